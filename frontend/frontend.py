@@ -977,18 +977,26 @@ def draw_gradio_ui(
                                             minimum=64,
                                             maximum=2048,
                                             step=64,
-                                            label="Height",
+                                            label="GoBig Tile Height",
                                             value=imgproc_defaults["height"],
-                                            visible=False,
-                                        )  # not currently implemented
+                                            visible=RealESRGAN is not None,
+                                        )
                                         imgproc_width = gr.Slider(
                                             minimum=64,
                                             maximum=2048,
                                             step=64,
-                                            label="Width",
+                                            label="GoBig Tile Width",
                                             value=imgproc_defaults["width"],
-                                            visible=False,
-                                        )  # not currently implemented
+                                            visible=RealESRGAN is not None,
+                                        )
+                                        imgproc_tile_overlap = gr.Slider(
+                                            minimum=0,
+                                            maximum=256,
+                                            step=8,
+                                            label="GoBig Tile Overlap",
+                                            value=imgproc_defaults["tile_overlap"],
+                                            visible=RealESRGAN is not None,
+                                        )
                                         imgproc_seed = gr.Textbox(
                                             label="Seed (blank to randomize)",
                                             lines=1,
@@ -1016,6 +1024,7 @@ def draw_gradio_ui(
                                                 imgproc_ldsr_steps,
                                                 imgproc_ldsr_pre_downSample,
                                                 imgproc_ldsr_post_downSample,
+                                                imgproc_tile_overlap,
                                             ],
                                             [imgproc_output],
                                             api_name="imgproc",
@@ -20,6 +20,11 @@ from typing import Dict, Optional
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 import copy
+import json
+
+# EXIF tags used to store the metadata on the formats that do not support text chunks like PNG.
+EXIF_IFD_POINTER = 0x8769
+EXIF_USER_COMMENT = 0x9286
 
 
 @dataclass
@@ -64,7 +69,9 @@ class ImageMetadata:
         if not metadata:
             found_metadata = False
             metadata = ImageMetadata()
-            for key, value in image.info.items():
+            info = dict(image.info)
+            info.update(cls.get_exif_user_comment(image))
+            for key, value in info.items():
                 if key.lower().startswith("sd:"):
                     key = key[3:]
                     if f"{key}" in metadata.__dict__:
@@ -75,3 +82,46 @@ class ImageMetadata:
         if not metadata:
             print("Couldn't find metadata on image")
         return metadata
+
+    @staticmethod
+    def get_exif_user_comment(image: Image) -> Dict[str, str]:
+        """Reads the metadata saved as JSON on the EXIF UserComment tag of JPEG and WebP images"""
+        try:
+            comment = image.getexif().get_ifd(EXIF_IFD_POINTER).get(EXIF_USER_COMMENT)
+        except Exception:
+            return {}
+        if not isinstance(comment, bytes):
+            return {}
+
+        # the first 8 bytes of the UserComment tag are the character code
+        if comment.startswith(b"UNICODE\0"):
+            text = comment[8:].decode(
+                "utf-16-be" if comment[8:9] == b"\0" else "utf-16-le", errors="replace"
+            )
+        else:
+            text = comment[8:].decode("utf-8", errors="replace")
+
+        try:
+            values = json.loads(text)
+        except ValueError:
+            return {}
+        if not isinstance(values, dict):
+            return {}
+        return {key: str(value) for key, value in values.items()}
+
+
+def metadata_to_exif(metadata: Dict[str, str]) -> bytes:
+    """Serializes the metadata as JSON into the UserComment tag of an EXIF block that can be passed
+    to Image.save(exif=...), get_exif_user_comment reads it back"""
+    # only saving JPEG and WebP images needs piexif, it isn't imported at startup.
+    import piexif
+    import piexif.helper
+
+    exif_dict = {
+        "Exif": {
+            piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(
+                json.dumps(metadata), encoding="unicode"
+            )
+        }
+    }
+    return piexif.dump(exif_dict)
@@ -17,11 +17,13 @@
 from __future__ import annotations
 import gradio as gr
 from gradio.components import Component, Gallery
-from threading import Event, Timer
+from threading import Event, Lock, Timer
 from typing import Callable, List, Dict, Tuple, Optional, Any
 from dataclasses import dataclass, field
 from functools import partial
 from PIL.Image import Image
+import heapq
+import itertools
 import uuid
 import traceback
 import time
@@ -62,6 +64,9 @@ class JobInfo:
     started: bool = False
     timestamp: float = None
     removed_output_idxs: List[int] = field(default_factory=list)
+    priority: int = 0
+    queue_item: Optional[QueueItem] = None
+    start_time: float = None
 
 
 @dataclass
@@ -70,9 +75,39 @@ class SessionInfo:
     finished_jobs: Dict[FuncKey, JobInfo] = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(order=True)
 class QueueItem:
-    wait_event: Event
+    """A job waiting for a token. Items are served by priority (lower first), then by the virtual
+    start time of their session so that sessions take turns, then in arrival order."""
+
+    priority: int
+    virtual_time: int
+    seq: int
+    session_key: str = field(compare=False)
+    job_type: str = field(compare=False)
+    wait_event: Event = field(compare=False, default_factory=Event)
+    enqueue_time: float = field(compare=False, default_factory=time.time)
+    token: Optional[int] = field(compare=False, default=None)
+    cancelled: bool = field(compare=False, default=False)
+    job_info: Optional[JobInfo] = field(compare=False, default=None, repr=False)
+
+
+@dataclass
+class JobTypeStats:
+    jobs: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+    service_total: float = 0.0
+    service_max: float = 0.0
+
+    def add_wait(self, seconds: float) -> None:
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def add_service(self, seconds: float) -> None:
+        self.jobs += 1
+        self.service_total += seconds
+        self.service_max = max(self.service_max, seconds)
 
 
 def triggerChangeEvent():
@@ -82,7 +117,11 @@ def triggerChangeEvent():
 @dataclass
 class JobManagerUi:
     def wrap_func(
-        self, func: Callable, inputs: List[Component], outputs: List[Component]
+        self,
+        func: Callable,
+        inputs: List[Component],
+        outputs: List[Component],
+        priority: int = 0,
     ) -> Tuple[Callable, List[Component], List[Component]]:
         """Takes a gradio event listener function and its input/outputs and returns wrapped replacements which will
             be managed by JobManager
@@ -95,13 +134,14 @@ class JobManagerUi:
         refresh_btn: (gr.Button, optional) a button to use for updating the gallery with intermediate results
         stop_btn: (gr.Button, optional) a button to use for stopping the function
         status_text: (gr.Textbox) a textbox to display job status updates
+        priority (int, optional) jobs with a lower priority are started first when jobs are queued
 
         Returns:
         Tuple(newFunc (Callable), newInputs (List[Component]), newOutputs (List[Component]), which should be used as
         replacements for the passed in function, inputs and outputs
         """
         return self._job_manager._wrap_func(
-            func=func, inputs=inputs, outputs=outputs, job_ui=self
+            func=func, inputs=inputs, outputs=outputs, job_ui=self, priority=priority
         )
 
     _refresh_btn: gr.Button
@@ -109,6 +149,7 @@ class JobManagerUi:
     _status_text: gr.Textbox
     _stop_all_session_btn: gr.Button
     _free_done_sessions_btn: gr.Button
+    _queue_stats_btn: gr.Button
     _active_image: gr.Image
     _active_image_stop_btn: gr.Button
     _active_image_refresh_btn: gr.Button
@@ -123,11 +164,20 @@ class JobManager:
     JOB_MAX_START_TIME = (
         5.0  # How long can a job be stuck 'starting' before assuming it isn't running
     )
+    # How long a job has to start running once it was given a token, before it's taken back
+    JOB_MAX_CLAIM_TIME = 60.0
 
     def __init__(self, max_jobs: int):
         self._max_jobs: int = max_jobs
         self._avail_job_tokens: List[Any] = list(range(max_jobs))
-        self._job_queue: List[QueueItem] = []
+        # tokens given to jobs that didn't start running yet: token -> (job, timer taking it back)
+        self._unclaimed_job_tokens: Dict[Any, Tuple[JobInfo, Timer]] = {}
+        self._job_queue: List[QueueItem] = []  # heap of QueueItem
+        self._queue_lock = Lock()
+        self._queue_seq = itertools.count()
+        self._virtual_time: int = 0
+        self._session_virtual_time: Dict[str, int] = {}
+        self._job_stats: Dict[str, JobTypeStats] = {}
         self._sessions: Dict[str, SessionInfo] = {}
         self._session_key: gr.JSON = None
 
@@ -199,6 +249,9 @@ class JobManager:
                         elem_id="clear_finished",
                         variant="secondary",
                     )
+                    queue_stats_btn = gr.Button(
+                        "Show Queue Stats", elem_id="queue_stats", variant="secondary"
+                    )
 
         return JobManagerUi(
             _refresh_btn=refresh_btn,
@@ -206,6 +259,7 @@ class JobManager:
             _status_text=status_text,
             _stop_all_session_btn=stop_all_sessions_btn,
             _free_done_sessions_btn=free_done_sessions_btn,
+            _queue_stats_btn=queue_stats_btn,
             _active_image=active_image,
             _active_image_stop_btn=active_image_stop_btn,
             _active_image_refresh_btn=active_image_refresh_btn,
@@ -229,37 +283,147 @@ class JobManager:
             for job in session.jobs.values():
                 job.should_stop.set()
                 job.stop_cur_iter.set()
+                self._cancel_queued_job(job)
+
+    def queue_stats(self) -> Dict[str, Any]:
+        """Queue depth and per job type wait and service times, in seconds"""
+        with self._queue_lock:
+            stats = {
+                "queued": sum(not item.cancelled for item in self._job_queue),
+                "available_tokens": len(self._avail_job_tokens),
+            }
+            for job_type, job_stats in self._job_stats.items():
+                stats[job_type] = {
+                    "jobs": job_stats.jobs,
+                    "avg_wait": round(job_stats.wait_total / max(job_stats.jobs, 1), 2),
+                    "max_wait": round(job_stats.wait_max, 2),
+                    "avg_service": round(
+                        job_stats.service_total / max(job_stats.jobs, 1), 2
+                    ),
+                    "max_service": round(job_stats.service_max, 2),
+                }
+        return stats
 
-    def _get_job_token(self, block: bool = False) -> Optional[int]:
-        """Attempts to acquire a job token, optionally blocking until available"""
-        token = None
-        while token is None:
-            try:
-                token = self._avail_job_tokens.pop()
-                break
-            except IndexError:
-                pass
+    def _queue_stats_text(self) -> str:
+        return "\n".join(f"{key}: {value}" for key, value in self.queue_stats().items())
 
-            if not block:
-                break
-
-            # No token and requested to block, so queue up
-            wait_event = Event()
-            self._job_queue.append(QueueItem(wait_event))
-            wait_event.wait()
+    def _get_job_stats(self, job_type: str) -> JobTypeStats:
+        return self._job_stats.setdefault(job_type, JobTypeStats())
 
+    def _get_job_token(self, job_info: JobInfo, block: bool = False) -> Optional[int]:
+        """Attempts to acquire a job token, optionally blocking until available.
+        Returns None if not blocking and no token is free, or if the job was cancelled while queued.
+        """
+        job_type = job_info.func.__name__
+        with self._queue_lock:
+            if self._avail_job_tokens and not self._job_queue:
+                self._get_job_stats(job_type).add_wait(time.time() - job_info.timestamp)
+                return self._hand_over_job_token(job_info)
+            if not block:
+                return None
+
+            # No token, or others are already waiting for one, so queue up
+            session_time = self._session_virtual_time.get(job_info.session_key, 0)
+            virtual_time = max(self._virtual_time, session_time) + 1
+            self._session_virtual_time[job_info.session_key] = virtual_time
+            queue_item = QueueItem(
+                priority=job_info.priority,
+                virtual_time=virtual_time,
+                seq=next(self._queue_seq),
+                session_key=job_info.session_key,
+                job_type=job_type,
+                job_info=job_info,
+            )
+            heapq.heappush(self._job_queue, queue_item)
+            job_info.queue_item = queue_item
+            # a token may have been released while no one was queued
+            self._run_queued_jobs()
+
+        queue_item.wait_event.wait()
+        job_info.queue_item = None
+        return None if queue_item.cancelled else queue_item.token
+
+    def _hand_over_job_token(self, job_info: JobInfo) -> int:
+        """Takes a free token for a job, it goes back to the pool unless the job claims it within
+        JOB_MAX_CLAIM_TIME, like when the browser was closed before the job could start.
+        Must be called with the queue lock held"""
+        token = self._avail_job_tokens.pop()
+        timer = Timer(
+            self.JOB_MAX_CLAIM_TIME, self._reclaim_job_token, args=(token, job_info)
+        )
+        timer.daemon = True
+        self._unclaimed_job_tokens[token] = (job_info, timer)
+        timer.start()
         return token
 
+    def _claim_job_token(self, job_info: JobInfo) -> bool:
+        """Marks the token of a job that starts running as in use, False if it has none anymore"""
+        with self._queue_lock:
+            owner, timer = self._unclaimed_job_tokens.get(
+                job_info.job_token, (None, None)
+            )
+            if owner is not job_info:
+                job_info.job_token = None
+                return False
+            del self._unclaimed_job_tokens[job_info.job_token]
+        timer.cancel()
+        return True
+
+    def _reclaim_job_token(self, token: int, job_info: JobInfo) -> None:
+        """Puts back a token that was given to a job which never started running"""
+        with self._queue_lock:
+            owner, timer = self._unclaimed_job_tokens.get(token, (None, None))
+            if owner is not job_info:
+                return
+            del self._unclaimed_job_tokens[token]
+            timer.cancel()
+            self._avail_job_tokens.append(token)
+            self._run_queued_jobs()
+
     def _release_job_token(self, token: int) -> None:
         """Returns a job token to allow another job to start"""
-        self._avail_job_tokens.append(token)
-        self._run_queued_jobs()
+        with self._queue_lock:
+            self._avail_job_tokens.append(token)
+            self._run_queued_jobs()
+
+    def _cancel_queued_job(self, job_info: JobInfo) -> None:
+        """Removes a job that didn't start from the queue, waking its waiter without a token, and
+        puts back the token it was given, if any"""
+        with self._queue_lock:
+            queue_item = job_info.queue_item
+            if queue_item is not None and not queue_item.cancelled:
+                queue_item.cancelled = True
+                if queue_item.token is None:
+                    self._job_queue.remove(queue_item)
+                    heapq.heapify(self._job_queue)
+                queue_item.wait_event.set()
+            tokens = [
+                token
+                for token, (owner, _) in self._unclaimed_job_tokens.items()
+                if owner is job_info
+            ]
+        for token in tokens:
+            self._reclaim_job_token(token, job_info)
+
+    def _queue_position(self, job_info: JobInfo) -> Optional[Tuple[int, int]]:
+        """1-based position of a queued job and the number of queued jobs"""
+        with self._queue_lock:
+            queue_item = job_info.queue_item
+            if queue_item is None or queue_item.token is not None:
+                return None
+            queued = sorted(item for item in self._job_queue if not item.cancelled)
+            if queue_item not in queued:
+                return None
+            return queued.index(queue_item) + 1, len(queued)
 
     def _refresh_func(self, func_key: FuncKey, session_key: str) -> List[Component]:
         """Updates information from the active job"""
         session_info, job_info = self._get_call_info(func_key, session_key)
         if job_info is None:
             return [None, f"Session {session_key} was not running function {func_key}"]
+        position = self._queue_position(job_info)
+        if position is not None:
+            return [triggerChangeEvent(), "Job is queued, position %d of %d" % position]
         return [triggerChangeEvent(), job_info.job_status]
 
     def _stop_wrapped_func(
@@ -270,6 +434,9 @@ class JobManager:
         if job_info is None:
             return f"Session {session_key} was not running function {func_key}"
         job_info.should_stop.set()
+        if job_info.queue_item is not None:
+            self._cancel_queued_job(job_info)
+            return "Removed job from the queue"
         return "Stopping after current batch finishes"
 
     def _refresh_cur_iter_func(
@@ -318,18 +485,18 @@ class JobManager:
         return session_info, job_info
 
     def _run_queued_jobs(self) -> None:
-        """Runs queued jobs for any available slots"""
-        if self._avail_job_tokens:
-            try:
-                # Notify next queued job it may begin
-                queue_item = self._job_queue.pop(0)
-                queue_item.wait_event.set()
-
-                # Check again in a few seconds, just in case the queued
-                # waiter closed the browser while still queued
-                Timer(3.0, self._run_queued_jobs).start()
-            except IndexError:
-                pass  # No queued jobs
+        """Hands available tokens to the next queued jobs. Must be called with the queue lock held"""
+        while self._avail_job_tokens and self._job_queue:
+            queue_item = heapq.heappop(self._job_queue)
+            if queue_item.cancelled:
+                continue
+            # the token is handed over directly, so the woken waiter can't lose it to another job
+            queue_item.token = self._hand_over_job_token(queue_item.job_info)
+            self._virtual_time = max(self._virtual_time, queue_item.virtual_time)
+            self._get_job_stats(queue_item.job_type).add_wait(
+                time.time() - queue_item.enqueue_time
+            )
+            queue_item.wait_event.set()
 
     def _pre_call_func(
         self,
@@ -348,7 +515,7 @@ class JobManager:
 
         # If we didn't already get a token then queue up for one
         if job_info.job_token is None:
-            job_info.job_token = self._get_job_token(block=True)
+            job_info.job_token = self._get_job_token(job_info, block=True)
 
         # Buttons don't seem to update unless value is set on them as well...
         return {
@@ -373,8 +540,10 @@ class JobManager:
             return []
 
         job_info.started = True
+        job_info.start_time = time.time()
+        claimed = job_info.job_token is not None and self._claim_job_token(job_info)
         try:
-            if job_info.should_stop.is_set():
+            if job_info.should_stop.is_set() or not claimed:
                 raise Exception(
                     f"Job {job_info} requested a stop before execution began"
                 )
@@ -386,7 +555,12 @@ class JobManager:
         finally:
             job_info.finished = True
             session_info.finished_jobs[func_key] = session_info.jobs.pop(func_key)
-            self._release_job_token(job_info.job_token)
+            if claimed:
+                with self._queue_lock:
+                    self._get_job_stats(job_info.func.__name__).add_service(
+                        time.time() - job_info.start_time
+                    )
+                self._release_job_token(job_info.job_token)
 
         # Filter the function output for any removed outputs
         filtered_output = []
@@ -445,6 +619,7 @@ class JobManager:
         inputs: List[Component],
         outputs: List[Component],
         job_ui: JobManagerUi,
+        priority: int = 0,
     ) -> Tuple[Callable, List[Component]]:
         """handles JobManageUI's wrap_func"""
 
@@ -525,6 +700,11 @@ class JobManager:
                 self.clear_all_finished_jobs, [], [], queue=False
             )
 
+        if job_ui._queue_stats_btn:
+            job_ui._queue_stats_btn.click(
+                self._queue_stats_text, [], [job_ui._status_text], queue=False
+            )
+
         # (ab)use gr.JSON to forward events.
         # The gr.JSON object will fire its 'change' event when it is modified by being the output
         # of another component. This allows a method to forward events and allow multiple components
@@ -613,6 +793,7 @@ class JobManager:
                 ):
                     job_info.should_stop.set()
                     job_info.stop_cur_iter.set()
+                    self._cancel_queued_job(job_info)
                     session_info.jobs.pop(func_key)
                     return {
                         job_ui._status_text: "Canceled possibly hung job. Try again"
@@ -625,19 +806,19 @@ class JobManager:
             if func_key in session_info.finished_jobs:
                 session_info.finished_jobs.pop(func_key)
 
-            job_token = self._get_job_token(block=False)
             job = JobInfo(
                 inputs=job_inputs,
                 func=func,
                 removed_output_idxs=removed_idxs,
                 session_key=session_key,
-                job_token=job_token,
                 rec_steps_enabled=record_steps_enabled,
                 rec_steps_intrvl=rec_steps_interval,
                 rec_steps_to_gallery=save_rec_steps_grid,
                 rec_steps_to_file=save_rec_steps_file,
                 timestamp=time.time(),
+                priority=priority,
             )
+            job_token = job.job_token = self._get_job_token(job, block=False)
             session_info.jobs[func_key] = job
 
             ret = {pre_call_dummyobj: triggerChangeEvent()}
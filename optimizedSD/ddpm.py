@@ -6,6 +6,8 @@ https://github.com/CompVis/taming-transformers
 -- merci
 """
 
+import contextlib
+import threading
 from tqdm.auto import trange, tqdm
 import torch
 from einops import rearrange
@@ -17,6 +19,7 @@ import pytorch_lightning as pl
 from functools import partial
 from pytorch_lightning.utilities.distributed import rank_zero_only
 from ldm.util import exists, default, instantiate_from_config
+from optimizedSD.offload import get_offloader
 from ldm.modules.diffusionmodules.util import make_beta_schedule
 from ldm.modules.diffusionmodules.util import (
     make_ddim_sampling_parameters,
@@ -382,6 +385,66 @@ class DiffusionWrapperOut(pl.LightningModule):
         return self.diffusion_model(h, emb, tp, hs, context=cc)
 
 
+def split_buffer(buffers, name, like, bs):
+    """A tensor with room for bs rows shaped like like, taken from buffers when one with the same
+    shape, dtype and device is there already."""
+    shape = (bs,) + tuple(like.shape[1:])
+    key = (shape, like.dtype, like.device, torch.is_inference_mode_enabled())
+    if name not in buffers or buffers[name][0] != key:
+        buffers[name] = (key, torch.empty(shape, dtype=like.dtype, device=like.device))
+    return buffers[name][1]
+
+
+def run_split_encoder(model1, x_noisy, t, cond, step, buffers=None):
+    """Runs model1 on slices of step rows and gathers h, emb and hs for the whole batch. The
+    slices are written in place into tensors from buffers, so the same memory serves every
+    sampling step."""
+    bs = cond.shape[0]
+    h, emb, hs = model1(x_noisy[:step], t[:step], cond[:step])
+    if bs <= step:
+        return h, emb, hs
+
+    if buffers is None:
+        buffers = {}
+    outputs = [h, emb] + hs
+    gathered = [
+        split_buffer(buffers, j, output, bs) for j, output in enumerate(outputs)
+    ]
+    for i in range(0, bs, step):
+        if i > 0:
+            h, emb, hs = model1(
+                x_noisy[i : i + step], t[i : i + step], cond[i : i + step]
+            )
+            outputs = [h, emb] + hs
+        for buffer, output in zip(gathered, outputs):
+            buffer[i : i + step] = output
+
+    return gathered[0], gathered[1], gathered[2:]
+
+
+def run_split_decoder(model2, h, emb, dtype, hs, cond, step):
+    """Runs model2 on slices of step rows and writes them into one output tensor. The output is
+    allocated on every call since the samplers keep it around (plms keeps the last few).
+    """
+    bs = cond.shape[0]
+    out = None
+    for i in range(0, bs, step):
+        x_recon = model2(
+            h[i : i + step],
+            emb[i : i + step],
+            dtype,
+            [hs[j][i : i + step] for j in range(len(hs))],
+            cond[i : i + step],
+        )
+        if bs <= step:
+            return x_recon
+        if out is None:
+            out = x_recon.new_empty((bs,) + tuple(x_recon.shape[1:]))
+        out[i : i + step] = x_recon
+
+    return out
+
+
 class UNet(DDPM):
     """main class"""
 
@@ -429,7 +492,12 @@ class UNet(DDPM):
         self.model1.eval()
         self.model2.eval()
         self.turbo = False
+        # copy the next half of the unet in while the current one computes, needs both halves to fit.
+        self.prefetch = False
         self.unet_bs = unet_bs
+        # whole-batch outputs of model1, reused from one sampling step to the next inside
+        # reuse_split_buffers(), per thread so concurrent jobs don't share them.
+        self.split_buffers = threading.local()
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys)
@@ -473,46 +541,46 @@ class UNet(DDPM):
             print(f"setting self.scale_factor to {self.scale_factor}")
             print("### USING STD-RESCALING ###")
 
+    @contextlib.contextmanager
+    def reuse_split_buffers(self):
+        """Shares split buffers between the apply_model calls this thread makes in the block
+        and releases them when it exits, calls outside of it allocate their own."""
+        previous = getattr(self.split_buffers, "current", None)
+        self.split_buffers.current = {}
+        try:
+            yield
+        finally:
+            self.split_buffers.current = previous
+
     def apply_model(self, x_noisy, t, cond, return_ids=False):
         if not self.turbo:
-            self.model1.to(self.cdevice)
-
-        step = self.unet_bs
-        h, emb, hs = self.model1(x_noisy[0:step], t[:step], cond[:step])
-        bs = cond.shape[0]
-
-        # assert bs%2 == 0
-        lenhs = len(hs)
-
-        for i in range(step, bs, step):
-            h_temp, emb_temp, hs_temp = self.model1(
-                x_noisy[i : i + step], t[i : i + step], cond[i : i + step]
-            )
-            h = torch.cat((h, h_temp))
-            emb = torch.cat((emb, emb_temp))
-            for j in range(lenhs):
-                hs[j] = torch.cat((hs[j], hs_temp[j]))
+            offloader = get_offloader(self.cdevice)
+            offloader.acquire(self.model1)
+            if self.prefetch:
+                offloader.prefetch(self.model2)
+
+        h, emb, hs = run_split_encoder(
+            self.model1,
+            x_noisy,
+            t,
+            cond,
+            self.unet_bs,
+            getattr(self.split_buffers, "current", None),
+        )
 
         if not self.turbo:
-            self.model1.to("cpu")
-            self.model2.to(self.cdevice)
-
-        hs_temp = [hs[j][:step] for j in range(lenhs)]
-        x_recon = self.model2(h[:step], emb[:step], x_noisy.dtype, hs_temp, cond[:step])
-
-        for i in range(step, bs, step):
-            hs_temp = [hs[j][i : i + step] for j in range(lenhs)]
-            x_recon1 = self.model2(
-                h[i : i + step],
-                emb[i : i + step],
-                x_noisy.dtype,
-                hs_temp,
-                cond[i : i + step],
-            )
-            x_recon = torch.cat((x_recon, x_recon1))
+            offloader.offload(self.model1)
+            offloader.acquire(self.model2)
+
+        x_recon = run_split_decoder(
+            self.model2, h, emb, x_noisy.dtype, hs, cond, self.unet_bs
+        )
 
         if not self.turbo:
-            self.model2.to("cpu")
+            offloader.offload(self.model2)
+            if self.prefetch:
+                # the next step starts with the first half again.
+                offloader.prefetch(self.model1)
 
         if isinstance(x_recon, tuple) and not return_ids:
             return x_recon[0]
@@ -580,124 +648,124 @@ class UNet(DDPM):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
     ):
-        if self.turbo:
-            self.model1.to(self.cdevice)
-            self.model2.to(self.cdevice)
-
-        if x0 is None:
-            batch_size, b1, b2, b3 = shape
-            img_shape = (1, b1, b2, b3)
-            tens = []
-            print("seeds used = ", [seed + s for s in range(batch_size)])
-            for _ in range(batch_size):
-                torch.manual_seed(seed)
-                tens.append(torch.randn(img_shape, device=self.cdevice))
-                seed += 1
-            noise = torch.cat(tens)
-            del tens
-
-        x_latent = noise if x0 is None else x0
-        # sampling
-
-        if sampler == "plms":
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-            print(f"Data shape for PLMS sampling is {shape}")
-            samples = self.plms_sampling(
-                conditioning,
-                batch_size,
-                x_latent,
-                callback=callback,
-                img_callback=img_callback,
-                quantize_denoised=quantize_x0,
-                mask=mask,
-                x0=x0,
-                ddim_use_original_steps=False,
-                noise_dropout=noise_dropout,
-                temperature=temperature,
-                score_corrector=score_corrector,
-                corrector_kwargs=corrector_kwargs,
-                log_every_t=log_every_t,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=unconditional_conditioning,
-            )
-
-        elif sampler == "ddim":
-            samples = self.ddim_sampling(
-                x_latent,
-                conditioning,
-                S,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=unconditional_conditioning,
-                mask=mask,
-                init_latent=x_T,
-                use_original_steps=False,
-            )
+        with self.reuse_split_buffers():
+            if self.turbo:
+                self.model1.to(self.cdevice)
+                self.model2.to(self.cdevice)
+
+            if x0 is None:
+                batch_size, b1, b2, b3 = shape
+                img_shape = (1, b1, b2, b3)
+                tens = []
+                print("seeds used = ", [seed + s for s in range(batch_size)])
+                for _ in range(batch_size):
+                    torch.manual_seed(seed)
+                    tens.append(torch.randn(img_shape, device=self.cdevice))
+                    seed += 1
+                noise = torch.cat(tens)
+                del tens
+
+            x_latent = noise if x0 is None else x0
+            # sampling
+
+            if sampler == "plms":
+                self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
+                print(f"Data shape for PLMS sampling is {shape}")
+                samples = self.plms_sampling(
+                    conditioning,
+                    batch_size,
+                    x_latent,
+                    callback=callback,
+                    img_callback=img_callback,
+                    quantize_denoised=quantize_x0,
+                    mask=mask,
+                    x0=x0,
+                    ddim_use_original_steps=False,
+                    noise_dropout=noise_dropout,
+                    temperature=temperature,
+                    score_corrector=score_corrector,
+                    corrector_kwargs=corrector_kwargs,
+                    log_every_t=log_every_t,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    unconditional_conditioning=unconditional_conditioning,
+                )
 
-        elif sampler == "euler":
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-            samples = self.euler_sampling(
-                self.alphas_cumprod,
-                x_latent,
-                S,
-                conditioning,
-                unconditional_conditioning=unconditional_conditioning,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-            )
-        elif sampler == "euler_a":
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-            samples = self.euler_ancestral_sampling(
-                self.alphas_cumprod,
-                x_latent,
-                S,
-                conditioning,
-                unconditional_conditioning=unconditional_conditioning,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-            )
+            elif sampler == "ddim":
+                samples = self.ddim_sampling(
+                    x_latent,
+                    conditioning,
+                    S,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    unconditional_conditioning=unconditional_conditioning,
+                    mask=mask,
+                    init_latent=x_T,
+                    use_original_steps=False,
+                )
 
-        elif sampler == "dpm2":
-            samples = self.dpm_2_sampling(
-                self.alphas_cumprod,
-                x_latent,
-                S,
-                conditioning,
-                unconditional_conditioning=unconditional_conditioning,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-            )
-        elif sampler == "heun":
-            samples = self.heun_sampling(
-                self.alphas_cumprod,
-                x_latent,
-                S,
-                conditioning,
-                unconditional_conditioning=unconditional_conditioning,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-            )
+            elif sampler == "euler":
+                self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
+                samples = self.euler_sampling(
+                    self.alphas_cumprod,
+                    x_latent,
+                    S,
+                    conditioning,
+                    unconditional_conditioning=unconditional_conditioning,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                )
+            elif sampler == "euler_a":
+                self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
+                samples = self.euler_ancestral_sampling(
+                    self.alphas_cumprod,
+                    x_latent,
+                    S,
+                    conditioning,
+                    unconditional_conditioning=unconditional_conditioning,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                )
 
-        elif sampler == "dpm2_a":
-            samples = self.dpm_2_ancestral_sampling(
-                self.alphas_cumprod,
-                x_latent,
-                S,
-                conditioning,
-                unconditional_conditioning=unconditional_conditioning,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-            )
+            elif sampler == "dpm2":
+                samples = self.dpm_2_sampling(
+                    self.alphas_cumprod,
+                    x_latent,
+                    S,
+                    conditioning,
+                    unconditional_conditioning=unconditional_conditioning,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                )
+            elif sampler == "heun":
+                samples = self.heun_sampling(
+                    self.alphas_cumprod,
+                    x_latent,
+                    S,
+                    conditioning,
+                    unconditional_conditioning=unconditional_conditioning,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                )
 
-        elif sampler == "lms":
-            samples = self.lms_sampling(
-                self.alphas_cumprod,
-                x_latent,
-                S,
-                conditioning,
-                unconditional_conditioning=unconditional_conditioning,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-            )
+            elif sampler == "dpm2_a":
+                samples = self.dpm_2_ancestral_sampling(
+                    self.alphas_cumprod,
+                    x_latent,
+                    S,
+                    conditioning,
+                    unconditional_conditioning=unconditional_conditioning,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                )
 
-        if self.turbo:
-            self.model1.to("cpu")
-            self.model2.to("cpu")
+            elif sampler == "lms":
+                samples = self.lms_sampling(
+                    self.alphas_cumprod,
+                    x_latent,
+                    S,
+                    conditioning,
+                    unconditional_conditioning=unconditional_conditioning,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                )
 
-        return samples
+            if self.turbo:
+                self.model1.to("cpu")
+                self.model2.to("cpu")
+            return samples
 
     @torch.no_grad()
     def plms_sampling(
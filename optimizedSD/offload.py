@@ -0,0 +1,155 @@
+"""
+moves the sub-models of optimized mode between the cpu and the gpu without stalling the host.
+
+copies are queued on a side stream with non-blocking transfers, ordered after the work already
+queued on the compute stream, and the compute stream waits on cuda events for them instead of
+the host polling torch.cuda.memory_allocated().
+"""
+
+import itertools
+
+import torch
+
+
+def cuda_tensors(module):
+    """The parameters and buffers of module that live on a gpu."""
+    return [
+        tensor
+        for tensor in itertools.chain(module.parameters(), module.buffers())
+        if tensor.is_cuda
+    ]
+
+
+class CudaOffloadBackend:
+    """Copies modules on a dedicated cuda stream."""
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device)
+
+    def location(self, module):
+        return next(module.parameters()).device.type
+
+    def copy(self, module, device):
+        """Queues the copy of module to device after the work already queued on the compute
+        stream and returns an event recorded once the copy is done. Copies back to the cpu land
+        in pinned memory, so the next copy to the gpu is asynchronous as well."""
+        compute_stream = torch.cuda.current_stream(self.device)
+        self.stream.wait_stream(compute_stream)
+        # module.to() frees the old storage as soon as it's swapped out, while the copy may still
+        # be reading it. recording the side stream keeps the allocator from handing that memory
+        # to the compute stream before the copy is done.
+        for tensor in cuda_tensors(module):
+            tensor.record_stream(self.stream)
+        with torch.cuda.stream(self.stream):
+            module.to(device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        # the new storage belongs to the side stream but is used on the compute stream.
+        for tensor in cuda_tensors(module):
+            tensor.record_stream(compute_stream)
+        return event
+
+    def wait(self, event):
+        """Makes the compute stream wait for the event, the host carries on."""
+        torch.cuda.current_stream(self.device).wait_event(event)
+
+    def synchronize(self, event):
+        event.synchronize()
+
+
+class FakeOffloadBackend:
+    """Test double of CudaOffloadBackend that runs without a gpu. It doesn't move any tensor, it
+    keeps track of where every module would be and raises AssertionError when the offloader
+    breaks an invariant: more than max_resident modules on the device at once, or a module used
+    before the compute stream waited for its last copy."""
+
+    def __init__(self, max_resident=None):
+        self.max_resident = max_resident
+        self.locations = {}
+        self.last_event = {}
+        self.waited = set()
+        self.log = []
+        self.events = 0
+
+    def location(self, module):
+        return self.locations.get(id(module), "cpu")
+
+    def copy(self, module, device):
+        device = torch.device(device).type
+        self.locations[id(module)] = device
+        resident = sum(location != "cpu" for location in self.locations.values())
+        assert (
+            self.max_resident is None or resident <= self.max_resident
+        ), f"{resident} modules resident, at most {self.max_resident} allowed"
+        self.events += 1
+        event = self.events
+        self.last_event[id(module)] = event
+        self.log.append(("copy", id(module), device, event))
+        return event
+
+    def wait(self, event):
+        self.waited.add(event)
+        self.log.append(("wait", event))
+
+    def synchronize(self, event):
+        self.wait(event)
+
+    def check_usable(self, module):
+        """Asserts that module can be used by the work queued next on the compute stream."""
+        assert self.location(module) != "cpu", "module used while offloaded"
+        assert (
+            self.last_event[id(module)] in self.waited
+        ), "module used before its copy to the device was waited for"
+
+
+class ModelOffloader:
+    """Moves modules to the device when they are needed and back to the cpu when they aren't.
+
+    prefetch starts bringing a module in while the current one computes, acquire makes the
+    compute stream wait until the module is there, offload queues the copy back to the cpu
+    after the work that uses it. On a cpu device, or without cuda, modules are moved
+    synchronously."""
+
+    def __init__(self, device, backend=None):
+        self.device = torch.device(device)
+        if backend is None and self.device.type == "cuda" and torch.cuda.is_available():
+            backend = CudaOffloadBackend(self.device)
+        self.backend = backend
+        self.events = {}
+
+    def prefetch(self, module):
+        """Starts copying module to the device without waiting for it."""
+        if self.backend is None:
+            module.to(self.device)
+        elif self.backend.location(module) != self.device.type:
+            self.events[id(module)] = self.backend.copy(module, self.device)
+
+    def acquire(self, module):
+        """Makes sure the work queued next on the compute stream sees module on the device."""
+        self.prefetch(module)
+        if self.backend is not None and id(module) in self.events:
+            self.backend.wait(self.events.pop(id(module)))
+
+    def offload(self, module):
+        """Moves module back to the cpu once the work queued so far is done with it."""
+        if self.backend is None:
+            module.to("cpu")
+        elif self.backend.location(module) != "cpu":
+            self.events[id(module)] = self.backend.copy(module, "cpu")
+
+    def synchronize(self, module):
+        """Blocks the host until the last copy of module is done."""
+        if self.backend is not None and id(module) in self.events:
+            self.backend.synchronize(self.events[id(module)])
+
+
+offloaders = {}
+
+
+def get_offloader(device):
+    """The ModelOffloader shared by everything running on device."""
+    device = torch.device(device)
+    if device not in offloaders:
+        offloaders[device] = ModelOffloader(device)
+    return offloaders[device]
@@ -0,0 +1,543 @@
+# This file is part of sygil-webui (https://github.com/Sygil-Dev/sygil-webui/).
+
+# Copyright 2022 Sygil-Dev team.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+benchmarks for the hot paths of the webui, each one prints a table and returns its rows.
+run them from the repository root:
+
+    python scripts/benchmarks.py [name ...]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_split_model_reference(model1, model2, x_noisy, t, cond, step):
+    """The previous split execution that grows its outputs with torch.cat, for benchmarks."""
+    h, emb, hs = model1(x_noisy[0:step], t[:step], cond[:step])
+    bs = cond.shape[0]
+    lenhs = len(hs)
+    for i in range(step, bs, step):
+        h_temp, emb_temp, hs_temp = model1(
+            x_noisy[i : i + step], t[i : i + step], cond[i : i + step]
+        )
+        h = torch.cat((h, h_temp))
+        emb = torch.cat((emb, emb_temp))
+        for j in range(lenhs):
+            hs[j] = torch.cat((hs[j], hs_temp[j]))
+
+    hs_temp = [hs[j][:step] for j in range(lenhs)]
+    x_recon = model2(h[:step], emb[:step], x_noisy.dtype, hs_temp, cond[:step])
+    for i in range(step, bs, step):
+        hs_temp = [hs[j][i : i + step] for j in range(lenhs)]
+        x_recon1 = model2(
+            h[i : i + step],
+            emb[i : i + step],
+            x_noisy.dtype,
+            hs_temp,
+            cond[i : i + step],
+        )
+        x_recon = torch.cat((x_recon, x_recon1))
+    return x_recon
+
+
+def benchmark_split_model(
+    batch_sizes=(2, 4, 8, 16), unet_bs_values=(1, 2, 4), size=32, steps=5
+):
+    """Compares run_split_encoder/run_split_decoder with run_split_model_reference on the cpu.
+
+    model1 and model2 are stand-ins that return tensors with the shapes of the sd unet (12 skip
+    connections at 4 resolutions) and do almost no work, so the numbers are the cost of
+    gathering the slices; the allocations include what the stand-ins return. Returns rows of
+    (batch size, unet_bs, seconds and allocated MB per step for the reference, the same for the
+    buffered path)."""
+    channels = [320] * 4 + [640] * 3 + [1280] * 5
+    sizes = [size] * 3 + [size // 2] * 3 + [size // 4] * 3 + [size // 8] * 3
+
+    def model1(x, t, cond):
+        b = x.shape[0]
+        hs = [
+            x[:, :1, :s, :s].expand(b, c, s, s).contiguous()
+            for c, s in zip(channels, sizes)
+        ]
+        return hs[-1].clone(), t[:, None].expand(b, 1280).float(), hs
+
+    def model2(h, emb, dtype, hs, cond):
+        return hs[0][:, :4].to(dtype) + h[:, :4].mean()
+
+    def run(fn, *args):
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            start = time.perf_counter()
+            for _ in range(steps):
+                fn(*args)
+            elapsed = (time.perf_counter() - start) / steps
+        allocated = sum(max(event.cpu_memory_usage, 0) for event in prof.events())
+        return elapsed, allocated / steps / 2**20
+
+    from optimizedSD.ddpm import run_split_decoder, run_split_encoder
+
+    def buffered(x, t, cond, step, buffers):
+        h, emb, hs = run_split_encoder(model1, x, t, cond, step, buffers)
+        return run_split_decoder(model2, h, emb, x.dtype, hs, cond, step)
+
+    rows = []
+    with torch.no_grad():
+        for bs in batch_sizes:
+            x = torch.randn(bs, 4, size, size)
+            t = torch.arange(bs)
+            cond = torch.randn(bs, 77, 768)
+            for step in unet_bs_values:
+                if step > bs:
+                    continue
+                buffers = {}
+                expected = run_split_model_reference(model1, model2, x, t, cond, step)
+                assert torch.equal(buffered(x, t, cond, step, buffers), expected)
+                rows.append(
+                    (bs, step)
+                    + run(run_split_model_reference, model1, model2, x, t, cond, step)
+                    + run(buffered, x, t, cond, step, buffers)
+                )
+    for row in rows:
+        print("bs %2d unet_bs %d: torch.cat %.4fs %.1fMB, buffers %.4fs %.1fMB" % row)
+    return rows
+
+
+def transform_image_3d(
+    img_out,
+    img_in,
+    depth,
+    depth_near,
+    depth_scale,
+    fx0,
+    fy0,
+    cx0,
+    cy0,
+    fx1,
+    fy1,
+    cx1,
+    cy1,
+    rot_cam1_cam0,
+    offset_cam1_cam0,
+    min_mask,
+    max_mask,
+):
+    """The previous scn2img forward splat without depth test, for benchmarks."""
+    # (u0,v0)  : 2d pixel position in img_in
+    # pos_cam0 : 3d pixel position in cam0 coordinate system
+    # pos_cam1 : 3d pixel position in cam1 coordinate system
+    # (u1,v1)  : 2d pixel position in img_out
+    m00 = rot_cam1_cam0[0, 0]
+    m01 = rot_cam1_cam0[0, 1]
+    m02 = rot_cam1_cam0[0, 2]
+    m10 = rot_cam1_cam0[1, 0]
+    m11 = rot_cam1_cam0[1, 1]
+    m12 = rot_cam1_cam0[1, 2]
+    m20 = rot_cam1_cam0[2, 0]
+    m21 = rot_cam1_cam0[2, 1]
+    m22 = rot_cam1_cam0[2, 2]
+    h0 = int(depth.shape[0])
+    w0 = int(depth.shape[1])
+    h1 = int(img_out.shape[0])
+    w1 = int(img_out.shape[1])
+    for v0 in range(h0):
+        y0_ = fy0 * (v0 - cy0)
+        for u0 in range(w0):
+            r, g, b, a = img_in[v0, u0]
+            x0_ = fx0 * (u0 - cx0)
+            z0 = depth_near + depth[v0, u0] * depth_scale
+            x0 = x0_ * z0
+            y0 = y0_ * z0
+            x1 = offset_cam1_cam0[0] + m00 * x0 + m01 * y0 + m02 * z0
+            y1 = offset_cam1_cam0[1] + m10 * x0 + m11 * y0 + m12 * z0
+            z1 = offset_cam1_cam0[2] + m20 * x0 + m21 * y0 + m22 * z0
+            if z1 <= 0:
+                continue
+            u1 = int(0.5 + (x1 / (z1 * fx1)) + cx1)
+            v1 = int(0.5 + (y1 / (z1 * fy1)) + cy1)
+            if u1 < 0:
+                u1 = 0
+            if u1 >= w1:
+                u1 = w1 - 1
+            if v1 < 0:
+                v1 = 0
+            if v1 >= h1:
+                v1 = h1 - 1
+            img_out[v1, u1, 0] = r
+            img_out[v1, u1, 1] = g
+            img_out[v1, u1, 2] = b
+            img_out[v1, u1, 3] = a
+
+
+def benchmark_transform_image_3d(sizes=(512, 1024), repeats=3, device="cpu"):
+    """Times the previous transform_image_3d (numba-jitted), reproject_images_3d on the cpu and
+    reproject_images_3d_torch on device for a small camera move. Returns the seconds per image
+    by (size, name)."""
+    import numba
+
+    from scn2img import (
+        CameraInfo,
+        affine_inv,
+        pose3d_rpy,
+        reproject_images_3d,
+        reproject_images_3d_torch,
+    )
+
+    reference = numba.jit(nopython=True)(transform_image_3d)
+    results = {}
+    for size in sizes:
+        rng = np.random.default_rng(0)
+        img_in = rng.integers(0, 256, size=(size, size, 4), dtype=np.uint8)
+        depth = rng.random((size, size), dtype=np.float32)
+        from_caminfo = CameraInfo((size, size))
+        to_caminfo = CameraInfo((size, size), pose=pose3d_rpy(0.1, 0, 0.2, 0, 0.05, 0))
+        tf_cam1_cam0 = affine_inv(to_caminfo.pose) @ from_caminfo.pose
+
+        def run_reference():
+            img_out = np.zeros_like(img_in)
+            reference(
+                img_out,
+                img_in,
+                depth,
+                1.0,
+                1.0,
+                from_caminfo.fx,
+                from_caminfo.fy,
+                from_caminfo.cx,
+                from_caminfo.cy,
+                to_caminfo.fx,
+                to_caminfo.fy,
+                to_caminfo.cx,
+                to_caminfo.cy,
+                tf_cam1_cam0[:3, :3],
+                tf_cam1_cam0[:3, 3],
+                0,
+                255,
+            )
+
+        def run_cpu():
+            reproject_images_3d(img_in, depth, 1.0, 1.0, from_caminfo, [to_caminfo])
+
+        def run_torch():
+            reproject_images_3d_torch(
+                img_in, depth, 1.0, 1.0, from_caminfo, [to_caminfo], device=device
+            )
+
+        runs = (("reference", run_reference), ("numba", run_cpu), ("torch", run_torch))
+        for name, func in runs:
+            # the first call includes the jit compilation.
+            func()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                func()
+            if torch.device(device).type == "cuda":
+                torch.cuda.synchronize(device)
+            results[(size, name)] = (time.perf_counter() - start) / repeats
+        print(
+            f"transform_image_3d {size}x{size}: "
+            + ", ".join(f"{name} {results[(size, name)]:.4f}s" for name, _ in runs)
+            + f" (torch on {device})"
+        )
+    return results
+
+
+def benchmark_create_random_tensors(
+    shape=(4, 64, 64), batch_sizes=(1, 2, 4, 8, 16, 32, 64), repeats=10
+):
+    """Compares create_random_tensors with the old implementation that reseeded the global RNG
+    for each seed and stacked the results, and checks that compat mode gives the same noise.
+    """
+    from sd_utils import create_random_tensors, st
+
+    device = (
+        torch.device(f"cuda:{st.session_state['defaults'].general.gpu}")
+        if torch.cuda.is_available()
+        else torch.device("cpu")
+    )
+
+    def create_random_tensors_stack(shape, seeds):
+        xs = []
+        for seed in seeds:
+            torch.manual_seed(seed)
+            xs.append(torch.randn(shape, device=device))
+        return torch.stack(xs)
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def timed(func, *args, **kwargs):
+        func(*args, **kwargs)
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            func(*args, **kwargs)
+        synchronize()
+        return (time.perf_counter() - start) / repeats * 1000
+
+    results = []
+    for batch_size in batch_sizes:
+        seeds = [random.randint(0, 2**32 - 1) for _ in range(batch_size)]
+
+        same = torch.equal(
+            create_random_tensors_stack(shape, seeds),
+            create_random_tensors(shape, seeds, compat=True),
+        )
+        results.append(
+            {
+                "batch_size": batch_size,
+                "stack_ms": round(timed(create_random_tensors_stack, shape, seeds), 3),
+                "compat_ms": round(
+                    timed(create_random_tensors, shape, seeds, compat=True), 3
+                ),
+                "cpu_ms": round(
+                    timed(create_random_tensors, shape, seeds, compat=False), 3
+                ),
+                "compat_matches": same,
+            }
+        )
+        print(results[-1])
+
+    return results
+
+
+def get_matched_noise_reference(_np_src_image, np_mask_rgb, noise_q, color_variation):
+    """The original float64 complex-FFT get_matched_noise, kept for benchmark_matched_noise."""
+    import skimage.exposure
+
+    from sd_utils import (
+        _fft2,
+        _get_gaussian_window,
+        _get_masked_window_rgb,
+        _ifft2,
+    )
+
+    width = _np_src_image.shape[0]
+    height = _np_src_image.shape[1]
+    num_channels = _np_src_image.shape[2]
+
+    np_mask_grey = np.sum(np_mask_rgb, axis=2) / 3.0
+    img_mask = np_mask_grey > 1e-6
+    ref_mask = np_mask_grey < 1e-3
+
+    windowed_image = _np_src_image * (1.0 - _get_masked_window_rgb(np_mask_grey))
+    windowed_image /= np.max(windowed_image)
+    windowed_image += np.average(_np_src_image) * np_mask_rgb
+
+    src_fft = _fft2(windowed_image)  # get feature statistics from masked src img
+    src_dist = np.absolute(src_fft)
+    src_phase = src_fft / src_dist
+
+    noise_window = _get_gaussian_window(width, height, mode=1)
+    noise_rgb = np.random.random_sample((width, height, num_channels))
+    noise_grey = np.sum(noise_rgb, axis=2) / 3.0
+    noise_rgb *= color_variation
+    for c in range(num_channels):
+        noise_rgb[:, :, c] += (1.0 - color_variation) * noise_grey
+
+    noise_fft = _fft2(noise_rgb)
+    for c in range(num_channels):
+        noise_fft[:, :, c] *= noise_window
+    noise_rgb = np.real(_ifft2(noise_fft))
+    shaped_noise_fft = _fft2(noise_rgb)
+    shaped_noise_fft[:, :, :] = (
+        np.absolute(shaped_noise_fft[:, :, :]) ** 2 * (src_dist**noise_q) * src_phase
+    )
+
+    shaped_noise = np.real(_ifft2(shaped_noise_fft))
+    shaped_noise -= np.min(shaped_noise)
+    shaped_noise /= np.max(shaped_noise)
+    shaped_noise[img_mask, :] = skimage.exposure.match_histograms(
+        shaped_noise[img_mask, :], _np_src_image[ref_mask, :], channel_axis=1
+    )
+    shaped_noise = _np_src_image[:] * (1.0 - np_mask_rgb) + shaped_noise * np_mask_rgb
+
+    return np.clip(shaped_noise, 0.0, 1.0)
+
+
+def benchmark_matched_noise(
+    sizes=((512, 512), (1024, 1024)),
+    repeats=3,
+    noise_q=1.0,
+    color_variation=0.05,
+    device=None,
+):
+    """Compares get_matched_noise with the float64 complex-FFT reference on a synthetic
+    outpainting canvas (right third masked with a soft edge), using the same random noise for
+    both, and reports the runtime and the statistics of the generated area."""
+    from sd_utils import get_matched_noise
+
+    def timed(func, *args, **kwargs):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            np.random.seed(0)
+            result = func(*args, **kwargs)
+        return result, (time.perf_counter() - start) / repeats * 1000
+
+    results = []
+    for width, height in sizes:
+        x = np.linspace(0.0, 1.0, width)[:, None, None]
+        y = np.linspace(0.0, 1.0, height)[None, :, None]
+        image = 0.5 + 0.25 * np.sin(
+            2 * np.pi * (3 * x + 5 * y + np.array([0.0, 0.3, 0.6]))
+        )
+        image = np.clip(
+            image + np.random.default_rng(0).normal(0, 0.05, image.shape), 0, 1
+        )
+        mask = np.clip((y - 0.6) * 10.0, 0.0, 1.0) * np.ones((width, 1, 3))
+
+        reference, reference_ms = timed(
+            get_matched_noise_reference, image, mask, noise_q, color_variation
+        )
+        matched, matched_ms = timed(
+            get_matched_noise, image, mask, noise_q, color_variation, device=device
+        )
+        area = mask[:, :, 0] > 1e-6
+        results.append(
+            {
+                "size": (width, height),
+                "reference_ms": round(reference_ms, 1),
+                "matched_ms": round(matched_ms, 1),
+                "reference_mean": round(float(reference[area].mean()), 4),
+                "matched_mean": round(float(matched[area].mean()), 4),
+                "reference_std": round(float(reference[area].std()), 4),
+                "matched_std": round(float(matched[area].std()), 4),
+                "mean_abs_diff": float(np.abs(reference - matched).mean()),
+                "max_abs_diff": float(np.abs(reference - matched).max()),
+            }
+        )
+        print(results[-1])
+
+    return results
+
+
+def benchmark_metadata_write(
+    sizes=(512, 2048), formats=("png", "jpeg", "webp"), repeats=5
+):
+    """Compares writing the metadata while encoding the image with the previous approach of
+    saving the image and then inserting the EXIF block with piexif, and checks that the metadata
+    can be read back with ImageMetadata.get_from_image."""
+    import tempfile
+
+    import piexif
+    import piexif.helper
+    from PIL import Image
+    from PIL.PngImagePlugin import PngInfo
+
+    from frontend.image_metadata import ImageMetadata, metadata_to_exif
+    from sd_utils import save_quality
+
+    metadata = {"SD:prompt": "a benchmark prompt", "SD:seed": 42, "SD:steps": 30}
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            image = Image.fromarray(
+                np.random.randint(0, 255, (size, size, 3), dtype=np.uint8)
+            )
+            for image_format in formats:
+                path = os.path.join(tmp_dir, f"benchmark.{image_format}")
+
+                def save_two_pass():
+                    if image_format == "png":
+                        mdata = PngInfo()
+                        for key in metadata:
+                            mdata.add_text(key, str(metadata[key]))
+                        image.save(path, pnginfo=mdata)
+                        return
+                    image.save(path, image_format, quality=save_quality)
+                    exif_dict = piexif.load(path)
+                    exif_dict["Exif"][
+                        piexif.ExifIFD.UserComment
+                    ] = piexif.helper.UserComment.dump(
+                        json.dumps(metadata), encoding="unicode"
+                    )
+                    piexif.insert(piexif.dump(exif_dict), path)
+
+                def save_single_pass():
+                    if image_format == "png":
+                        mdata = PngInfo()
+                        for key in metadata:
+                            mdata.add_text(key, str(metadata[key]))
+                        image.save(path, pnginfo=mdata)
+                        return
+                    image.save(
+                        path,
+                        image_format,
+                        quality=save_quality,
+                        exif=metadata_to_exif(metadata),
+                    )
+
+                timings = {}
+                for name, func in (
+                    ("two_pass", save_two_pass),
+                    ("single_pass", save_single_pass),
+                ):
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        func()
+                    timings[name] = (time.perf_counter() - start) / repeats * 1000
+
+                with Image.open(path) as saved:
+                    read_back = ImageMetadata.get_from_image(saved)
+
+                results.append(
+                    {
+                        "format": image_format,
+                        "size": size,
+                        "two_pass_ms": round(timings["two_pass"], 2),
+                        "single_pass_ms": round(timings["single_pass"], 2),
+                        "round_trip": read_back is not None
+                        and read_back.prompt == metadata["SD:prompt"]
+                        and str(read_back.seed) == str(metadata["SD:seed"]),
+                    }
+                )
+                print(results[-1])
+
+    return results
+
+
+benchmarks = {
+    "split_model": benchmark_split_model,
+    "transform_image_3d": benchmark_transform_image_3d,
+    "create_random_tensors": benchmark_create_random_tensors,
+    "matched_noise": benchmark_matched_noise,
+    "metadata_write": benchmark_metadata_write,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "names",
+        nargs="*",
+        metavar="name",
+        help=f"benchmarks to run, all of them by default: {', '.join(benchmarks)}",
+    )
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown:
+        parser.error(f"unknown benchmark {', '.join(unknown)}")
+    for name in args.names or benchmarks:
+        print(name)
+        benchmarks[name]()
@@ -0,0 +1,467 @@
+# This file is part of sygil-webui (https://github.com/Sygil-Dev/sygil-webui/).
+
+# Copyright 2022 Sygil-Dev team.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+the horde REST client and the job pipeline of the bridge: jobs are popped ahead into a queue,
+grouped into batches of compatible jobs and uploaded on their own threads. nothing here needs
+streamlit or a model, run_bridge in sd_utils.bridge drives it with txt2img.
+"""
+import base64
+import bisect
+import collections
+import queue
+import random
+import threading
+import time
+from io import BytesIO
+
+import requests
+import requests.adapters
+
+from logger import logger
+
+
+class LatencyHistogram:
+    """Counts request latencies into fixed millisecond buckets."""
+
+    buckets = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.total += ms
+        self.count += 1
+
+    def summary(self):
+        labels = [f"<={bucket}ms" for bucket in self.buckets] + [
+            f">{self.buckets[-1]}ms"
+        ]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 1) if self.count else 0.0,
+            "buckets": {
+                label: count for label, count in zip(labels, self.counts) if count
+            },
+        }
+
+
+class CircuitBreaker:
+    """Stops calling a server that keeps failing.
+
+    After `threshold` consecutive failures the breaker opens and callers wait out
+    `reset_timeout` seconds, then a single trial request is let through (half-open) while
+    the other callers keep waiting: success closes the breaker again, failure re-opens it.
+    Whoever got past wait() has to report back with record_success or record_failure."""
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # a trial request of the half-open breaker is running.
+        self.trial = False
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def wait(self):
+        """Blocks while the breaker is open, or half-open with another caller's trial running."""
+        with self.changed:
+            while self.opened_at is not None:
+                if self.trial:
+                    self.changed.wait()
+                    continue
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.changed.wait(remaining)
+                    continue
+                # half-open, this caller makes the trial request.
+                self.trial = True
+                return
+
+    def record_success(self):
+        with self.changed:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+            self.changed.notify_all()
+
+    def record_failure(self):
+        with self.changed:
+            self.failures += 1
+            if self.trial:
+                self.trial = False
+                self.opened_at = time.monotonic()
+                self.changed.notify_all()
+                logger.warning(
+                    f"Trial request failed, pausing requests for another {self.reset_timeout} seconds."
+                )
+            elif self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                logger.warning(
+                    f"{self.failures} failed requests in a row, pausing requests for {self.reset_timeout} seconds."
+                )
+
+
+class HordeClient:
+    """Client for the horde REST API used by the bridge.
+
+    Requests go through a keep-alive `requests.Session` connection pool, failures are
+    retried with jittered exponential backoff behind a circuit breaker and the latency of
+    every call is recorded per endpoint. The bridge only calls `pop` and `submit`, so any
+    object with the same two methods can be passed to `run_bridge` instead, and pointing
+    `horde_url` at a local fake server works too."""
+
+    def __init__(
+        self,
+        horde_url,
+        api_key,
+        pool_size=4,
+        timeout=60,
+        backoff_base=1,
+        backoff_max=60,
+        breaker_threshold=5,
+        breaker_reset=30,
+        stats_interval=300,
+    ):
+        self.horde_url = horde_url
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats_interval = stats_interval
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"apikey": api_key})
+
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.histograms = collections.defaultdict(LatencyHistogram)
+        self.attempts = collections.Counter()
+        self.lock = threading.Lock()
+        self.last_stats = time.monotonic()
+
+    def backoff(self, endpoint):
+        """Sleeps for a randomised, exponentially growing delay and returns it."""
+        with self.lock:
+            self.attempts[endpoint] += 1
+            attempt = self.attempts[endpoint]
+        delay = random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2**attempt)
+        )
+        time.sleep(delay)
+        return delay
+
+    def reset_backoff(self, endpoint):
+        with self.lock:
+            self.attempts[endpoint] = 0
+
+    def post(self, endpoint, payload):
+        """POSTs to the endpoint and returns (response, decoded json).
+
+        Returns None, after backing off, when the server is unreachable, answers with a
+        5xx/429 or sends something that isn't json."""
+        self.breaker.wait()
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.horde_url + endpoint, json=payload, timeout=self.timeout
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.breaker.record_failure()
+            delay = self.backoff(endpoint)
+            logger.warning(
+                f"Server {self.horde_url} unavailable during {endpoint}. Waited {delay:.1f} seconds..."
+            )
+            return None
+        except BaseException:
+            # a half-open breaker waits for this request to report back.
+            self.breaker.record_failure()
+            raise
+        finally:
+            self.record_latency(endpoint, time.perf_counter() - start)
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+
+        if data is None or response.status_code >= 500:
+            self.breaker.record_failure()
+            delay = self.backoff(endpoint)
+            logger.warning(
+                f"Something has gone wrong with {self.horde_url} during {endpoint} (status code {response.status_code}). Please inform its administrator! Waited {delay:.1f} seconds..."
+            )
+            return None
+
+        self.breaker.record_success()
+        if response.status_code == 429:
+            delay = self.backoff(endpoint)
+            logger.warning(
+                f"Server {self.horde_url} is rate limiting {endpoint}. Waited {delay:.1f} seconds..."
+            )
+            return None
+
+        return response, data
+
+    def record_latency(self, endpoint, seconds):
+        with self.lock:
+            self.histograms[endpoint].record(seconds)
+            if time.monotonic() - self.last_stats < self.stats_interval:
+                return
+            self.last_stats = time.monotonic()
+            stats = {
+                name: histogram.summary() for name, histogram in self.histograms.items()
+            }
+        logger.debug(f"Horde request latencies: {stats}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                name: histogram.summary() for name, histogram in self.histograms.items()
+            }
+
+    def pop(self, gen_dict):
+        """Ask the horde for a job. Returns the decoded response, or None after backing off from an error."""
+        endpoint = "/api/v2/generate/pop"
+        result = self.post(endpoint, gen_dict)
+        if result is None:
+            return None
+        pop_req, pop = result
+        if not pop_req.ok:
+            logger.warning(
+                f"During gen pop, server {self.horde_url} responded with status code {pop_req.status_code}: {pop.get('message')}."
+            )
+            if "errors" in pop:
+                logger.debug(f"Detailed Request Errors: {pop['errors']}")
+            self.backoff(endpoint)
+            return None
+        self.reset_backoff(endpoint)
+        return pop
+
+    def submit(self, submit_dict):
+        """Upload a finished generation. Returns True once the job is done with (submitted or stale)
+        and False if the caller should retry."""
+        endpoint = "/api/v2/generate/submit"
+        result = self.post(endpoint, submit_dict)
+        if result is None:
+            return False
+        submit_req, submit = result
+        if submit_req.status_code == 404:
+            logger.info("The generation we were working on got stale. Aborting!")
+        elif not submit_req.ok:
+            logger.error(
+                f"During gen submit, server {self.horde_url} responded with status code {submit_req.status_code}: {submit.get('message')}."
+            )
+            if "errors" in submit:
+                logger.debug(f"Detailed Request Errors: {submit['errors']}")
+            self.backoff(endpoint)
+            return False
+        else:
+            logger.info(
+                f'Submitted generation with id {submit_dict["id"]} and contributed for {submit["reward"]}'
+            )
+        self.reset_backoff(endpoint)
+        return True
+
+
+class BridgeJob:
+    """A popped horde job waiting to be sampled."""
+
+    def __init__(self, id, payload, seed, model="stable_diffusion"):
+        self.id = id
+        self.payload = payload
+        self.seed = seed
+        self.model = model
+
+    @property
+    def key(self):
+        """Jobs with the same key can be sampled together in one batch."""
+        return (
+            self.model,
+            int(self.payload["width"]),
+            int(self.payload["height"]),
+            str(self.payload["sampler_name"]),
+            int(self.payload["ddim_steps"]),
+            float(self.payload["cfg_scale"]),
+        )
+
+
+def prepare_payload(payload, horde_nsfw, horde_censor_nsfw, horde_censorlist):
+    payload["toggles"] = payload.get("toggles", [1, 4])
+    # In bridge-mode, matrix is prepared on the horde and split in multiple nodes
+    if 0 in payload["toggles"]:
+        payload["toggles"].remove(0)
+    if 8 not in payload["toggles"]:
+        if horde_censor_nsfw and not horde_nsfw:
+            payload["toggles"].append(8)
+        elif any(word in payload["prompt"] for word in horde_censorlist):
+            payload["toggles"].append(8)
+    return payload
+
+
+def pop_job(
+    client,
+    gen_dict,
+    stop,
+    interval,
+    horde_nsfw,
+    horde_censor_nsfw,
+    horde_censorlist,
+    seed_to_int,
+):
+    """Pops one job from the horde, returns None after waiting when there is nothing to do."""
+    pop = client.pop(gen_dict)
+    if pop is None:
+        return None
+    if not pop.get("id"):
+        skipped_info = pop.get("skipped")
+        if skipped_info and len(skipped_info):
+            skipped_info = f" Skipped Info: {skipped_info}."
+        else:
+            skipped_info = ""
+        logger.info(
+            f"Server {client.horde_url} has no valid generations to do for us.{skipped_info}"
+        )
+        stop.wait(interval)
+        return None
+    payload = pop.get("payload") or {}
+    if "toggles" in payload and payload["toggles"] is None:
+        logger.error(f"Received Bad payload: {pop}")
+        stop.wait(10)
+        return None
+    logger.info(f"Request with id {pop['id']} picked up. Initiating work...")
+    logger.debug(payload)
+    prepare_payload(payload, horde_nsfw, horde_censor_nsfw, horde_censorlist)
+    return BridgeJob(
+        pop["id"],
+        payload,
+        seed_to_int(payload.get("seed")),
+        pop.get("model", "stable_diffusion"),
+    )
+
+
+def prefetch_jobs(
+    client,
+    gen_dict,
+    jobs,
+    slots,
+    stop,
+    interval,
+    horde_nsfw,
+    horde_censor_nsfw,
+    horde_censorlist,
+    seed_to_int,
+):
+    """Keeps popping jobs into `jobs` while the GPU is busy; `slots` bounds how many we hold at once.
+
+    `seed_to_int` turns the seed of a payload into the integer seed the job is sampled with.
+    Errors are logged and the next pop waits `interval` seconds, so one bad reply or payload
+    doesn't stop the bridge from getting jobs.
+    """
+    while not stop.is_set():
+        if not slots.acquire(timeout=interval):
+            continue
+        try:
+            job = pop_job(
+                client,
+                gen_dict,
+                stop,
+                interval,
+                horde_nsfw,
+                horde_censor_nsfw,
+                horde_censorlist,
+                seed_to_int,
+            )
+        except Exception:
+            logger.exception(
+                f"Getting a job from {client.horde_url} failed, trying again in {interval} seconds."
+            )
+            job = None
+            stop.wait(interval)
+        if job is None:
+            slots.release()
+        else:
+            jobs.put(job)
+
+
+def next_batch(jobs, pending, max_batch, prefetcher, poll_interval=1):
+    """Returns up to `max_batch` compatible jobs, oldest first.
+
+    Blocks until at least one job is available, then takes whatever else has already
+    been prefetched; jobs that don't match the oldest one stay in `pending` for the next batch.
+    Raises RuntimeError if the `prefetcher` thread is gone while waiting, no job would ever come.
+    """
+    while not pending:
+        try:
+            pending.append(jobs.get(timeout=poll_interval))
+        except queue.Empty:
+            if not prefetcher.is_alive():
+                raise RuntimeError(
+                    "The horde prefetch thread stopped, no jobs will come in."
+                )
+    while True:
+        try:
+            pending.append(jobs.get_nowait())
+        except queue.Empty:
+            break
+
+    key = pending[0].key
+    batch = [job for job in pending if job.key == key][:max_batch]
+    for job in batch:
+        pending.remove(job)
+    return batch
+
+
+def log_upload_errors(job):
+    """A done callback for the future of an upload_generation call, an upload that raised is
+    logged instead of being lost with its future."""
+
+    def done(future):
+        error = future.exception()
+        if error is not None:
+            logger.opt(exception=error).error(
+                f"Uploading generation id {job.id} failed, it was not delivered."
+            )
+
+    return done
+
+
+def upload_generation(client, job, image, api_key, horde_max_pixels):
+    buffer = BytesIO()
+    # We send as WebP to avoid using all the horde bandwidth
+    image.save(buffer, format="WebP", quality=90)
+    submit_dict = {
+        "id": job.id,
+        "generation": base64.b64encode(buffer.getvalue()).decode("utf8"),
+        "api_key": api_key,
+        "seed": job.seed,
+        "max_pixels": horde_max_pixels,
+    }
+    for loop_retry in range(1, 11):
+        if client.submit(submit_dict):
+            return
+        logger.info(f"Retrying ({loop_retry}/10) for generation id {job.id}...")
+    logger.info(
+        f"Exceeded retry count 10 for generation id {job.id}. Aborting generation!"
+    )
@@ -45,11 +45,11 @@ from PIL import Image, ImageOps
 import torch
 import k_diffusion as K
 import numpy as np
-import time
 import torch
 import skimage
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
+from optimizedSD.offload import get_offloader
 
 # streamlit components
 from custom_components import sygil_suggestions
@@ -234,7 +234,7 @@ def img2img(
             mask = torch.from_numpy(mask).to(server_state["device"])
 
         if st.session_state["defaults"].general.optimized:
-            server_state["modelFS"].to(server_state["device"])
+            get_offloader(server_state["device"]).acquire(server_state["modelFS"])
 
         init_image = 2.0 * image - 1.0
         init_image = init_image.to(server_state["device"])
@@ -251,10 +251,7 @@ def img2img(
         )  # move to latent space
 
         if st.session_state["defaults"].general.optimized:
-            mem = torch.cuda.memory_allocated() / 1e6
-            server_state["modelFS"].to("cpu")
-            while torch.cuda.memory_allocated() / 1e6 >= mem:
-                time.sleep(1)
+            get_offloader(server_state["device"]).offload(server_state["modelFS"])
 
         return (
             init_latent,
@@ -34,7 +34,14 @@ And if you're looking for more Ai art tools check out my [Ai generative art tool
 # ---------------------------------------------------------------------------------------------------------------------------------------------------
 
 # base webui import and utils.
-from sd_utils import st, logger, server_state, server_state_lock, random
+from sd_utils import (
+    st,
+    logger,
+    server_state,
+    server_state_lock,
+    get_model_registry,
+    random,
+)
 
 # streamlit imports
 
@@ -44,37 +51,51 @@ from sd_utils import st, logger, server_state, server_state_lock, random
 
 import clip
 import open_clip
+import csv
 import gc
+import glob
+import hashlib
+import json
 import os
+import time
+import numpy as np
 import pandas as pd
 
 # import requests
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 from ldm.models.blip import blip_decoder
 
-# import hashlib
-
 # end of imports
 # ---------------------------------------------------------------------------------------------------------------
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 blip_image_eval_size = 512
 
+# folder where the precomputed text embeddings for the label lists are stored, one subfolder per CLIP model.
+text_index_dir = os.path.join("models", "clip", "text_index")
+
 st.session_state["log"] = []
 
 
-def load_blip_model():
-    logger.info("Loading BLIP Model")
+def log_message(message):
+    """Logs the message and shows it on the UI log if the page is being rendered."""
+    logger.info(message)
     if "log" not in st.session_state:
         st.session_state["log"] = []
 
-    st.session_state["log"].append("Loading BLIP Model")
-    st.session_state["log_message"].code(
-        "\n".join(st.session_state["log"]), language=""
-    )
+    st.session_state["log"].append(message)
+    if "log_message" in st.session_state:
+        st.session_state["log_message"].code(
+            "\n".join(st.session_state["log"]), language=""
+        )
+
+
+def load_blip_model():
+    log_message("Loading BLIP Model")
 
     if "blip_model" not in server_state:
         with server_state_lock["blip_model"]:
@@ -89,41 +110,38 @@ def load_blip_model():
 
             server_state["blip_model"] = server_state["blip_model"].to(device).half()
 
-            logger.info("BLIP Model Loaded")
-            st.session_state["log"].append("BLIP Model Loaded")
-            st.session_state["log_message"].code(
-                "\n".join(st.session_state["log"]), language=""
-            )
+            log_message("BLIP Model Loaded")
     else:
-        logger.info("BLIP Model already loaded")
-        st.session_state["log"].append("BLIP Model already loaded")
-        st.session_state["log_message"].code(
-            "\n".join(st.session_state["log"]), language=""
-        )
+        log_message("BLIP Model already loaded")
+
+
+blip_preprocess = transforms.Compose(
+    [  # type: ignore
+        transforms.Resize((blip_image_eval_size, blip_image_eval_size), interpolation=InterpolationMode.BICUBIC),  # type: ignore
+        transforms.ToTensor(),  # type: ignore
+        transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),  # type: ignore
+    ]
+)
 
 
 def generate_caption(pil_image):
-    load_blip_model()
+    return generate_captions(blip_preprocess(pil_image).unsqueeze(0))[0]
 
-    gpu_image = (
-        transforms.Compose(
-            [  # type: ignore
-                transforms.Resize((blip_image_eval_size, blip_image_eval_size), interpolation=InterpolationMode.BICUBIC),  # type: ignore
-                transforms.ToTensor(),  # type: ignore
-                transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),  # type: ignore
-            ]
-        )(pil_image)
-        .unsqueeze(0)
-        .to(device)
-        .half()
-    )
+
+def generate_captions(images):
+    """Generates a caption for each image on a batch already preprocessed with blip_preprocess."""
+    load_blip_model()
 
     with torch.no_grad():
-        caption = server_state["blip_model"].generate(
-            gpu_image, sample=False, num_beams=3, max_length=20, min_length=5
+        captions = server_state["blip_model"].generate(
+            images.to(device).half(),
+            sample=False,
+            num_beams=3,
+            max_length=20,
+            min_length=5,
         )
 
-    return caption[0]
+    return captions
 
 
 def load_list(filename):
@@ -132,25 +150,150 @@ def load_list(filename):
         return items
 
 
-def rank(model, image_features, text_array, top_count=1):
+def get_text_index_path(model_name, list_name, digest):
+    model_dir = model_name.replace("/", "_").replace("@", "_")
+    return os.path.join(text_index_dir, model_dir, f"{list_name}-{digest}")
+
+
+def build_text_index(model, model_name, text_array, path, batch_size):
+    """Encodes every label in text_array with the CLIP model and writes the normalized
+    embeddings to disk as a float16 matrix that can be memory-mapped, plus a label table.
+    """
+    logger.info(f"Building {model_name} text index for {os.path.basename(path)}...")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    index = None
+    for i in range(0, len(text_array), batch_size):
+        text_tokens = clip.tokenize(text_array[i : i + batch_size]).cuda()
+        with torch.no_grad():
+            text_features = model.encode_text(text_tokens).float()
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+
+        if index is None:
+            index = np.lib.format.open_memmap(
+                f"{path}.tmp.npy",
+                mode="w+",
+                dtype=np.float16,
+                shape=(len(text_array), text_features.shape[-1]),
+            )
+        index[i : i + len(text_tokens)] = text_features.cpu().numpy()
+
+    index.flush()
+    del index
+    os.replace(f"{path}.tmp.npy", f"{path}.npy")
+
+    with open(f"{path}.json", "w", encoding="utf-8") as f:
+        json.dump({"model": model_name, "labels": text_array}, f)
+
+
+def text_index_matches(path, model_name, text_array):
+    """True if the index at path was built by model_name for exactly the labels in text_array."""
+    if not os.path.exists(f"{path}.npy") or not os.path.exists(f"{path}.json"):
+        return False
+
+    try:
+        with open(f"{path}.json", "r", encoding="utf-8") as f:
+            table = json.load(f)
+        index = np.load(f"{path}.npy", mmap_mode="r")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Text index {path} can't be read, rebuilding it: {e}")
+        return False
+
+    if (
+        table.get("model") != model_name
+        or table.get("labels") != text_array
+        or index.shape[0] != len(text_array)
+    ):
+        logger.warning(f"Text index {path} is out of date, rebuilding it.")
+        return False
+    return True
+
+
+def prune_text_indexes(path, list_name):
+    """Deletes the indexes of older versions of a list, they are never used again."""
+    for stale in glob.glob(os.path.join(os.path.dirname(path), f"{list_name}-*")):
+        if stale.startswith(f"{path}."):
+            continue
+        try:
+            os.remove(stale)
+        except OSError as e:
+            # still mapped by an older cached index on windows, the next run removes it.
+            logger.debug(f"Couldn't remove stale text index {stale}: {e}")
+
+
+def load_text_index(model, model_name, list_name, text_array):
+    """Returns the normalized text embeddings for text_array on the GPU.
+
+    The embeddings are computed only once per CLIP model and list content, they are stored under
+    models/clip/text_index and reused on the next runs, the index is rebuilt if the list changes
+    and the indexes of the previous versions of the list are deleted.
+    """
+    digest = hashlib.sha256("\n".join(text_array).encode("utf-8")).hexdigest()[:16]
+
+    with server_state_lock["clip_text_index"]:
+        if "clip_text_index" not in server_state:
+            server_state["clip_text_index"] = {}
+
+        key = (model_name, list_name)
+        if key in server_state["clip_text_index"]:
+            cached_digest, text_features = server_state["clip_text_index"][key]
+            if cached_digest == digest:
+                return text_features
+
+        path = get_text_index_path(model_name, list_name, digest)
+        if not text_index_matches(path, model_name, text_array):
+            build_text_index(
+                model,
+                model_name,
+                text_array,
+                path,
+                st.session_state["defaults"].img2txt.batch_size,
+            )
+        prune_text_indexes(path, list_name)
+
+        # copy-on-write mapping, torch reads the pages straight from the file without a copy in ram.
+        text_features = torch.from_numpy(np.load(f"{path}.npy", mmap_mode="c")).to(
+            device
+        )
+
+        server_state["clip_text_index"][key] = (digest, text_features)
+
+    return text_features
+
+
+def unload_text_index(model_name):
+    if "clip_text_index" not in server_state:
+        return
+
+    with server_state_lock["clip_text_index"]:
+        for key in [
+            key for key in server_state["clip_text_index"] if key[0] == model_name
+        ]:
+            del server_state["clip_text_index"][key]
+
+
+def rank(image_features, text_features, text_array, top_count=1, per_image=False):
+    """Returns the top labels of text_array with their confidence for the images on the batch
+    averaged, or a list of them for each image with per_image."""
     top_count = min(top_count, len(text_array))
-    text_tokens = clip.tokenize([text for text in text_array]).cuda()
-    with torch.no_grad():
-        text_features = model.encode_text(text_tokens).float()
-    text_features /= text_features.norm(dim=-1, keepdim=True)
 
-    similarity = torch.zeros((1, len(text_array))).to(device)
-    for i in range(image_features.shape[0]):
-        similarity += (
-            100.0 * image_features[i].unsqueeze(0) @ text_features.T
-        ).softmax(dim=-1)
-    similarity /= image_features.shape[0]
+    similarity = (
+        (100.0 * image_features.to(text_features.dtype) @ text_features.T)
+        .float()
+        .softmax(dim=-1)
+    )
+    if not per_image:
+        similarity = similarity.mean(dim=0, keepdim=True)
 
     top_probs, top_labels = similarity.cpu().topk(top_count, dim=-1)
-    return [
-        (text_array[top_labels[0][i].numpy()], (top_probs[0][i].numpy() * 100))
-        for i in range(top_count)
+    ranks = [
+        [
+            (text_array[top_labels[n][i].numpy()], (top_probs[n][i].numpy() * 100))
+            for i in range(top_count)
+        ]
+        for n in range(similarity.shape[0])
     ]
+    return ranks if per_image else ranks[0]
 
 
 def clear_cuda():
@@ -158,21 +301,153 @@ def clear_cuda():
     gc.collect()
 
 
-def batch_rank(
-    model,
-    image_features,
-    text_array,
-    batch_size=st.session_state["defaults"].img2txt.batch_size,
-):
-    batch_size = min(batch_size, len(text_array))
-    batch_count = int(len(text_array) / batch_size)
-    batches = [
-        text_array[i * batch_size : (i + 1) * batch_size] for i in range(batch_count)
+def release_clip_model(model_name):
+    server_state["clip_models"].pop(model_name, None)
+    server_state["preprocesses"].pop(model_name, None)
+    unload_text_index(model_name)
+    clear_cuda()
+
+
+def load_clip_model(model_name):
+    if "clip_models" not in server_state:
+        server_state["clip_models"] = {}
+    if "preprocesses" not in server_state:
+        server_state["preprocesses"] = {}
+
+    if model_name in server_state["clip_models"]:
+        get_model_registry().use(f"clip/{model_name}")
+        return
+
+    start = time.perf_counter()
+    if model_name == "ViT-H-14":
+        (
+            server_state["clip_models"][model_name],
+            _,
+            server_state["preprocesses"][model_name],
+        ) = open_clip.create_model_and_transforms(
+            model_name,
+            pretrained="laion2b_s32b_b79k",
+            cache_dir="models/clip",
+        )
+    elif model_name == "ViT-g-14":
+        (
+            server_state["clip_models"][model_name],
+            _,
+            server_state["preprocesses"][model_name],
+        ) = open_clip.create_model_and_transforms(
+            model_name,
+            pretrained="laion2b_s12b_b42k",
+            cache_dir="models/clip",
+        )
+    else:
+        (
+            server_state["clip_models"][model_name],
+            server_state["preprocesses"][model_name],
+        ) = clip.load(model_name, device=device, download_root="models/clip")
+    server_state["clip_models"][model_name] = (
+        server_state["clip_models"][model_name].cuda().eval()
+    )
+    registry = get_model_registry()
+    registry.register(
+        f"clip/{model_name}",
+        lambda: server_state["clip_models"].get(model_name),
+        lambda: release_clip_model(model_name),
+        device="cuda",
+        load_seconds=time.perf_counter() - start,
+    )
+    registry.enforce_budget(protect=[f"clip/{model_name}"])
+
+
+def load_label_lists():
+    data_path = "data/"
+    if "artists" not in server_state:
+        server_state["artists"] = load_list(
+            os.path.join(data_path, "img2txt", "artists.txt")
+        )
+    if "flavors" not in server_state:
+        server_state["flavors"] = random.choices(
+            load_list(os.path.join(data_path, "img2txt", "flavors.txt")), k=2000
+        )
+    if "mediums" not in server_state:
+        server_state["mediums"] = load_list(
+            os.path.join(data_path, "img2txt", "mediums.txt")
+        )
+    if "movements" not in server_state:
+        server_state["movements"] = load_list(
+            os.path.join(data_path, "img2txt", "movements.txt")
+        )
+    if "sites" not in server_state:
+        server_state["sites"] = load_list(
+            os.path.join(data_path, "img2txt", "sites.txt")
+        )
+    # server_state["domains"] = load_list(os.path.join(data_path, 'img2txt', 'domains.txt'))
+    # server_state["subreddits"] = load_list(os.path.join(data_path, 'img2txt', 'subreddits.txt'))
+    if "techniques" not in server_state:
+        server_state["techniques"] = load_list(
+            os.path.join(data_path, "img2txt", "techniques.txt")
+        )
+    if "tags" not in server_state:
+        server_state["tags"] = load_list(os.path.join(data_path, "img2txt", "tags.txt"))
+    # server_state["genres"] = load_list(os.path.join(data_path, 'img2txt', 'genres.txt'))
+    # server_state["styles"] = load_list(os.path.join(data_path, 'img2txt', 'styles.txt'))
+    # server_state["subjects"] = load_list(os.path.join(data_path, 'img2txt', 'subjects.txt'))
+    if "trending_list" not in server_state:
+        server_state["trending_list"] = [site for site in server_state["sites"]]
+        server_state["trending_list"].extend(
+            ["trending on " + site for site in server_state["sites"]]
+        )
+        server_state["trending_list"].extend(
+            ["featured on " + site for site in server_state["sites"]]
+        )
+        server_state["trending_list"].extend(
+            [site + " contest winner" for site in server_state["sites"]]
+        )
+
+
+def get_label_lists():
+    return [
+        ("mediums", server_state["mediums"]),
+        ("artists", ["by " + artist for artist in server_state["artists"]]),
+        ("trending", server_state["trending_list"]),
+        ("movements", server_state["movements"]),
+        ("flavors", server_state["flavors"]),
+        # ("domains", server_state["domains"]),
+        # ("subreddits", server_state["subreddits"]),
+        ("techniques", server_state["techniques"]),
+        ("tags", server_state["tags"]),
     ]
-    ranks = []
-    for batch in batches:
-        ranks += rank(model, image_features, batch)
-    return ranks
+
+
+def update_bests(bests, ranks):
+    """Keeps on bests the ranks of the model with the highest confidence for each label list."""
+    for i in range(len(ranks)):
+        confidence_sum = 0
+        for ci in range(len(ranks[i])):
+            confidence_sum += ranks[i][ci][1]
+        if confidence_sum > sum(bests[i][t][1] for t in range(len(bests[i]))):
+            bests[i] = ranks[i]
+
+    for best in bests:
+        best.sort(key=lambda x: x[1], reverse=True)
+        # prune to 3
+        best = best[:3]
+
+
+def build_prompt(caption, bests):
+    medium = bests[0][0][0]
+    artist = bests[1][0][0]
+    trending = bests[2][0][0]
+    movement = bests[3][0][0]
+    flavors = bests[4][0][0]
+    # domains = bests[5][0][0]
+    # subreddits = bests[6][0][0]
+    techniques = bests[5][0][0]
+    tags = bests[6][0][0]
+
+    if caption.startswith(medium):
+        return f"{caption} {artist}, {trending}, {movement}, {techniques}, {flavors}, {tags}"
+    else:
+        return f"{caption}, {medium} {artist}, {trending}, {movement}, {techniques}, {flavors}, {tags}"
 
 
 def interrogate(image, models):
@@ -209,7 +484,10 @@ def interrogate(image, models):
     )
 
     for model_name in models:
-        with torch.no_grad(), torch.autocast("cuda", dtype=torch.float16):
+        # loading the next clip model can't evict this one while it's ranking.
+        with get_model_registry().hold(
+            f"clip/{model_name}"
+        ), torch.no_grad(), torch.autocast("cuda", dtype=torch.float16):
             logger.info(f"Interrogating with {model_name}...")
             st.session_state["log"].append(f"Interrogating with {model_name}...")
             st.session_state["log_message"].code(
@@ -218,44 +496,10 @@ def interrogate(image, models):
 
             if model_name not in server_state["clip_models"]:
                 if not st.session_state["defaults"].img2txt.keep_all_models_loaded:
-                    model_to_delete = []
-                    for model in server_state["clip_models"]:
+                    for model in list(server_state["clip_models"]):
                         if model != model_name:
-                            model_to_delete.append(model)
-                    for model in model_to_delete:
-                        del server_state["clip_models"][model]
-                        del server_state["preprocesses"][model]
-                        clear_cuda()
-                if model_name == "ViT-H-14":
-                    (
-                        server_state["clip_models"][model_name],
-                        _,
-                        server_state["preprocesses"][model_name],
-                    ) = open_clip.create_model_and_transforms(
-                        model_name,
-                        pretrained="laion2b_s32b_b79k",
-                        cache_dir="models/clip",
-                    )
-                elif model_name == "ViT-g-14":
-                    (
-                        server_state["clip_models"][model_name],
-                        _,
-                        server_state["preprocesses"][model_name],
-                    ) = open_clip.create_model_and_transforms(
-                        model_name,
-                        pretrained="laion2b_s12b_b42k",
-                        cache_dir="models/clip",
-                    )
-                else:
-                    (
-                        server_state["clip_models"][model_name],
-                        server_state["preprocesses"][model_name],
-                    ) = clip.load(
-                        model_name, device=device, download_root="models/clip"
-                    )
-                server_state["clip_models"][model_name] = (
-                    server_state["clip_models"][model_name].cuda().eval()
-                )
+                            get_model_registry().drop(f"clip/{model}")
+            load_clip_model(model_name)
 
             images = server_state["preprocesses"][model_name](image).unsqueeze(0).cuda()
 
@@ -269,57 +513,21 @@ def interrogate(image, models):
                 clear_cuda()
 
             ranks = []
-            ranks.append(
-                batch_rank(
-                    server_state["clip_models"][model_name],
-                    image_features,
-                    server_state["mediums"],
-                )
-            )
-            ranks.append(
-                batch_rank(
-                    server_state["clip_models"][model_name],
-                    image_features,
-                    ["by " + artist for artist in server_state["artists"]],
-                )
-            )
-            ranks.append(
-                batch_rank(
+            for list_name, text_array in get_label_lists():
+                text_features = load_text_index(
                     server_state["clip_models"][model_name],
-                    image_features,
-                    server_state["trending_list"],
+                    model_name,
+                    list_name,
+                    text_array,
                 )
-            )
-            ranks.append(
-                batch_rank(
-                    server_state["clip_models"][model_name],
-                    image_features,
-                    server_state["movements"],
-                )
-            )
-            ranks.append(
-                batch_rank(
-                    server_state["clip_models"][model_name],
-                    image_features,
-                    server_state["flavors"],
-                )
-            )
-            # ranks.append(batch_rank(server_state["clip_models"][model_name], image_features, server_state["domains"]))
-            # ranks.append(batch_rank(server_state["clip_models"][model_name], image_features, server_state["subreddits"]))
-            ranks.append(
-                batch_rank(
-                    server_state["clip_models"][model_name],
-                    image_features,
-                    server_state["techniques"],
-                )
-            )
-            ranks.append(
-                batch_rank(
-                    server_state["clip_models"][model_name],
-                    image_features,
-                    server_state["tags"],
+                ranks.append(
+                    rank(
+                        image_features,
+                        text_features,
+                        text_array,
+                        top_count=st.session_state["defaults"].img2txt.top_count,
+                    )
                 )
-            )
 
             # ranks.append(batch_rank(server_state["clip_models"][model_name], image_features, server_state["genres"]))
             # ranks.append(batch_rank(server_state["clip_models"][model_name], image_features, server_state["styles"]))
@@ -332,17 +540,7 @@ def interrogate(image, models):
             # print (bests)
             # print (ranks)
 
-            for i in range(len(ranks)):
-                confidence_sum = 0
-                for ci in range(len(ranks[i])):
-                    confidence_sum += ranks[i][ci][1]
-                if confidence_sum > sum(bests[i][t][1] for t in range(len(bests[i]))):
-                    bests[i] = ranks[i]
-
-            for best in bests:
-                best.sort(key=lambda x: x[1], reverse=True)
-                # prune to 3
-                best = best[:3]
+            update_bests(bests, ranks)
 
             row = [model_name]
 
@@ -356,7 +554,7 @@ def interrogate(image, models):
             table.append(row)
 
             if st.session_state["defaults"].general.optimized:
-                del server_state["clip_models"][model_name]
+                get_model_registry().drop(f"clip/{model_name}")
                 gc.collect()
 
     st.session_state["prediction_table"][
@@ -377,26 +575,10 @@ def interrogate(image, models):
         )
     )
 
-    medium = bests[0][0][0]
-    artist = bests[1][0][0]
-    trending = bests[2][0][0]
-    movement = bests[3][0][0]
-    flavors = bests[4][0][0]
-    # domains = bests[5][0][0]
-    # subreddits = bests[6][0][0]
-    techniques = bests[5][0][0]
-    tags = bests[6][0][0]
-
-    if caption.startswith(medium):
-        st.session_state["text_result"][st.session_state["processed_image_count"]].code(
-            f"\n\n{caption} {artist}, {trending}, {movement}, {techniques}, {flavors}, {tags}",
-            language="",
-        )
-    else:
-        st.session_state["text_result"][st.session_state["processed_image_count"]].code(
-            f"\n\n{caption}, {medium} {artist}, {trending}, {movement}, {techniques}, {flavors}, {tags}",
-            language="",
-        )
+    st.session_state["text_result"][st.session_state["processed_image_count"]].code(
+        f"\n\n{build_prompt(caption, bests)}",
+        language="",
+    )
 
     logger.info("Finished Interrogating.")
     st.session_state["log"].append("Finished Interrogating.")
@@ -442,6 +624,24 @@ def img2txt():
     # thumb.thumbnail([blip_image_eval_size, blip_image_eval_size])
     # display(thumb)
 
+    if st.session_state["batch_input_folder"]:
+        output_path = st.session_state["batch_output_file"] or os.path.join(
+            st.session_state["defaults"].general.outdir_img2txt, "interrogations.jsonl"
+        )
+
+        def update_progress(done, total):
+            log_message(f"Interrogated {done}/{total} images.")
+
+        batch_interrogate(
+            st.session_state["batch_input_folder"],
+            output_path,
+            models,
+            batch_size=st.session_state["defaults"].img2txt.interrogation_batch_size,
+            num_workers=st.session_state["defaults"].img2txt.num_workers,
+            progress_callback=update_progress,
+        )
+        return
+
     st.session_state["processed_image_count"] = 0
 
     for i in range(len(st.session_state["uploaded_image"])):
@@ -450,6 +650,189 @@ def img2txt():
         st.session_state["processed_image_count"] += 1
 
 
+def find_images(input_dir):
+    extensions = (".png", ".jpg", ".jpeg", ".jfif", ".webp")
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(extensions):
+                yield os.path.relpath(os.path.join(root, file), input_dir)
+
+
+def read_processed_images(output_path):
+    """Returns the images already written to output_path so an interrupted batch can resume from there."""
+    processed = set()
+    if not os.path.exists(output_path):
+        return processed
+
+    with open(output_path, "r", encoding="utf-8", newline="") as f:
+        if output_path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                processed.add(row["file"])
+        else:
+            for line in f:
+                try:
+                    processed.add(json.loads(line)["file"])
+                except (ValueError, KeyError):
+                    # a partially written line from a crash, the image will be processed again.
+                    pass
+
+    return processed
+
+
+def preprocess_image(input_dir, file, models):
+    image = Image.open(os.path.join(input_dir, file)).convert("RGB")
+    return (
+        file,
+        blip_preprocess(image),
+        {
+            model_name: server_state["preprocesses"][model_name](image)
+            for model_name in models
+        },
+    )
+
+
+def batch_interrogate(
+    input_dir, output_path, models, batch_size=8, num_workers=4, progress_callback=None
+):
+    """Interrogates every image inside input_dir and writes a line for each of them to output_path.
+
+    Images are read and preprocessed on a pool of workers while the previous batch runs through
+    BLIP and every CLIP model, the models stay loaded for the whole run. The output is a JSON lines
+    file, or a CSV file if output_path ends with .csv, and it is written as each batch finishes,
+    images that are already on it are skipped so an interrupted run can be started again.
+    """
+    # the clip models stay loaded for the whole run, no session can evict them meanwhile.
+    with get_model_registry().hold(*[f"clip/{model_name}" for model_name in models]):
+        return _batch_interrogate(
+            input_dir, output_path, models, batch_size, num_workers, progress_callback
+        )
+
+
+def _batch_interrogate(
+    input_dir, output_path, models, batch_size, num_workers, progress_callback
+):
+    load_label_lists()
+    load_blip_model()
+    for model_name in models:
+        load_clip_model(model_name)
+
+    processed = read_processed_images(output_path)
+    files = [file for file in find_images(input_dir) if file not in processed]
+    log_message(
+        f"Interrogating {len(files)} images from {input_dir}, {len(processed)} already done."
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    is_csv = output_path.endswith(".csv")
+    write_header = is_csv and not os.path.exists(output_path)
+
+    with open(output_path, "a", encoding="utf-8", newline="") as f, ThreadPoolExecutor(
+        max_workers=num_workers
+    ) as executor:
+        if is_csv:
+            writer = csv.DictWriter(f, fieldnames=["file", "caption", "prompt"])
+            if write_header:
+                writer.writeheader()
+
+        batches = [files[i : i + batch_size] for i in range(0, len(files), batch_size)]
+
+        # always keep the next batch being preprocessed while the current one runs on the GPU.
+        pending = None
+        if batches:
+            pending = executor.map(
+                lambda file: preprocess_image(input_dir, file, models), batches[0]
+            )
+
+        for n in range(len(batches)):
+            try:
+                batch = list(pending)
+            except Exception as e:
+                logger.error(f"Error reading images from batch {n + 1}: {e}")
+                batch = []
+                for file in batches[n]:
+                    try:
+                        batch.append(preprocess_image(input_dir, file, models))
+                    except Exception as e:
+                        logger.error(f"Skipping {file}: {e}")
+
+            if n + 1 < len(batches):
+                pending = executor.map(
+                    lambda file: preprocess_image(input_dir, file, models),
+                    batches[n + 1],
+                )
+
+            if not batch:
+                continue
+
+            captions = generate_captions(torch.stack([item[1] for item in batch]))
+            bests = [[[("", 0)]] * 7 for _ in batch]
+            model_ranks = [{} for _ in batch]
+
+            for model_name in models:
+                with torch.no_grad(), torch.autocast("cuda", dtype=torch.float16):
+                    images = torch.stack([item[2][model_name] for item in batch]).cuda()
+                    image_features = (
+                        server_state["clip_models"][model_name]
+                        .encode_image(images)
+                        .float()
+                    )
+                    image_features /= image_features.norm(dim=-1, keepdim=True)
+
+                    ranks = [[] for _ in batch]
+                    for list_name, text_array in get_label_lists():
+                        text_features = load_text_index(
+                            server_state["clip_models"][model_name],
+                            model_name,
+                            list_name,
+                            text_array,
+                        )
+                        for i, image_ranks in enumerate(
+                            rank(
+                                image_features,
+                                text_features,
+                                text_array,
+                                top_count=st.session_state[
+                                    "defaults"
+                                ].img2txt.top_count,
+                                per_image=True,
+                            )
+                        ):
+                            ranks[i].append(image_ranks)
+                            model_ranks[i].setdefault(model_name, {})[list_name] = [
+                                (label, round(float(confidence), 2))
+                                for label, confidence in image_ranks
+                            ]
+
+                for i in range(len(batch)):
+                    update_bests(bests[i], ranks[i])
+
+            for i, (file, _, _) in enumerate(batch):
+                prompt = build_prompt(captions[i], bests[i]) if models else captions[i]
+                if is_csv:
+                    writer.writerow(
+                        {"file": file, "caption": captions[i], "prompt": prompt}
+                    )
+                else:
+                    f.write(
+                        json.dumps(
+                            {
+                                "file": file,
+                                "caption": captions[i],
+                                "prompt": prompt,
+                                "ranks": model_ranks[i],
+                            }
+                        )
+                        + "\n"
+                    )
+            f.flush()
+
+            if progress_callback is not None:
+                progress_callback(min((n + 1) * batch_size, len(files)), len(files))
+
+    log_message(f"Finished interrogating {input_dir}.")
+
+
 #
 
 
@@ -461,49 +844,8 @@ def layout():
         server_state["clip_models"] = {}
     if "preprocesses" not in server_state:
         server_state["preprocesses"] = {}
-    data_path = "data/"
-    if "artists" not in server_state:
-        server_state["artists"] = load_list(
-            os.path.join(data_path, "img2txt", "artists.txt")
-        )
-    if "flavors" not in server_state:
-        server_state["flavors"] = random.choices(
-            load_list(os.path.join(data_path, "img2txt", "flavors.txt")), k=2000
-        )
-    if "mediums" not in server_state:
-        server_state["mediums"] = load_list(
-            os.path.join(data_path, "img2txt", "mediums.txt")
-        )
-    if "movements" not in server_state:
-        server_state["movements"] = load_list(
-            os.path.join(data_path, "img2txt", "movements.txt")
-        )
-    if "sites" not in server_state:
-        server_state["sites"] = load_list(
-            os.path.join(data_path, "img2txt", "sites.txt")
-        )
-    # server_state["domains"] = load_list(os.path.join(data_path, 'img2txt', 'domains.txt'))
-    # server_state["subreddits"] = load_list(os.path.join(data_path, 'img2txt', 'subreddits.txt'))
-    if "techniques" not in server_state:
-        server_state["techniques"] = load_list(
-            os.path.join(data_path, "img2txt", "techniques.txt")
-        )
-    if "tags" not in server_state:
-        server_state["tags"] = load_list(os.path.join(data_path, "img2txt", "tags.txt"))
-    # server_state["genres"] = load_list(os.path.join(data_path, 'img2txt', 'genres.txt'))
-    # server_state["styles"] = load_list(os.path.join(data_path, 'img2txt', 'styles.txt'))
-    # server_state["subjects"] = load_list(os.path.join(data_path, 'img2txt', 'subjects.txt'))
-    if "trending_list" not in server_state:
-        server_state["trending_list"] = [site for site in server_state["sites"]]
-        server_state["trending_list"].extend(
-            ["trending on " + site for site in server_state["sites"]]
-        )
-        server_state["trending_list"].extend(
-            ["featured on " + site for site in server_state["sites"]]
-        )
-        server_state["trending_list"].extend(
-            [site + " contest winner" for site in server_state["sites"]]
-        )
+    load_label_lists()
+
     with st.form("img2txt-inputs"):
         st.session_state["generation_mode"] = "img2txt"
 
@@ -559,6 +901,20 @@ def layout():
                     "RN101", value=False, help="RN101 model."
                 )
 
+            with st.expander("Batch Folder"):
+                st.session_state["batch_input_folder"] = st.text_input(
+                    "Input Folder",
+                    value="",
+                    help="Interrogate every image inside this folder instead of the uploaded images. \
+                    The results are written as they are generated, running it again continues where it stopped.",
+                )
+                st.session_state["batch_output_file"] = st.text_input(
+                    "Output File",
+                    value="",
+                    help="File where the results are written, use a .csv extension for CSV or anything else for JSON lines. \
+                    Default: interrogations.jsonl inside the img2txt output folder.",
+                )
+
             #
             # st.subheader("Logs:")
 
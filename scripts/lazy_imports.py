@@ -0,0 +1,143 @@
+# This file is part of sygil-webui (https://github.com/Sygil-Dev/sygil-webui/).
+
+# Copyright 2022 Sygil-Dev team.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+helpers to keep startup cheap: modules imported on first use and a profiler for the time
+spent importing. only the standard library is used here, so the profiler can be started
+before anything heavy is imported.
+"""
+import builtins
+import collections
+import contextlib
+import importlib
+import importlib.util
+import sys
+import time
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module and imports it the first time one of its attributes is used."""
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+class ImportProfiler:
+    """Times every module imported while it runs.
+
+    builtins.__import__ is wrapped, a module is timed by the import statement that first brings
+    it into sys.modules. cumulative includes the modules it imports itself, own doesn't.
+    """
+
+    def __init__(self):
+        self.cumulative = collections.defaultdict(float)
+        self.own = collections.defaultdict(float)
+        self.steps = []
+        self.stack = []
+        self.original_import = None
+        self.started_at = None
+        self.stopped_at = None
+
+    def start(self):
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+        self.started_at = time.perf_counter()
+
+    def stop(self):
+        builtins.__import__ = self.original_import
+        self.stopped_at = time.perf_counter()
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        absolute = name
+        if level:
+            try:
+                package = globals.get("__package__") or globals["__name__"]
+                absolute = importlib.util.resolve_name("." * level + name, package)
+            except (AttributeError, KeyError, ImportError, ValueError):
+                pass
+        if absolute in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            self.cumulative[absolute] += elapsed
+            self.own[absolute] += elapsed - children
+
+    @contextlib.contextmanager
+    def measure(self, label):
+        """Adds the time spent in the block to the report as label."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((label, time.perf_counter() - start))
+
+    def report(self, top=25):
+        """A text table of the slowest modules and top level packages."""
+        total = (self.stopped_at or time.perf_counter()) - self.started_at
+        packages = collections.defaultdict(float)
+        for name, seconds in self.own.items():
+            packages[name.split(".")[0]] += seconds
+
+        lines = [f"startup took {total:.2f}s, {sum(self.own.values()):.2f}s importing"]
+        for label, seconds in self.steps:
+            lines.append(f"{seconds:8.3f}s  {label}")
+
+        lines.append("slowest packages (own time of all their modules):")
+        for name, seconds in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f"{seconds:8.3f}s  {name}")
+
+        lines.append("slowest modules (cumulative / own):")
+        slowest = sorted(self.cumulative.items(), key=lambda item: -item[1])
+        for name, seconds in slowest[:top]:
+            lines.append(f"{seconds:8.3f}s {self.own[name]:8.3f}s  {name}")
+        return "\n".join(lines)
+
+
+profiler = None
+
+
+def get_import_profiler():
+    """The profiler started by the first call, streamlit reruns keep getting the same one."""
+    global profiler
+    if profiler is None:
+        profiler = ImportProfiler()
+        profiler.start()
+    return profiler
+
+
+def measure_startup(label):
+    """profiler.measure(label) while --profile-startup is timing the startup, a no-op after."""
+    if profiler is None or profiler.stopped_at is not None:
+        return contextlib.nullcontext()
+    return profiler.measure(label)
+
+
+def report_startup():
+    """Stops the profiler and prints its report, only the first time it's called."""
+    if profiler is not None and profiler.stopped_at is None:
+        profiler.stop()
+        print(profiler.report())
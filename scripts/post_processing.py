@@ -23,6 +23,8 @@ from sd_utils import (
     GFPGAN_available,
     LDSR_available,
     load_models,
+    get_model_registry,
+    post_processing_model_names,
     logger,
     load_GFPGAN,
     load_RealESRGAN,
@@ -648,27 +650,35 @@ def layout():
             process = st.form_submit_button("Process Images!")
 
         if process:
-            with hc.HyLoader(
-                "Loading Models...", hc.Loaders.standard_loaders, index=[0]
+            # the models stay loaded until the job is done, other sessions can't evict them.
+            with get_model_registry().hold(
+                *post_processing_model_names(
+                    st.session_state["use_GFPGAN"],
+                    st.session_state["use_RealESRGAN"],
+                    st.session_state["use_LDSR"],
+                )
             ):
-                # load_models(use_LDSR=st.session_state["use_LDSR"], LDSR_model=st.session_state["LDSR_model"],
-                # use_GFPGAN=st.session_state["use_GFPGAN"], GFPGAN_model=st.session_state["GFPGAN_model"] ,
-                # use_RealESRGAN=st.session_state["use_RealESRGAN"], RealESRGAN_model=st.session_state["RealESRGAN_model"])
-
-                if st.session_state["use_GFPGAN"]:
-                    load_GFPGAN(model_name=st.session_state["GFPGAN_model"])
-
-                if st.session_state["use_RealESRGAN"]:
-                    load_RealESRGAN(st.session_state["RealESRGAN_model"])
-
-                if st.session_state["use_LDSR"]:
-                    load_LDSR(st.session_state["LDSR_model"])
-
-            post_process(
-                use_GFPGAN=st.session_state["use_GFPGAN"],
-                GFPGAN_model=st.session_state["GFPGAN_model"],
-                use_RealESRGAN=st.session_state["use_RealESRGAN"],
-                realesrgan_model_name=st.session_state["RealESRGAN_model"],
-                use_LDSR=st.session_state["use_LDSR"],
-                LDSR_model_name=st.session_state["LDSR_model"],
-            )
+                with hc.HyLoader(
+                    "Loading Models...", hc.Loaders.standard_loaders, index=[0]
+                ):
+                    # load_models(use_LDSR=st.session_state["use_LDSR"], LDSR_model=st.session_state["LDSR_model"],
+                    # use_GFPGAN=st.session_state["use_GFPGAN"], GFPGAN_model=st.session_state["GFPGAN_model"] ,
+                    # use_RealESRGAN=st.session_state["use_RealESRGAN"], RealESRGAN_model=st.session_state["RealESRGAN_model"])
+
+                    if st.session_state["use_GFPGAN"]:
+                        load_GFPGAN(model_name=st.session_state["GFPGAN_model"])
+
+                    if st.session_state["use_RealESRGAN"]:
+                        load_RealESRGAN(st.session_state["RealESRGAN_model"])
+
+                    if st.session_state["use_LDSR"]:
+                        load_LDSR(st.session_state["LDSR_model"])
+
+                post_process(
+                    use_GFPGAN=st.session_state["use_GFPGAN"],
+                    GFPGAN_model=st.session_state["GFPGAN_model"],
+                    use_RealESRGAN=st.session_state["use_RealESRGAN"],
+                    realesrgan_model_name=st.session_state["RealESRGAN_model"],
+                    use_LDSR=st.session_state["use_LDSR"],
+                    LDSR_model_name=st.session_state["LDSR_model"],
+                )
@@ -1,5 +1,6 @@
-import argparse, os, sys, re, time
+import argparse, os, sys, re, time, json, shutil, hashlib, queue, threading
 import collections
+from concurrent.futures import Future, ThreadPoolExecutor
 import yaml
 import math
 import random
@@ -16,7 +17,111 @@ import torch
 from frontend.job_manager import JobInfo
 from frontend.image_metadata import ImageMetadata
 
-scn2img_cache = {"seed": None, "cache": {}}
+
+class SceneNodeCache:
+    """Cache of rendered scene nodes, keyed by the stable content hash of the node.
+
+    Entries are kept in memory in LRU order and evicted once their images take more than
+    `max_bytes`. With `disk_dir` set every entry is also written to disk (PNG images plus a
+    json sidecar), so unchanged subtrees of a scene are reused across restarts."""
+
+    def __init__(self, max_bytes=1024 * 1024 * 1024, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_bytes(outputs):
+        return sum(
+            img.width * img.height * len(img.getbands())
+            for img in outputs
+            if isinstance(img, Image.Image)
+        )
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        value = self.read_disk(key) if self.disk_dir is not None else None
+        if value is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self.add(key, value)
+        return value
+
+    def put(self, key, value):
+        self.add(key, value)
+        if self.disk_dir is not None:
+            self.write_disk(key, value)
+
+    def add(self, key, value):
+        if key in self.entries:
+            self.bytes -= self.entry_bytes(self.entries.pop(key)[0])
+        self.entries[key] = value
+        self.bytes += self.entry_bytes(value[0])
+        # always keep the newest entry, even if it is larger than the whole budget.
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= self.entry_bytes(evicted[0])
+
+    def read_disk(self, key):
+        path = self.disk_path(key)
+        try:
+            with open(os.path.join(path, "entry.json"), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            outputs = []
+            for k in range(entry["count"]):
+                with Image.open(os.path.join(path, f"{k:03}.png")) as img:
+                    outputs.append(img.copy())
+        except (OSError, ValueError, KeyError):
+            return None
+        return outputs, entry["seed"], entry["info"], entry["stats"]
+
+    def write_disk(self, key, value):
+        outputs, seed, info, stats = value
+        path = self.disk_path(key)
+        os.makedirs(path, exist_ok=True)
+        for k, img in enumerate(outputs):
+            img.save(os.path.join(path, f"{k:03}.png"))
+        # the sidecar is written last, an entry without it is incomplete and ignored.
+        with open(os.path.join(path, "entry.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {"count": len(outputs), "seed": seed, "info": info, "stats": stats},
+                f,
+                default=str,
+            )
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        if self.disk_dir is not None and os.path.isdir(self.disk_dir):
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "mb": round(self.bytes / 1_048_576, 1),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 3)
+            if lookups
+            else 0.0,
+        }
+
+
+scn2img_cache = None
 
 monocular_depth_estimation = None
 
@@ -394,9 +499,15 @@ def get_scn2img(
 
         os.makedirs(outpath, exist_ok=True)
 
-        if clear_cache or scn2img_cache["seed"] != seed:
-            scn2img_cache["seed"] = seed
-            scn2img_cache["cache"] = {}
+        if scn2img_cache is None:
+            scn2img_cache = SceneNodeCache(
+                max_bytes=getattr(opt, "scn2img_cache_mb", 1024) * 1_048_576,
+                disk_dir=getattr(opt, "scn2img_disk_cache", None),
+            )
+
+        # the seed is part of every node hash, so changing it no longer needs to drop the cache.
+        if clear_cache:
+            scn2img_cache.clear()
 
         comments = []
         print_log_lvl = 2
@@ -438,9 +549,7 @@ def get_scn2img(
 
             log_lvl(0, traceback.format_exc())
 
-        # cache = scn2img_cache["cache"]
-        log_info("scn2img_cache")
-        log_info(list(scn2img_cache["cache"].keys()))
+        log_info("scn2img_cache", scn2img_cache.stats())
 
         def is_seed_invalid(s):
             result = (type(s) != int) or (s == "") or (s is None)
@@ -526,36 +635,36 @@ def get_scn2img(
                 exclude_child_args = set(exclude_child_args)
                 if None not in exclude_args:
                     exclude_args.add(None)
-                return hash(
-                    (
-                        hash(seed),
-                        hash(extra),
-                        hash(self.func),
-                        hash(
-                            tuple(
-                                [
-                                    (k, v)
-                                    for k, v in self.args.items()
-                                    if k not in exclude_args
-                                ]
-                            )
+                # BLAKE2 over a canonical json encoding, unlike hash() this is stable across processes
+                # so it can address the on-disk cache.
+                content = json.dumps(
+                    {
+                        "model": getattr(opt, "ckpt", None),
+                        "seed": seed,
+                        "extra": extra,
+                        "func": self.func,
+                        "args": sorted(
+                            [k, v]
+                            for k, v in self.args.items()
+                            if k not in exclude_args
                         ),
-                        hash(
-                            tuple(
-                                [
-                                    c.cache_hash(
-                                        seed=seed,
-                                        exclude_args=exclude_child_args,
-                                        exclude_child_args=exclude_child_args,
-                                        extra=child_extra,
-                                        child_extra=child_extra,
-                                    )
-                                    for c in self.children
-                                ]
+                        "children": [
+                            c.cache_hash(
+                                seed=seed,
+                                exclude_args=exclude_child_args,
+                                exclude_child_args=exclude_child_args,
+                                extra=child_extra,
+                                child_extra=child_extra,
                             )
-                        ),
-                    )
+                            for c in self.children
+                        ],
+                    },
+                    sort_keys=True,
+                    default=repr,
                 )
+                return hashlib.blake2b(
+                    content.encode("utf-8"), digest_size=20
+                ).hexdigest()
 
         parse_arg, function_args, function_args_ext = scn2img_define_args()
         # log_debug("function_args", function_args)
@@ -1399,7 +1508,8 @@ def get_scn2img(
                     seed=img2img_kwargs["seed"],
                     exclude_args={"select", "pos", "rotation"},
                 )
-                if obj_hash not in scn2img_cache["cache"]:
+                cached = scn2img_cache.get(obj_hash)
+                if cached is None:
                     if job_info:
                         count_images_before = len(job_info.images)
                     outputs, seed, info, stats = img2img(**img2img_kwargs)
@@ -1414,9 +1524,10 @@ def get_scn2img(
                         # use images.pop so that images list is modified inplace and stays the same object.
                         for k in range(num_new):
                             job_info.images.pop()
-                    scn2img_cache["cache"][obj_hash] = outputs, seed, info, stats
+                    cached = outputs, seed, info, stats
+                    scn2img_cache.put(obj_hash, cached)
 
-                outputs, seed, info, stats = scn2img_cache["cache"][obj_hash]
+                outputs, seed, info, stats = cached
 
                 for img in outputs:
                     output_img(img)
@@ -1453,7 +1564,8 @@ def get_scn2img(
                     seed=txt2img_kwargs["seed"],
                     exclude_args={"select", "pos", "rotation"},
                 )
-                if obj_hash not in scn2img_cache["cache"]:
+                cached = scn2img_cache.get(obj_hash)
+                if cached is None:
                     if job_info:
                         count_images_before = len(job_info.images)
                     outputs, seed, info, stats = txt2img(**txt2img_kwargs)
@@ -1468,9 +1580,10 @@ def get_scn2img(
                         # use images.pop so that images list is modified inplace and stays the same object.
                         for k in range(num_new):
                             job_info.images.pop()
-                    scn2img_cache["cache"][obj_hash] = outputs, seed, info, stats
+                    cached = outputs, seed, info, stats
+                    scn2img_cache.put(obj_hash, cached)
 
-                outputs, seed, info, stats = scn2img_cache["cache"][obj_hash]
+                outputs, seed, info, stats = cached
 
                 for img in outputs:
                     output_img(img)
@@ -1573,6 +1686,10 @@ def get_scn2img(
         mem_max_used, mem_total = mem_mon.read_and_stop()
         time_diff = time.time() - start_time
 
+        log_info("scn2img_cache", scn2img_cache.stats())
+        if depth_estimation_service is not None:
+            log_info("depth_estimation", depth_estimation_service.stats())
+
         output_infos = []
         output_infos.append(("initial_seed", seed))
         excluded_args = set(["job_info", "fp", "init_info", "init_info_mask", "prompt"])
@@ -1623,54 +1740,212 @@ def get_scn2img(
     return scn2img
 
 
+class DepthEstimationService:
+    """Runs the depth estimation models for scn2img.
+
+    The models stay resident once loaded. Depth maps are cached by model and image content
+    hash, so an image that passes through several scene nodes (or several renders of the same
+    scene) is only estimated once. Cache misses are queued for a worker thread that batches
+    the requests arriving within `batch_window` seconds of each other, while the image
+    preprocessing runs in a thread pool."""
+
+    MONOCULAR = 0
+    MIDAS = 1
+
+    def __init__(
+        self, max_bytes=256 * 1024 * 1024, max_batch=8, batch_window=0.01, workers=4
+    ):
+        self.max_bytes = max_bytes
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.cache = collections.OrderedDict()
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.worker = None
+
+    @staticmethod
+    def image_key(model_idx, image):
+        digest = hashlib.blake2b(image.tobytes(), digest_size=20)
+        digest.update(f"{image.mode}{image.size}".encode("utf-8"))
+        return model_idx, digest.hexdigest()
+
+    def cache_get(self, key):
+        with self.lock:
+            if key not in self.cache:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+    def cache_put(self, key, depth):
+        # cached depth maps are shared between callers, so they must not be modified in place.
+        depth.flags.writeable = False
+        with self.lock:
+            if key in self.cache:
+                return
+            self.cache[key] = depth
+            self.cache_bytes += depth.nbytes
+            while self.cache_bytes > self.max_bytes and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= evicted.nbytes
+
+    def estimate(self, images, model_idx):
+        """Returns the raw model output for every image, None where the model isn't available."""
+        images = [
+            image
+            if isinstance(image, Image.Image)
+            else Image.fromarray(np.asarray(image))
+            for image in images
+        ]
+        keys = [self.image_key(model_idx, image) for image in images]
+        results = [self.cache_get(key) for key in keys]
+
+        futures = {}
+        for image, key, result in zip(images, keys, results):
+            if result is None and key not in futures:
+                futures[key] = Future()
+                self.requests.put((model_idx, image, key, futures[key]))
+        if futures:
+            self.start_worker()
+
+        return [
+            result if result is not None else futures[key].result()
+            for key, result in zip(keys, results)
+        ]
+
+    def start_worker(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(
+                    target=self.run, name="depth-estimation", daemon=True
+                )
+                self.worker.start()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(
+                        self.requests.get(timeout=timeout)
+                        if timeout > 0
+                        else self.requests.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+
+            for model_idx in set(request[0] for request in batch):
+                group = [request for request in batch if request[0] == model_idx]
+                try:
+                    depths = self.predict(model_idx, [request[1] for request in group])
+                except Exception as e:
+                    for request in group:
+                        request[3].set_exception(e)
+                    continue
+                for (_, _, key, future), depth in zip(group, depths):
+                    if depth is not None:
+                        self.cache_put(key, depth)
+                    future.set_result(depth)
+
+    def predict(self, model_idx, images):
+        if model_idx == self.MONOCULAR:
+            return self.predict_monocular(images)
+        return self.predict_midas(images)
+
+    def predict_monocular(self, images):
+        # https://huggingface.co/keras-io/monocular-depth-estimation
+        # https://huggingface.co/spaces/atsantiago/Monocular_Depth_Filter
+        if monocular_depth_estimation is None:
+            try_loading_monocular_depth_estimation()
+        if monocular_depth_estimation is None:
+            return [None] * len(images)
+
+        def preprocess(image):
+            return np.asarray(image.convert("RGB").resize((640, 480)))
+
+        batch = np.stack(list(self.pool.map(preprocess, images)), axis=0)
+        predictions = monocular_depth_estimation.predict(
+            batch.astype(np.float32) / 255, batch_size=len(images)
+        )
+        return list(predictions)
+
+    def predict_midas(self, images):
+        if midas_depth_estimation is None or midas_transform is None:
+            try_loading_midas_depth_estimation()
+        if midas_depth_estimation is None or midas_transform is None:
+            return [None] * len(images)
+
+        def preprocess(image):
+            return midas_transform(np.asarray(image.convert("RGB")))
+
+        inputs = list(self.pool.map(preprocess, images))
+        depths = [None] * len(images)
+        # images of the same size give inputs of the same shape and go through the model together.
+        sizes = collections.defaultdict(list)
+        for k, image in enumerate(images):
+            sizes[image.size].append(k)
+        for (width, height), indices in sizes.items():
+            input_batch = torch.cat([inputs[k] for k in indices]).to("cpu")
+            with torch.no_grad():
+                prediction = midas_depth_estimation(input_batch)
+                prediction = torch.nn.functional.interpolate(
+                    prediction.unsqueeze(1),
+                    size=(height, width),
+                    mode="bicubic",
+                    align_corners=False,
+                )[:, 0]
+            output = prediction.cpu().numpy()
+            output = 1 - output / np.max(output, axis=(1, 2), keepdims=True)
+            for k, depth in zip(indices, output):
+                depths[k] = depth
+        return depths
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.cache),
+                "mb": round(self.cache_bytes / 1_048_576, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+depth_estimation_service = None
+
+
+def get_depth_estimation_service():
+    global depth_estimation_service
+    if depth_estimation_service is None:
+        depth_estimation_service = DepthEstimationService()
+    return depth_estimation_service
+
+
 def run_monocular_depth_estimation_multi(
     images, minDepth=10, maxDepth=1000, batch_size=2
 ):
-    # https://huggingface.co/keras-io/monocular-depth-estimation
-    # https://huggingface.co/spaces/atsantiago/Monocular_Depth_Filter
-    global monocular_depth_estimation
+    # batch_size is kept for compatibility, batching is done by the depth estimation service.
     if images is None:
         return None
-    if monocular_depth_estimation is None:
-        try_loading_monocular_depth_estimation()
-    if monocular_depth_estimation is None:
-        return None
-    if type(images) == Image:
+    if isinstance(images, Image.Image):
         images = [images]
-    loaded_images = []
-    for image in images:
-        # print("image", image)
-        # print("type(image)", type(image))
-        # if type(image) is Image:
-        # image = np.asarray(image.convert("RGB"))
-        try:
-            image = image.convert("RGB")
-            image = image.resize((640, 480))
-        except:
-            pass
-        image = np.asarray(image)
-        x = np.clip(image.reshape(480, 640, 3) / 255, 0, 1)
-        loaded_images.append(x)
-    loaded_images = np.stack(loaded_images, axis=0)
-    images = loaded_images
-
-    # Support multiple RGB(A)s, one RGB(A) image, even grayscale
-    if len(images.shape) < 3:
-        images = np.stack((images, images, images), axis=2)
-    if len(images.shape) < 4:
-        images = images.reshape((1, images.shape[0], images.shape[1], images.shape[2]))
-    if images.shape[3] > 3:
-        images = images[:, :, :, :3]
-
-    # Compute predictions
-    predictions = monocular_depth_estimation.predict(images, batch_size=batch_size)
+    predictions = get_depth_estimation_service().estimate(
+        images, DepthEstimationService.MONOCULAR
+    )
+    if any(prediction is None for prediction in predictions):
+        return None
+    predictions = np.stack(predictions, axis=0)
 
     def depth_norm(x, maxDepth):
         return maxDepth / x
 
     # Put in expected range
-    # print("Max Depth:", np.amax(predictions), maxDepth)
-    # print("Min Depth:", np.amin(predictions), minDepth)
     depths = (
         np.clip(depth_norm(predictions, maxDepth=maxDepth), minDepth, maxDepth)
         / maxDepth
@@ -1737,33 +2012,11 @@ def run_Monocular_Depth_Filter_single(
 
 
 def run_midas_depth_estimation(image):
-    global midas_depth_estimation
-    global midas_transform
     if image is None:
         return None
-    if midas_depth_estimation is None or midas_transform is None:
-        try_loading_midas_depth_estimation()
-    if midas_depth_estimation is None or midas_transform is None:
-        return None
-
-    image = image.convert("RGB")
-    image = np.asarray(image)
-
-    device = "cpu"
-    input_batch = midas_transform(image).to(device)
-    with torch.no_grad():
-        prediction = midas_depth_estimation(input_batch)
-
-        prediction = torch.nn.functional.interpolate(
-            prediction.unsqueeze(1),
-            size=image.shape[:2],
-            mode="bicubic",
-            align_corners=False,
-        ).squeeze()
-
-    output = prediction.cpu().numpy()
-    depth = 1 - output / np.max(output)
-    return depth
+    return get_depth_estimation_service().estimate(
+        [image], DepthEstimationService.MIDAS
+    )[0]
 
 
 def run_midas_depth_filter(
@@ -1831,7 +2084,6 @@ def run_depth_estimation(image: Image, model_idx: int):
     return depth
 
 
-@numba.jit
 def depth_reprojection(
     xyz: np.ndarray,
     depth: np.ndarray,
@@ -1842,14 +2094,10 @@ def depth_reprojection(
     cy: float,
 ):
     h, w = depth.shape[:2]
-    for v in range(h):
-        y = fy * (v - cy)
-        for u in range(w):
-            x = fx * (u - cx)
-            z = depth[v, u] * depth_scale
-            xyz[v, u, 0] = x * z
-            xyz[v, u, 1] = y * z
-            xyz[v, u, 2] = z
+    z = depth * depth_scale
+    xyz[:, :, 0] = (fx * (np.arange(w) - cx))[np.newaxis, :] * z
+    xyz[:, :, 1] = (fy * (np.arange(h) - cy))[:, np.newaxis] * z
+    xyz[:, :, 2] = z
 
 
 def run_3d_estimation(
@@ -1865,9 +2113,10 @@ def run_3d_estimation(
     return xyz
 
 
-@numba.jit
-def transform_image_3d(
+@numba.jit(nopython=True, cache=True)
+def splat_image_3d(
     img_out: np.ndarray,
+    zbuf: np.ndarray,
     img_in: np.ndarray,
     depth: np.ndarray,
     depth_near: float,
@@ -1882,67 +2131,216 @@ def transform_image_3d(
     cy1: float,
     rot_cam1_cam0: np.ndarray,
     offset_cam1_cam0: np.ndarray,
-    min_mask: int,
-    max_mask: int,
 ):
-    # assert(img_in.shape[2] == 4)
-    # assert(img_out.shape[2] == 4)
-    # assert(len(depth.shape) == 2)
+    """Forward splat of img_in into img_out with a depth test against zbuf, which has to be
+    filled with inf. The nearest surface wins, ties keep the first source pixel."""
     # (u0,v0)  : 2d pixel position in img_in
     # pos_cam0 : 3d pixel position in cam0 coordinate system
     # pos_cam1 : 3d pixel position in cam1 coordinate system
     # (u1,v1)  : 2d pixel position in img_out
-    m00 = rot_cam1_cam0[0, 0]
-    m01 = rot_cam1_cam0[0, 1]
-    m02 = rot_cam1_cam0[0, 2]
-    m10 = rot_cam1_cam0[1, 0]
-    m11 = rot_cam1_cam0[1, 1]
-    m12 = rot_cam1_cam0[1, 2]
-    m20 = rot_cam1_cam0[2, 0]
-    m21 = rot_cam1_cam0[2, 1]
-    m22 = rot_cam1_cam0[2, 2]
-    h0 = int(depth.shape[0])
-    w0 = int(depth.shape[1])
-    h1 = int(img_out.shape[0])
-    w1 = int(img_out.shape[1])
+    h0 = depth.shape[0]
+    w0 = depth.shape[1]
+    h1 = img_out.shape[0]
+    w1 = img_out.shape[1]
+    channels = img_out.shape[2]
     for v0 in range(h0):
         y0_ = fy0 * (v0 - cy0)
         for u0 in range(w0):
-            r, g, b, a = img_in[v0, u0]
-            # img_out[v0,u0,0] = r
-            # img_out[v0,u0,1] = g
-            # img_out[v0,u0,2] = b
-            # img_out[v0,u0,3] = a
-            # continue
-            # if not (min_mask <= a <= max_mask): continue
             x0_ = fx0 * (u0 - cx0)
             z0 = depth_near + depth[v0, u0] * depth_scale
             x0 = x0_ * z0
             y0 = y0_ * z0
-            x1 = offset_cam1_cam0[0] + m00 * x0 + m01 * y0 + m02 * z0
-            y1 = offset_cam1_cam0[1] + m10 * x0 + m11 * y0 + m12 * z0
-            z1 = offset_cam1_cam0[2] + m20 * x0 + m21 * y0 + m22 * z0
-            # pos_cam0 = (x0*z0,y0*z0,z0)
-            # pos_cam1 = offset_cam1_cam0 + rot_cam1_cam0 @ pos_cam0
-            # x1,y1,z1 = pos_cam1
+            z1 = (
+                offset_cam1_cam0[2]
+                + rot_cam1_cam0[2, 0] * x0
+                + rot_cam1_cam0[2, 1] * y0
+                + rot_cam1_cam0[2, 2] * z0
+            )
             if z1 <= 0:
                 continue
-            u1 = int(0.5 + (x1 / (z1 * fx1)) + cx1)
-            v1 = int(0.5 + (y1 / (z1 * fy1)) + cy1)
-            if u1 < 0:
-                u1 = 0
-            if u1 >= w1:
-                u1 = w1 - 1
-            if v1 < 0:
-                v1 = 0
-            if v1 >= h1:
-                v1 = h1 - 1
-            # if not (0 <= u1 < w1): continue
-            # if not (0 <= v1 < h1): continue
-            img_out[v1, u1, 0] = r
-            img_out[v1, u1, 1] = g
-            img_out[v1, u1, 2] = b
-            img_out[v1, u1, 3] = a
+            x1 = (
+                offset_cam1_cam0[0]
+                + rot_cam1_cam0[0, 0] * x0
+                + rot_cam1_cam0[0, 1] * y0
+                + rot_cam1_cam0[0, 2] * z0
+            )
+            y1 = (
+                offset_cam1_cam0[1]
+                + rot_cam1_cam0[1, 0] * x0
+                + rot_cam1_cam0[1, 1] * y0
+                + rot_cam1_cam0[1, 2] * z0
+            )
+            u1 = min(max(int(0.5 + (x1 / (z1 * fx1)) + cx1), 0), w1 - 1)
+            v1 = min(max(int(0.5 + (y1 / (z1 * fy1)) + cy1), 0), h1 - 1)
+            if z1 < zbuf[v1, u1]:
+                zbuf[v1, u1] = z1
+                for c in range(channels):
+                    img_out[v1, u1, c] = img_in[v0, u0, c]
+
+
+def reproject_images_3d(
+    img_in: np.ndarray,
+    depth: np.ndarray,
+    depth_near: float,
+    depth_scale: float,
+    from_caminfo: "CameraInfo",
+    to_caminfos: List["CameraInfo"],
+    device: Union[str, torch.device] = "cpu",
+    pose_batch_size: int = 8,
+):
+    """Reprojects img_in (h, w, c) as seen from from_caminfo into every camera of to_caminfos.
+
+    Collisions are resolved with a z-buffer, so the nearest surface wins. Pixels behind the
+    camera are dropped and pixels outside the image are clamped to its border. On the cpu
+    every camera goes through the compiled splat_image_3d loop, other devices use
+    reproject_images_3d_torch. Returns a (len(to_caminfos), h, w, c) uint8 array."""
+    if torch.device(device).type != "cpu":
+        return reproject_images_3d_torch(
+            img_in,
+            depth,
+            depth_near,
+            depth_scale,
+            from_caminfo,
+            to_caminfos,
+            device=device,
+            pose_batch_size=pose_batch_size,
+        )
+
+    h, w = depth.shape[:2]
+    img_in = np.ascontiguousarray(img_in, dtype=np.uint8)
+    depth = np.ascontiguousarray(depth, dtype=np.float32)
+    images_out = np.zeros((len(to_caminfos), h, w, img_in.shape[2]), dtype=np.uint8)
+    zbuf = np.empty((h, w), dtype=np.float32)
+    for img_out, to_caminfo in zip(images_out, to_caminfos):
+        zbuf.fill(np.inf)
+        tf_cam1_cam0 = affine_inv(to_caminfo.pose) @ from_caminfo.pose
+        splat_image_3d(
+            img_out,
+            zbuf,
+            img_in,
+            depth,
+            float(depth_near),
+            float(depth_scale),
+            float(from_caminfo.fx),
+            float(from_caminfo.fy),
+            float(from_caminfo.cx),
+            float(from_caminfo.cy),
+            float(to_caminfo.fx),
+            float(to_caminfo.fy),
+            float(to_caminfo.cx),
+            float(to_caminfo.cy),
+            np.ascontiguousarray(tf_cam1_cam0[:3, :3], dtype=np.float64),
+            np.ascontiguousarray(tf_cam1_cam0[:3, 3], dtype=np.float64),
+        )
+    return images_out
+
+
+def warm_up_reproject_images_3d():
+    """Runs reproject_images_3d on a tiny image so splat_image_3d is compiled, or loaded from
+    numba's cache, before the first request needs it. The arguments are cast above so this is
+    the only specialization requests use."""
+    try:
+        reproject_images_3d(
+            np.zeros((2, 2, 4), dtype=np.uint8),
+            np.zeros((2, 2), dtype=np.float32),
+            1.0,
+            1.0,
+            CameraInfo((2, 2)),
+            [CameraInfo((2, 2))],
+        )
+    except Exception:
+        import traceback
+
+        print("Error compiling splat_image_3d:", file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+
+
+def reproject_images_3d_torch(
+    img_in: np.ndarray,
+    depth: np.ndarray,
+    depth_near: float,
+    depth_scale: float,
+    from_caminfo: "CameraInfo",
+    to_caminfos: List["CameraInfo"],
+    device: Union[str, torch.device] = "cuda",
+    pose_batch_size: int = 8,
+):
+    """reproject_images_3d for gpus: all pixels are moved with a single matrix transform per
+    batch of camera poses and the z-buffer is a scatter_reduce, so the nearest surface wins.
+    """
+    h, w = depth.shape[:2]
+    channels = img_in.shape[2]
+    # each pixel is packed into a single int32 so moving it is one gather, the extra
+    # transparent entry at index h * w is what empty output pixels point to.
+    img_in = np.ascontiguousarray(img_in, dtype=np.uint8)
+    if channels != 4:
+        img_in = np.concatenate(
+            [img_in, np.zeros((h, w, 4 - channels), dtype=np.uint8)], axis=2
+        )
+    colors = torch.as_tensor(img_in.view(np.int32).reshape(h * w), device=device)
+    colors = torch.cat([colors, colors.new_zeros(1)])
+    empty = (0x7FFFFFFF << 32) | (h * w)
+
+    # the 3d position of input pixel (u0, v0) in cam0 is ray(u0, v0) * z0 with
+    # ray = (fx0 * (u0 - cx0), fy0 * (v0 - cy0), 1), so rotating it into cam1 only needs the
+    # rotated ray components per column and per row, broadcast over the image.
+    ray_x = from_caminfo.fx * (
+        torch.arange(w, device=device, dtype=torch.float32) - from_caminfo.cx
+    )
+    ray_y = from_caminfo.fy * (
+        torch.arange(h, device=device, dtype=torch.float32) - from_caminfo.cy
+    )
+    z0 = depth_near + torch.as_tensor(depth, device=device, dtype=torch.float32) * (
+        depth_scale
+    )
+    pixel_index = torch.arange(h * w, device=device).reshape(h, w)
+
+    outputs = []
+    for start in range(0, len(to_caminfos), pose_batch_size):
+        cams = to_caminfos[start : start + pose_batch_size]
+        batch = len(cams)
+        tf_cam1_cam0 = torch.as_tensor(
+            np.stack([affine_inv(cam.pose) @ from_caminfo.pose for cam in cams]),
+            device=device,
+            dtype=torch.float32,
+        )
+        intrinsics = torch.as_tensor(
+            [[cam.fx, cam.fy, cam.cx, cam.cy] for cam in cams],
+            device=device,
+            dtype=torch.float32,
+        )
+        fx1, fy1, cx1, cy1 = intrinsics[:, :, None, None].unbind(1)
+
+        rot = tf_cam1_cam0[:, :3, :3, None, None]
+        offset = tf_cam1_cam0[:, :3, 3, None, None]
+        x1, y1, z1 = (
+            (
+                rot[:, i, 0] * ray_x[None, None, :]
+                + (rot[:, i, 1] * ray_y[None, :, None] + rot[:, i, 2])
+            )
+            * z0
+            + offset[:, i]
+            for i in range(3)
+        )
+
+        valid = z1 > 0
+        z1 = torch.where(valid, z1, torch.ones_like(z1))
+        u1 = (0.5 + x1 / (z1 * fx1) + cx1).clamp(0, w - 1).long()
+        v1 = (0.5 + y1 / (z1 * fy1) + cy1).clamp(0, h - 1).long()
+        target = (torch.arange(batch, device=device)[:, None, None] * h + v1) * w + u1
+
+        # z-buffer: the bits of a positive float32 sort like the float, so the smallest
+        # (depth, source pixel) key per output pixel is the nearest surface.
+        key = (z1.view(torch.int32).long() << 32) | pixel_index
+        key = torch.where(valid, key, torch.full_like(key, empty))
+        nearest = torch.full((batch * h * w,), empty, device=device, dtype=torch.long)
+        nearest.scatter_reduce_(0, target.reshape(-1), key.reshape(-1), reduce="amin")
+
+        out = colors[nearest & 0xFFFFFFFF]
+        outputs.append(out.reshape(batch, h, w))
+
+    images_out = torch.cat(outputs).cpu().numpy().view(np.uint8)
+    return images_out.reshape(len(to_caminfos), h, w, 4)[..., :channels]
 
 
 class CameraInfo:
@@ -1980,53 +2378,48 @@ def run_transform_image_3d(
 ):
     if image is None:
         return None
-    h, w = image.size
     image_in = np.asarray(image.convert("RGBA"))
-    image_out = np.zeros(shape=(h, w, 4), dtype=np.uint8)
-    tf_world_cam0 = from_caminfo.pose
-    tf_world_cam1 = to_caminfo.pose
-    tf_cam1_world = affine_inv(tf_world_cam1)
-    tf_cam1_cam0 = tf_cam1_world @ tf_world_cam0
-    rot_cam1_cam0 = tf_cam1_cam0[:3, :3]
-    offset_cam1_cam0 = tf_cam1_cam0[:3, 3]
-    # print("depth_scale", depth_scale)
-    # print("from_caminfo.fx", from_caminfo.fx)
-    # print("from_caminfo.fy", from_caminfo.fy)
-    # print("from_caminfo.cx", from_caminfo.cx)
-    # print("from_caminfo.cy", from_caminfo.cy)
-    # print("to_caminfo.fx", to_caminfo.fx)
-    # print("to_caminfo.fy", to_caminfo.fy)
-    # print("to_caminfo.cx", to_caminfo.cx)
-    # print("to_caminfo.cy", to_caminfo.cy)
-    # print("rot_cam1_cam0", rot_cam1_cam0)
-    # print("offset_cam1_cam0", offset_cam1_cam0)
-    # print("min_mask", min_mask)
-    # print("max_mask", max_mask)
-
-    transform_image_3d(
-        image_out,
+    image_out = reproject_images_3d(
         image_in,
         depth,
         depth_near,
         depth_scale,
-        from_caminfo.fx,
-        from_caminfo.fy,
-        from_caminfo.cx,
-        from_caminfo.cy,
-        to_caminfo.fx,
-        to_caminfo.fy,
-        to_caminfo.cx,
-        to_caminfo.cy,
-        rot_cam1_cam0,
-        offset_cam1_cam0,
-        min_mask,
-        max_mask,
-    )
+        from_caminfo,
+        [to_caminfo],
+        device="cuda" if torch.cuda.is_available() else "cpu",
+    )[0]
     if mask_invert:
         image_out[:, :, 3] = 255 - image_out[:, :, 3]
     return Image.fromarray(image_out, "RGBA")
 
 
+def run_transform_image_3d_batch(
+    image: Image,
+    depth: np.ndarray,
+    depth_near: float,
+    depth_scale: float,
+    from_caminfo: CameraInfo,
+    to_caminfos: List[CameraInfo],
+    mask_invert: bool = False,
+    device: Union[str, torch.device] = "cpu",
+):
+    """run_transform_image_3d for many camera poses at once, e.g. the frames of a camera path."""
+    if image is None:
+        return None
+    images_out = reproject_images_3d(
+        np.asarray(image.convert("RGBA")),
+        depth,
+        depth_near,
+        depth_scale,
+        from_caminfo,
+        to_caminfos,
+        device=device,
+    )
+    if mask_invert:
+        images_out[:, :, :, 3] = 255 - images_out[:, :, :, 3]
+    return [Image.fromarray(image_out, "RGBA") for image_out in images_out]
+
+
 def run_transform_image_3d_simple(
     image: Image,
     depth: np.ndarray,
@@ -2141,3 +2534,10 @@ def pose3d(rotation, translation):
 def pose3d_rpy(x, y, z, roll, pitch, yaw):
     """returns transformation matrix which transforms from pose to world"""
     return translation3d(x, y, z) @ rotation3d_rpy(roll, pitch, yaw)
+
+
+# compiling splat_image_3d takes seconds, so it is done off the request path when the module
+# is imported, a request that comes in meanwhile waits for the same compilation.
+threading.Thread(
+    target=warm_up_reproject_images_3d, name="scn2img-warmup", daemon=True
+).start()
@@ -19,7 +19,11 @@ import hydralit as st
 import hydralit_components as hc
 
 # streamlit imports
-from streamlit.runtime.scriptrunner import StopException
+from streamlit.runtime.scriptrunner import (
+    StopException,
+    add_script_run_ctx,
+    get_script_run_ctx,
+)
 
 # from streamlit.runtime.scriptrunner import script_run_context
 
@@ -36,21 +40,27 @@ import streamlit_nested_layout
 
 import warnings
 import json
+import collections
+import collections.abc
+import functools
+import contextlib
+import inspect
+import importlib.util
+import hashlib
+import itertools
+import copy
 
-import cv2
 import os, sys, re, random, datetime, time, math, toml
 import gc
 from PIL import Image, ImageFont, ImageDraw, ImageFilter
 from PIL.PngImagePlugin import PngInfo
-from scipy import integrate
 import torch
-from torchdiffeq import odeint
-import k_diffusion as K
 import math
 import mimetypes
 import numpy as np
 import pynvml
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import torch, torchvision
 from torch import autocast
 from torchvision import transforms
@@ -61,11 +71,9 @@ from pathlib import Path
 from contextlib import nullcontext
 from einops import rearrange, repeat
 from ldm.util import instantiate_from_config
+from optimizedSD.offload import get_offloader
 from retry import retry
 from slugify import slugify
-import skimage
-import piexif
-import piexif.helper
 from tqdm import trange
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.util import ismap
@@ -73,18 +81,34 @@ from ldm.util import ismap
 # from abc import ABC, abstractmethod
 from packaging import version
 from pathlib import Path
-from huggingface_hub import hf_hub_download
 import shutup
 
 # import librosa
 from logger import logger
+from lazy_imports import LazyModule
+from frontend.image_metadata import metadata_to_exif
+from vram_admission import (
+    AdmissionController,
+    FakeMemoryProbe,
+    NvmlMemoryProbe,
+)
 
 # from loguru import logger
 
-try:
-    from realesrgan import RealESRGANer
-    from basicsr.archs.rrdbnet_arch import RRDBNet
-except ImportError:
+# heavy modules only a few functions need are imported the first time they are used.
+cv2 = LazyModule("cv2")
+integrate = LazyModule("scipy.integrate")
+scipy_fft = LazyModule("scipy.fft")
+torchdiffeq = LazyModule("torchdiffeq")
+K = LazyModule("k_diffusion")
+skimage = LazyModule("skimage")
+huggingface_hub = LazyModule("huggingface_hub")
+
+# realesrgan and basicsr are imported where they are used, this only checks they are there.
+if (
+    importlib.util.find_spec("realesrgan") is None
+    or importlib.util.find_spec("basicsr") is None
+):
     logger.error(
         "You tried to import realesrgan without having it installed properly. To install Real-ESRGAN, run:\n\n"
         "pip install realesrgan"
@@ -133,19 +157,52 @@ opt_f = 8
 # model_manager = ModelManager()
 
 
+# the merged config of the last load_configs and the stamps of the files it was read from.
+config_cache = {}
+
+
+def config_stamps():
+    """Modification time and size of the config files, None for a missing one."""
+    stamps = []
+    for path in (
+        "configs/webui/webui_streamlit.yaml",
+        "configs/webui/userconfig_streamlit.yaml",
+    ):
+        try:
+            stat = os.stat(path)
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stamps.append(None)
+    return stamps
+
+
 def load_configs():
     if "defaults" not in st.session_state:
         st.session_state["defaults"] = {}
 
-    st.session_state["defaults"] = OmegaConf.load("configs/webui/webui_streamlit.yaml")
+    # every rerun calls this, the yaml files are only parsed again when they changed on disk.
+    if config_cache.get("stamps") == config_stamps():
+        st.session_state["defaults"] = copy.deepcopy(config_cache["defaults"])
+    else:
+        st.session_state["defaults"] = OmegaConf.load(
+            "configs/webui/webui_streamlit.yaml"
+        )
 
-    if os.path.exists("configs/webui/userconfig_streamlit.yaml"):
-        user_defaults = OmegaConf.load("configs/webui/userconfig_streamlit.yaml")
+        if os.path.exists("configs/webui/userconfig_streamlit.yaml"):
+            user_defaults = OmegaConf.load("configs/webui/userconfig_streamlit.yaml")
 
-        if "version" in user_defaults.general:
-            if version.parse(user_defaults.general.version) < version.parse(
-                st.session_state["defaults"].general.version
-            ):
+            if "version" in user_defaults.general:
+                if version.parse(user_defaults.general.version) < version.parse(
+                    st.session_state["defaults"].general.version
+                ):
+                    logger.error(
+                        "The version of the user config file is older than the version on the defaults config file. "
+                        "This means there were big changes we made on the config."
+                        "We are removing this file and recreating it from the defaults in order to make sure things work properly."
+                    )
+                    os.remove("configs/webui/userconfig_streamlit.yaml")
+                    st.experimental_rerun()
+            else:
                 logger.error(
                     "The version of the user config file is older than the version on the defaults config file. "
                     "This means there were big changes we made on the config."
@@ -153,28 +210,23 @@ def load_configs():
                 )
                 os.remove("configs/webui/userconfig_streamlit.yaml")
                 st.experimental_rerun()
+
+            try:
+                st.session_state["defaults"] = OmegaConf.merge(
+                    st.session_state["defaults"], user_defaults
+                )
+            except KeyError:
+                st.experimental_rerun()
         else:
-            logger.error(
-                "The version of the user config file is older than the version on the defaults config file. "
-                "This means there were big changes we made on the config."
-                "We are removing this file and recreating it from the defaults in order to make sure things work properly."
+            OmegaConf.save(
+                config=st.session_state.defaults,
+                f="configs/webui/userconfig_streamlit.yaml",
             )
-            os.remove("configs/webui/userconfig_streamlit.yaml")
-            st.experimental_rerun()
+            loaded = OmegaConf.load("configs/webui/userconfig_streamlit.yaml")
+            assert st.session_state.defaults == loaded
 
-        try:
-            st.session_state["defaults"] = OmegaConf.merge(
-                st.session_state["defaults"], user_defaults
-            )
-        except KeyError:
-            st.experimental_rerun()
-    else:
-        OmegaConf.save(
-            config=st.session_state.defaults,
-            f="configs/webui/userconfig_streamlit.yaml",
-        )
-        loaded = OmegaConf.load("configs/webui/userconfig_streamlit.yaml")
-        assert st.session_state.defaults == loaded
+        config_cache["stamps"] = config_stamps()
+        config_cache["defaults"] = copy.deepcopy(st.session_state["defaults"])
 
     if os.path.exists(".streamlit/config.toml"):
         st.session_state["streamlit_config"] = toml.load(".streamlit/config.toml")
@@ -351,6 +403,271 @@ def human_readable_size(size, decimal_places=3):
     return f"{size:.{decimal_places}f}{unit}"
 
 
+def find_modules(obj, depth=3, seen=None):
+    """The torch modules held by obj, directly or through its attributes, lists and dicts."""
+    if seen is None:
+        seen = set()
+    if obj is None or id(obj) in seen or depth < 0:
+        return []
+    seen.add(id(obj))
+
+    if isinstance(obj, torch.nn.Module):
+        return [obj]
+    if isinstance(obj, dict):
+        children = obj.values()
+    elif isinstance(obj, (list, tuple)):
+        children = obj
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        children = vars(obj).values()
+    else:
+        return []
+
+    modules = []
+    for child in children:
+        modules += find_modules(child, depth - 1, seen)
+    return modules
+
+
+def module_bytes(modules):
+    """Bytes taken by the parameters and buffers of modules, by device type."""
+    sizes = collections.defaultdict(int)
+    seen = set()
+    for module in modules:
+        for tensor in itertools.chain(module.parameters(), module.buffers()):
+            key = (tensor.device, tensor.data_ptr())
+            if key not in seen:
+                seen.add(key)
+                sizes[tensor.device.type] += tensor.numel() * tensor.element_size()
+    return sizes
+
+
+def release_server_state_model(*names):
+    """Deletes names from server_state, calling unload() on the ones that have it."""
+    for name in names:
+        if name in server_state:
+            if hasattr(server_state[name], "unload"):
+                server_state[name].unload()
+            del server_state[name]
+
+
+class RegisteredModel:
+    def __init__(self, name, get, release, device, load_seconds, lock):
+        self.name = name
+        self.get = get
+        self.release = release
+        self.device = device
+        self.load_seconds = load_seconds
+        self.lock = lock
+        self.last_used = time.time()
+        self.uses = 0
+        self.demoted = False
+
+
+class ModelRegistry:
+    """Keeps track of the models kept in server_state: where they are, how much memory they
+    take, how long they took to load and when they were last used.
+
+    Entries look their model up with get() instead of holding on to it, so code that deletes
+    a model from server_state still frees it. When a budget is set, enforce_budget moves the
+    least recently used models to the cpu to fit in vram and drops them to fit in ram, except
+    for the models a running job holds.
+    """
+
+    def __init__(self, vram_budget_bytes=0, ram_budget_bytes=0):
+        self.vram_budget_bytes = vram_budget_bytes
+        self.ram_budget_bytes = ram_budget_bytes
+        self.entries = collections.OrderedDict()
+        # jobs using each model, by name so a job can hold a model before loading it.
+        self.holders = collections.Counter()
+        self.lock = threading.Lock()
+
+    def register(self, name, get, release, device=None, load_seconds=0.0, lock=None):
+        """Adds a freshly loaded model. device is where it runs, None when it can't be moved
+        to the cpu and back; lock is the server_state_lock key to hold while evicting it.
+        """
+        with self.lock:
+            self.entries[name] = RegisteredModel(
+                name, get, release, device, load_seconds, lock
+            )
+            self.entries[name].uses = 1
+            self.entries.move_to_end(name)
+
+    def use(self, *names):
+        """Marks models as used, moving the ones that were evicted to the cpu back first."""
+        with self.lock:
+            for name in names:
+                entry = self.entries.get(name)
+                if entry is None:
+                    continue
+                model = entry.get()
+                if model is None:
+                    del self.entries[name]
+                    continue
+                if entry.demoted:
+                    logger.info(f"Moving {name} back to {entry.device}")
+                    for module in find_modules(model):
+                        module.to(entry.device)
+                    entry.demoted = False
+                entry.last_used = time.time()
+                entry.uses += 1
+                self.entries.move_to_end(name)
+
+    @contextlib.contextmanager
+    def hold(self, *names):
+        """Marks models as used and keeps enforce_budget from evicting them, in any session,
+        until the block exits. Jobs hold the models they use for as long as they run."""
+        with self.lock:
+            self.holders.update(names)
+        try:
+            self.use(*names)
+            yield
+        finally:
+            with self.lock:
+                self.holders.subtract(names)
+                # adding an empty counter drops the names nobody holds anymore.
+                self.holders += collections.Counter()
+
+    def drop(self, name):
+        """Unloads a model, the caller holds its lock if it has one."""
+        with self.lock:
+            entry = self.entries.pop(name, None)
+        if entry is not None:
+            entry.release()
+        else:
+            release_server_state_model(name)
+
+    def usage(self):
+        """Bytes on the gpu and on the cpu of every model still loaded."""
+        usage = {}
+        for name, entry in list(self.entries.items()):
+            model = entry.get()
+            if model is None:
+                del self.entries[name]
+            else:
+                usage[name] = module_bytes(find_modules(model))
+        return usage
+
+    def pick_eviction(self, protect):
+        usage = self.usage()
+        vram = sum(sizes["cuda"] for sizes in usage.values())
+        ram = sum(sizes["cpu"] for sizes in usage.values())
+        for name, entry in self.entries.items():
+            if name in protect or self.holders[name]:
+                continue
+            if self.vram_budget_bytes and vram > self.vram_budget_bytes:
+                if usage[name]["cuda"] == 0:
+                    continue
+                fits_in_ram = (
+                    not self.ram_budget_bytes
+                    or ram + usage[name]["cuda"] <= self.ram_budget_bytes
+                )
+                if entry.device is not None and not entry.demoted and fits_in_ram:
+                    return entry, "demote"
+                return entry, "drop"
+            if self.ram_budget_bytes and ram > self.ram_budget_bytes:
+                if usage[name]["cpu"] > 0:
+                    return entry, "drop"
+        return None, None
+
+    def enforce_budget(self, protect=()):
+        """Evicts the least recently used models not in protect until the budgets are met.
+        Call it without holding any server_state_lock."""
+        if not self.vram_budget_bytes and not self.ram_budget_bytes:
+            return
+
+        while True:
+            with self.lock:
+                entry, action = self.pick_eviction(protect)
+            if entry is None:
+                return
+
+            lock = (
+                server_state_lock[entry.lock]
+                if entry.lock is not None
+                else contextlib.nullcontext()
+            )
+            with lock:
+                with self.lock:
+                    # a job may have held or reloaded the model while we waited for its lock.
+                    if (
+                        self.entries.get(entry.name) is not entry
+                        or self.holders[entry.name]
+                    ):
+                        continue
+                    if action == "demote":
+                        # under self.lock, so a job holding it now waits in use() and
+                        # moves it back once it is on the cpu.
+                        logger.info(
+                            f"Moving {entry.name} to the cpu to stay in the vram budget"
+                        )
+                        for module in find_modules(entry.get()):
+                            module.to("cpu")
+                        entry.demoted = True
+                    else:
+                        del self.entries[entry.name]
+                if action != "demote":
+                    logger.info(f"Unloading {entry.name} to stay in the memory budget")
+                    entry.release()
+            torch_gc()
+
+    def status(self):
+        """One dict per loaded model with its device, size, load time, idle time and uses."""
+        now = time.time()
+        with self.lock:
+            usage = self.usage()
+            return [
+                {
+                    "name": name,
+                    "device": "cpu" if entry.demoted else str(entry.device or "-"),
+                    "vram_mb": usage[name]["cuda"] / 2**20,
+                    "ram_mb": usage[name]["cpu"] / 2**20,
+                    "load_seconds": entry.load_seconds,
+                    "idle_seconds": now - entry.last_used,
+                    "uses": entry.uses,
+                    "holders": self.holders[name],
+                }
+                for name, entry in self.entries.items()
+            ]
+
+    def status_text(self):
+        return ", ".join(
+            f"{model['name']} ({model['vram_mb']:.0f}MB vram, {model['ram_mb']:.0f}MB ram)"
+            for model in self.status()
+        )
+
+
+def post_processing_model_names(use_GFPGAN=False, use_RealESRGAN=False, use_LDSR=False):
+    """Registry names of the post-processing models a job uses."""
+    return [
+        name
+        for name, used in (
+            ("GFPGAN", use_GFPGAN),
+            ("RealESRGAN", use_RealESRGAN),
+            ("LDSR", use_LDSR),
+        )
+        if used
+    ]
+
+
+def get_model_registry():
+    with server_state_lock["model_registry"]:
+        if "model_registry" not in server_state:
+            server_state["model_registry"] = ModelRegistry(
+                vram_budget_bytes=st.session_state[
+                    "defaults"
+                ].general.model_registry_vram_budget_mb
+                * 1024
+                * 1024,
+                ram_budget_bytes=st.session_state[
+                    "defaults"
+                ].general.model_registry_ram_budget_mb
+                * 1024
+                * 1024,
+            )
+
+    return server_state["model_registry"]
+
+
 def load_models(
     use_LDSR=False,
     LDSR_model="model",
@@ -362,10 +679,43 @@ def load_models(
     custom_model="Stable Diffusion v1.5",
 ):
     """Load the different models. We also reuse the models that are already in memory to speed things up instead of loading them again."""
+    result = _load_models(
+        use_LDSR=use_LDSR,
+        LDSR_model=LDSR_model,
+        use_GFPGAN=use_GFPGAN,
+        GFPGAN_model=GFPGAN_model,
+        use_RealESRGAN=use_RealESRGAN,
+        RealESRGAN_model=RealESRGAN_model,
+        CustomModel_available=CustomModel_available,
+        custom_model=custom_model,
+    )
+
+    # evicting takes the lock of each model, so it runs once _load_models let go of them.
+    registry = get_model_registry()
+    # the models this call asks for aren't evicted to make room for the others.
+    protect = ["model"] + post_processing_model_names(
+        use_GFPGAN, use_RealESRGAN, use_LDSR
+    )
+    registry.enforce_budget(protect=protect)
+    logger.info(f"Loaded models: {registry.status_text()}")
+
+    return result
 
+
+def _load_models(
+    use_LDSR=False,
+    LDSR_model="model",
+    use_GFPGAN=False,
+    GFPGAN_model="GFPGANv1.4",
+    use_RealESRGAN=False,
+    RealESRGAN_model="RealESRGAN_x4plus",
+    CustomModel_available=False,
+    custom_model="Stable Diffusion v1.5",
+):
     # model_manager.init()
 
     logger.info("Loading models.")
+    registry = get_model_registry()
 
     if "progress_bar_text" in st.session_state:
         st.session_state["progress_bar_text"].text("")
@@ -375,14 +725,26 @@ def load_models(
         if use_LDSR:
             if "LDSR" in server_state and server_state["LDSR"].name == LDSR_model:
                 logger.info("LDSR already loaded")
+                registry.use("LDSR")
             else:
                 if "LDSR" in server_state:
-                    del server_state["LDSR"]
+                    registry.drop("LDSR")
 
-                # Load GFPGAN
+                # Load LDSR
                 if os.path.exists(st.session_state["defaults"].general.LDSR_dir):
                     try:
+                        start = time.perf_counter()
                         server_state["LDSR"] = load_LDSR(model_name=LDSR_model)
+                        # load the weights now so the first upscale does not pay for it.
+                        server_state["LDSR"].load_model_from_config()
+                        registry.register(
+                            "LDSR",
+                            lambda: server_state.get("LDSR"),
+                            lambda: release_server_state_model("LDSR"),
+                            device="cuda",
+                            load_seconds=time.perf_counter() - start,
+                            lock="LDSR",
+                        )
                         logger.info("Loaded LDSR")
                     except Exception:
                         import traceback
@@ -394,20 +756,30 @@ def load_models(
                 logger.debug(
                     "LDSR was in memory but we won't use it. Removing to save VRAM."
                 )
-                del server_state["LDSR"]
+                registry.drop("LDSR")
 
     with server_state_lock["GFPGAN"]:
         if use_GFPGAN:
             if "GFPGAN" in server_state and server_state["GFPGAN"].name == GFPGAN_model:
                 logger.info("GFPGAN already loaded")
+                registry.use("GFPGAN")
             else:
                 if "GFPGAN" in server_state:
-                    del server_state["GFPGAN"]
+                    registry.drop("GFPGAN")
 
                 # Load GFPGAN
                 if os.path.exists(st.session_state["defaults"].general.GFPGAN_dir):
                     try:
+                        start = time.perf_counter()
                         server_state["GFPGAN"] = load_GFPGAN(GFPGAN_model)
+                        registry.register(
+                            "GFPGAN",
+                            lambda: server_state.get("GFPGAN"),
+                            lambda: release_server_state_model("GFPGAN"),
+                            device=server_state["GFPGAN"].device,
+                            load_seconds=time.perf_counter() - start,
+                            lock="GFPGAN",
+                        )
                         logger.info(f"Loaded GFPGAN: {GFPGAN_model}")
                     except Exception:
                         import traceback
@@ -416,7 +788,7 @@ def load_models(
                         logger.error(traceback.format_exc(), file=sys.stderr)
         else:
             if "GFPGAN" in server_state and not server_state["keep_all_models_loaded"]:
-                del server_state["GFPGAN"]
+                registry.drop("GFPGAN")
 
     with server_state_lock["RealESRGAN"]:
         if use_RealESRGAN:
@@ -425,6 +797,7 @@ def load_models(
                 and server_state["RealESRGAN"].model.name == RealESRGAN_model
             ):
                 logger.info("RealESRGAN already loaded")
+                registry.use("RealESRGAN")
             else:
                 # Load RealESRGAN
                 try:
@@ -437,7 +810,16 @@ def load_models(
 
                 if os.path.exists(st.session_state["defaults"].general.RealESRGAN_dir):
                     # st.session_state is used for keeping the models in memory across multiple pages or runs.
+                    start = time.perf_counter()
                     server_state["RealESRGAN"] = load_RealESRGAN(RealESRGAN_model)
+                    registry.register(
+                        "RealESRGAN",
+                        lambda: server_state.get("RealESRGAN"),
+                        lambda: release_server_state_model("RealESRGAN"),
+                        device=server_state["RealESRGAN"].device,
+                        load_seconds=time.perf_counter() - start,
+                        lock="RealESRGAN",
+                    )
                     logger.info(
                         "Loaded RealESRGAN with model "
                         + server_state["RealESRGAN"].model.name
@@ -448,7 +830,7 @@ def load_models(
                 "RealESRGAN" in server_state
                 and not server_state["keep_all_models_loaded"]
             ):
-                del server_state["RealESRGAN"]
+                registry.drop("RealESRGAN")
 
     with server_state_lock["model"], server_state_lock["modelCS"], server_state_lock[
         "modelFS"
@@ -497,7 +879,7 @@ def load_models(
                         "defaults"
                     ].general.optimized
 
-                    load_models(
+                    _load_models(
                         use_LDSR=st.session_state["use_LDSR"],
                         LDSR_model=st.session_state["LDSR_model"],
                         use_GFPGAN=st.session_state["use_GFPGAN"],
@@ -509,6 +891,7 @@ def load_models(
                     )
                 else:
                     logger.info("Model already loaded")
+                    registry.use("model")
 
                 return
             else:
@@ -538,6 +921,7 @@ def load_models(
         # load new model into memory
         server_state["custom_model"] = custom_model
 
+        start = time.perf_counter()
         config, device, model, modelCS, modelFS = load_sd_model(custom_model)
 
         server_state["device"] = device
@@ -565,24 +949,258 @@ def load_models(
         if st.session_state.defaults.general.enable_minimal_memory_usage:
             server_state["model"].enable_minimal_memory_usage()
 
+        registry.register(
+            "model",
+            lambda: [server_state.get(key) for key in ("model", "modelCS", "modelFS")]
+            if "model" in server_state
+            else None,
+            lambda: release_server_state_model(
+                "model", "modelCS", "modelFS", "loaded_model"
+            ),
+            # the optimized sub-models are moved around by their offloader already.
+            device=None if st.session_state.defaults.general.optimized else device,
+            load_seconds=time.perf_counter() - start,
+            lock="model",
+        )
+
         logger.info("Model loaded.")
 
     return True
 
 
+def read_checkpoint(path):
+    """Reads a whole checkpoint into memory, returns its state dict and metadata."""
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(path, device="cpu"), {}
+
+    pl_sd = torch.load(path, map_location="cpu")
+    metadata = {}
+    if "global_step" in pl_sd:
+        metadata["global_step"] = pl_sd["global_step"]
+    sd = pl_sd["state_dict"] if "state_dict" in pl_sd else pl_sd
+    return sd, metadata
+
+
+class MappedCheckpoint(collections.abc.Mapping):
+    """Read-only state dict backed by a converted checkpoint file. Tensors are views into a
+    memory map made when they are looked up, so only the weights a model copies in get read
+    from disk."""
+
+    def __init__(self, index, data_path):
+        self.index = index["tensors"]
+        self.metadata = index["metadata"]
+        # copy-on-write keeps the file untouched while giving torch writable memory.
+        self.data = np.memmap(data_path, dtype=np.uint8, mode="c")
+
+    def __getitem__(self, key):
+        entry = self.index[key]
+        data = self.data[entry["offset"] : entry["offset"] + entry["nbytes"]]
+        tensor = torch.from_numpy(data).view(getattr(torch, entry["dtype"]))
+        return tensor.reshape(entry["shape"])
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+class CheckpointCache:
+    """Converted copies of checkpoints that load by memory-mapping instead of unpickling.
+
+    The first load of a checkpoint unpickles it and writes its tensors to one flat file and a
+    json index in cache_dir, named after the hash of the checkpoint's content, so copies of the
+    same file share one entry. Later loads map that file. The content hash of each path is
+    remembered along with its size and mtime, so unchanged checkpoints aren't read again to
+    hash them."""
+
+    alignment = 64
+
+    def __init__(self, cache_dir="", max_disk_bytes=16 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.hashes = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        hashes_path = os.path.join(self.cache_dir, "hashes.json")
+        if self.hashes is None:
+            try:
+                with open(hashes_path) as f:
+                    self.hashes = json.load(f)
+            except (OSError, ValueError):
+                self.hashes = {}
+
+        known = self.hashes.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        self.hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(hashes_path + ".tmp", "w") as f:
+            json.dump(self.hashes, f)
+        os.replace(hashes_path + ".tmp", hashes_path)
+        return digest
+
+    def load(self, path):
+        """Returns the state dict and the metadata of the checkpoint at path."""
+        if not self.cache_dir:
+            return read_checkpoint(path)
+
+        with self.lock:
+            digest = self.content_hash(path)
+            checkpoint = self.open(digest)
+            if checkpoint is None:
+                self.misses += 1
+                sd, metadata = read_checkpoint(path)
+                try:
+                    self.write(digest, sd, metadata)
+                except OSError as e:
+                    logger.warning(
+                        f"Could not write the checkpoint cache for {path}: {e}"
+                    )
+                    return sd, metadata
+                del sd
+                checkpoint = self.open(digest)
+            else:
+                self.hits += 1
+            return checkpoint, checkpoint.metadata
+
+    def open(self, digest):
+        """Maps the entry for digest, every call gets its own copy-on-write mapping."""
+        index_path = os.path.join(self.cache_dir, f"{digest}.json")
+        data_path = os.path.join(self.cache_dir, f"{digest}.bin")
+        if not os.path.isfile(index_path):
+            return None
+        try:
+            with open(index_path) as f:
+                checkpoint = MappedCheckpoint(json.load(f), data_path)
+            os.utime(index_path)
+            return checkpoint
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(
+                f"Discarding unreadable checkpoint cache entry {digest}: {e}"
+            )
+            for stale in (index_path, data_path):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            return None
+
+    def write(self, digest, sd, metadata):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index_path = os.path.join(self.cache_dir, f"{digest}.json")
+        data_path = os.path.join(self.cache_dir, f"{digest}.bin")
+
+        tensors = {}
+        offset = 0
+        with open(data_path + ".tmp", "wb") as f:
+            for key, tensor in sd.items():
+                if not isinstance(tensor, torch.Tensor):
+                    continue
+                data = tensor.detach().contiguous().reshape(-1).view(torch.uint8)
+                tensors[key] = {
+                    "dtype": str(tensor.dtype).replace("torch.", ""),
+                    "shape": list(tensor.shape),
+                    "offset": offset,
+                    "nbytes": data.numel(),
+                }
+                f.write(data.numpy().tobytes())
+                padding = -(offset + data.numel()) % self.alignment
+                f.write(b"\0" * padding)
+                offset += data.numel() + padding
+        os.replace(data_path + ".tmp", data_path)
+
+        # the index is written last, an entry without one is never read.
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"metadata": metadata, "tensors": tensors}, f)
+        os.replace(index_path + ".tmp", index_path)
+        self.prune_disk()
+
+    def prune_disk(self):
+        """Removes the least recently used entries until the cache fits its budget."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if (
+                entry.is_file()
+                and entry.name.endswith(".json")
+                and entry.name != "hashes.json"
+            ):
+                digest = entry.name[: -len(".json")]
+                data_path = os.path.join(self.cache_dir, f"{digest}.bin")
+                size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+                entries.append((entry.stat().st_mtime, digest, size))
+        entries.sort()
+        total = sum(size for _, _, size in entries)
+        for _, digest, size in entries[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            total -= size
+            for extension in ("json", "bin"):
+                os.remove(os.path.join(self.cache_dir, f"{digest}.{extension}"))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def get_checkpoint_cache():
+    with server_state_lock["checkpoint_cache"]:
+        if "checkpoint_cache" not in server_state:
+            server_state["checkpoint_cache"] = CheckpointCache(
+                cache_dir=st.session_state["defaults"].general.checkpoint_cache_dir,
+                max_disk_bytes=st.session_state[
+                    "defaults"
+                ].general.checkpoint_cache_max_disk_gb
+                * 1024**3,
+            )
+
+    return server_state["checkpoint_cache"]
+
+
+def state_dict_for(module, checkpoint, rename=None):
+    """The entries of checkpoint that module has parameters or buffers for, looked up under
+    rename(key) when rename is given."""
+    sd = {}
+    for key in module.state_dict().keys():
+        checkpoint_key = rename(key) if rename is not None else key
+        if checkpoint_key in checkpoint:
+            sd[key] = checkpoint[checkpoint_key]
+    return sd
+
+
+def unet_checkpoint_key(key):
+    """Maps the keys of the optimized UNet, split in model1 and model2, to the checkpoint's."""
+    if key.startswith(("model1.", "model2.")):
+        return "model." + key[len("model1.") :]
+    return key
+
+
 def load_model_from_config(config, ckpt, verbose=False):
     logger.info(f"Loading model from {ckpt}")
 
     try:
-        pl_sd = torch.load(ckpt, map_location="cpu")
-        if "global_step" in pl_sd:
-            logger.info(f"Global Step: {pl_sd['global_step']}")
-        sd = pl_sd["state_dict"] if "state_dict" in pl_sd else pl_sd
+        checkpoint, metadata = get_checkpoint_cache().load(ckpt)
+        if "global_step" in metadata:
+            logger.info(f"Global Step: {metadata['global_step']}")
         try:
             model = instantiate_from_config(config.model, personalization_config="")
         except TypeError:
             model = instantiate_from_config(config.model)
+        sd = state_dict_for(model, checkpoint)
         m, u = model.load_state_dict(sd, strict=False)
+        u = [key for key in checkpoint if key not in sd]
+        del sd
         if len(m) > 0 and verbose:
             logger.info("missing keys:")
             logger.info(m)
@@ -608,11 +1226,10 @@ def load_model_from_config(config, ckpt, verbose=False):
 
 def load_sd_from_config(ckpt, verbose=False):
     logger.info(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        logger.info(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    return sd
+    checkpoint, metadata = get_checkpoint_cache().load(ckpt)
+    if "global_step" in metadata:
+        logger.info(f"Global Step: {metadata['global_step']}")
+    return checkpoint
 
 
 class MemUsageMonitor(threading.Thread):
@@ -623,6 +1240,8 @@ class MemUsageMonitor(threading.Thread):
     def __init__(self, name):
         threading.Thread.__init__(self)
         self.name = name
+        # the thread has no streamlit context, so the device is read here.
+        self.device_index = st.session_state["defaults"].general.gpu
 
     def run(self):
         try:
@@ -633,9 +1252,7 @@ class MemUsageMonitor(threading.Thread):
             )
             return
         logger.info(f"[{self.name}] Recording memory usage...\n")
-        # Missing context
-        # handle = pynvml.nvmlDeviceGetHandleByIndex(st.session_state['defaults'].general.gpu)
-        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        handle = pynvml.nvmlDeviceGetHandleByIndex(self.device_index)
         self.total = pynvml.nvmlDeviceGetMemoryInfo(handle).total
         while not self.stop_flag:
             m = pynvml.nvmlDeviceGetMemoryInfo(handle)
@@ -656,6 +1273,148 @@ class MemUsageMonitor(threading.Thread):
         return self.max_usage, self.total
 
 
+def get_admission_controller():
+    """The shared AdmissionController, None when admission control is disabled or there is no
+    GPU to probe."""
+    defaults = st.session_state["defaults"].general
+    if not defaults.vram_admission_control:
+        return None
+
+    with server_state_lock["admission_controller"]:
+        if "admission_controller" not in server_state:
+            if defaults.vram_probe == "fake":
+                probe = FakeMemoryProbe(defaults.vram_fake_total_mb * 1_048_576)
+            else:
+                try:
+                    probe = NvmlMemoryProbe(defaults.gpu)
+                except Exception as e:
+                    logger.debug(
+                        f"VRAM admission control disabled, no GPU to probe: {e}"
+                    )
+                    probe = None
+            server_state["admission_controller"] = (
+                AdmissionController(probe, margin_mb=defaults.vram_safety_margin_mb)
+                if probe is not None
+                else None
+            )
+
+    return server_state["admission_controller"]
+
+
+class ConditioningCache:
+    """LRU cache for the output of get_learned_conditioning shared by all the sessions.
+
+    Every prompt is encoded and stored on its own, keyed by the model, the prompt text and the
+    version of the embeddings loaded into the text encoder, so a batch with the same prompt
+    repeated several times, the empty negative prompt or the prompts of a matrix are only
+    encoded once. The cache is bounded both by number of entries and by the bytes used by the
+    stored tensors, the least recently used entries are dropped first."""
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.embeddings_version = 0
+        self.lock = threading.Lock()
+
+    def _key(self, model, prompt):
+        return (
+            id(model),
+            server_state["loaded_model"] if "loaded_model" in server_state else None,
+            self.embeddings_version,
+            torch.is_autocast_enabled(),
+            prompt,
+        )
+
+    def get_learned_conditioning(self, model, prompts):
+        """Same as model.get_learned_conditioning(prompts) but only encodes the prompts that are not cached yet."""
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        prompts = list(prompts)
+
+        with self.lock:
+            found = {}
+            for prompt in prompts:
+                key = self._key(model, prompt)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[prompt] = self.entries[key]
+                    self.hits += 1
+                elif prompt not in found:
+                    found[prompt] = None
+                    self.misses += 1
+                else:
+                    # repeated prompt on the same batch, it will be encoded only once.
+                    self.hits += 1
+
+        missing = [prompt for prompt, c in found.items() if c is None]
+        if missing:
+            encoded = model.get_learned_conditioning(missing)
+            with self.lock:
+                for prompt, c in zip(missing, encoded.split(1)):
+                    found[prompt] = c
+                    self._add(self._key(model, prompt), c)
+
+        return torch.cat([found[prompt] for prompt in prompts])
+
+    def _add(self, key, c):
+        if key in self.entries:
+            old = self.entries.pop(key)
+            self.size_bytes -= old.element_size() * old.nelement()
+        self.entries[key] = c
+        self.size_bytes += c.element_size() * c.nelement()
+
+        while self.entries and (
+            len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes
+        ):
+            _, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= evicted.element_size() * evicted.nelement()
+
+    def embeddings_changed(self):
+        """Called when new embeddings are loaded into the text encoder, entries encoded before that are not reused."""
+        with self.lock:
+            self.embeddings_version += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "size": human_readable_size(self.size_bytes),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+def get_conditioning_cache():
+    with server_state_lock["conditioning_cache"]:
+        if "conditioning_cache" not in server_state:
+            server_state["conditioning_cache"] = ConditioningCache(
+                max_entries=st.session_state[
+                    "defaults"
+                ].general.conditioning_cache_max_entries,
+                max_bytes=st.session_state["defaults"].general.conditioning_cache_max_mb
+                * 1024
+                * 1024,
+            )
+
+    return server_state["conditioning_cache"]
+
+
+def get_learned_conditioning(model, prompts):
+    """Encodes the prompts with the model going through the shared conditioning cache."""
+    return get_conditioning_cache().get_learned_conditioning(model, prompts)
+
+
 class CFGMaskedDenoiser(nn.Module):
     def __init__(self, model):
         super().__init__()
@@ -754,16 +1513,14 @@ def _get_gaussian_window(width, height, std=3.14, mode=0):
     window_scale_x = float(width / min(width, height))
     window_scale_y = float(height / min(width, height))
 
-    window = np.zeros((width, height))
-    x = (np.arange(width) / width * 2.0 - 1.0) * window_scale_x
-    for y in range(height):
-        fy = (y / height * 2.0 - 1.0) * window_scale_y
-        if mode == 0:
-            window[:, y] = np.exp(-(x**2 + fy**2) * std)
-        else:
-            window[:, y] = (1 / ((x**2 + 1.0) * (fy**2 + 1.0))) ** (
-                std / 3.14
-            )  # hey wait a minute that's not gaussian
+    x = (np.arange(width) / width * 2.0 - 1.0)[:, None] * window_scale_x
+    fy = (np.arange(height) / height * 2.0 - 1.0)[None, :] * window_scale_y
+    if mode == 0:
+        window = np.exp(-(x**2 + fy**2) * std)
+    else:
+        window = (1 / ((x**2 + 1.0) * (fy**2 + 1.0))) ** (
+            std / 3.14
+        )  # hey wait a minute that's not gaussian
 
     return window
 
@@ -779,7 +1536,72 @@ def _get_masked_window_rgb(np_mask_grey, hardness=1.0):
     return np_mask_rgb
 
 
-def get_matched_noise(_np_src_image, np_mask_rgb, noise_q, color_variation):
+@functools.lru_cache(maxsize=16)
+def _get_noise_rfft_window(width, height):
+    # the noise shaping window of get_matched_noise in unshifted frequency order, cut down to the
+    # half spectrum of rfft2. real(ifft2(X * w)) only sees the hermitian part of w, which is w
+    # itself for even sizes.
+    window = np.fft.fftshift(_get_gaussian_window(width, height, mode=1))
+    window = 0.5 * (window + np.roll(window[::-1, ::-1], 1, axis=(0, 1)))
+    window = np.ascontiguousarray(window[:, : height // 2 + 1, None], dtype=np.float32)
+    window.flags.writeable = False
+    return window
+
+
+def _shape_noise_spectrum(windowed_image, noise_rgb, noise_q, device=None):
+    # spectral part of get_matched_noise for a batch of (n, width, height, channels) float32 arrays.
+    # the complex fft/ifft/fft round trip of the noise collapses into one real fft multiplied by
+    # the window, and the fftshifts of _fft2/_ifft2 reduce to a spatial shift before the forward
+    # and after the inverse transform. the dc term only offsets the result, which get_matched_noise
+    # normalizes away, but it is so large that keeping it would leave float32 without the
+    # precision for the actual noise, so it is dropped.
+    n, width, height, num_channels = windowed_image.shape
+    window = _get_noise_rfft_window(width, height)
+    axes = (1, 2)
+
+    if device is None:
+        src_fft = scipy_fft.rfft2(
+            np.fft.fftshift(windowed_image, axes=axes),
+            axes=axes,
+            norm="ortho",
+            workers=-1,
+        )
+        noise_fft = scipy_fft.rfft2(
+            np.fft.fftshift(noise_rgb, axes=axes), axes=axes, norm="ortho", workers=-1
+        )
+        src_dist = np.abs(src_fft)
+        shaped_noise_fft = (
+            np.abs(noise_fft * window) ** 2
+            * src_dist**noise_q
+            * (src_fft / np.where(src_dist > 0, src_dist, 1.0))
+        )
+        shaped_noise_fft[:, 0, 0] = 0
+        shaped_noise = scipy_fft.irfft2(
+            shaped_noise_fft, s=(width, height), axes=axes, norm="ortho", workers=-1
+        )
+        return np.fft.ifftshift(shaped_noise, axes=axes).astype(np.float32, copy=False)
+
+    with torch.no_grad():
+        src = torch.fft.fftshift(torch.from_numpy(windowed_image).to(device), dim=axes)
+        noise = torch.fft.fftshift(torch.from_numpy(noise_rgb).to(device), dim=axes)
+        src_fft = torch.fft.rfft2(src, dim=axes, norm="ortho")
+        noise_fft = torch.fft.rfft2(noise, dim=axes, norm="ortho")
+        src_dist = src_fft.abs()
+        shaped_noise_fft = (
+            (noise_fft * torch.tensor(window, device=device)).abs() ** 2
+            * src_dist**noise_q
+            * (src_fft / torch.where(src_dist > 0, src_dist, torch.ones_like(src_dist)))
+        )
+        shaped_noise_fft[:, 0, 0] = 0
+        shaped_noise = torch.fft.irfft2(
+            shaped_noise_fft, s=(width, height), dim=axes, norm="ortho"
+        )
+        return torch.fft.ifftshift(shaped_noise, dim=axes).cpu().numpy()
+
+
+def get_matched_noise(
+    _np_src_image, np_mask_rgb, noise_q, color_variation, device=None
+):
     """
     Explanation:
     Getting good results in/out-painting with stable diffusion can be challenging.
@@ -805,83 +1627,57 @@ def get_matched_noise(_np_src_image, np_mask_rgb, noise_q, color_variation):
     Questions or comments can be sent to parlance@fifth-harmonic.com (https://github.com/parlance-zz/)
     This code is part of a new branch of a discord bot I am working on integrating with diffusers (https://github.com/parlance-zz/g-diffuser-bot)
 
+    The spectra are computed with float32 real FFTs (scipy.fft, or torch.fft when a torch device is
+    given). np_mask_rgb may also be a batch of masks (n, width, height, channels), with
+    _np_src_image either a single image or a matching batch; a batch of noise is returned then.
     """
 
-    global DEBUG_MODE
-    global TMP_ROOT_PATH
-
-    width = _np_src_image.shape[0]
-    height = _np_src_image.shape[1]
-    num_channels = _np_src_image.shape[2]
+    batched = np.ndim(np_mask_rgb) == 4
+    masks = np.asarray(np_mask_rgb, dtype=np.float32)
+    if not batched:
+        masks = masks[None]
+    src_images = np.broadcast_to(
+        np.asarray(_np_src_image, dtype=np.float32), masks.shape
+    )
+    n, width, height, num_channels = masks.shape
 
-    np_src_image = _np_src_image[:] * (1.0 - np_mask_rgb)
-    np_mask_grey = np.sum(np_mask_rgb, axis=2) / 3.0
-    (np.sum(np_src_image, axis=2) / 3.0)
-    np.ones((width, height), dtype=bool)
+    np_mask_grey = np.sum(masks, axis=3) / 3.0
     img_mask = np_mask_grey > 1e-6
     ref_mask = np_mask_grey < 1e-3
 
-    windowed_image = _np_src_image * (1.0 - _get_masked_window_rgb(np_mask_grey))
-    windowed_image /= np.max(windowed_image)
+    windowed_image = src_images * (1.0 - np_mask_grey[..., None])
+    windowed_image /= np.max(windowed_image, axis=(1, 2, 3), keepdims=True)
     windowed_image += (
-        np.average(_np_src_image) * np_mask_rgb
-    )  # / (1.-np.average(np_mask_rgb))  # rather than leave the masked area black, we get better results from fft by filling the average unmasked color
-    # windowed_image += np.average(_np_src_image) * (np_mask_rgb * (1.- np_mask_rgb)) / (1.-np.average(np_mask_rgb)) # compensate for darkening across the mask transition area
-    # _save_debug_img(windowed_image, "windowed_src_img")
-
-    src_fft = _fft2(windowed_image)  # get feature statistics from masked src img
-    src_dist = np.absolute(src_fft)
-    src_phase = src_fft / src_dist
-    # _save_debug_img(src_dist, "windowed_src_dist")
-
-    noise_window = _get_gaussian_window(
-        width, height, mode=1
+        np.mean(src_images, axis=(1, 2, 3), keepdims=True) * masks
+    )  # rather than leave the masked area black, we get better results from fft by filling the average unmasked color
+
+    noise_rgb = np.random.random_sample((n, width, height, num_channels)).astype(
+        np.float32
     )  # start with simple gaussian noise
-    noise_rgb = np.random.random_sample((width, height, num_channels))
-    noise_grey = np.sum(noise_rgb, axis=2) / 3.0
+    noise_grey = np.sum(noise_rgb, axis=3, keepdims=True) / 3.0
     noise_rgb *= color_variation  # the colorfulness of the starting noise is blended to greyscale with a parameter
-    for c in range(num_channels):
-        noise_rgb[:, :, c] += (1.0 - color_variation) * noise_grey
-
-    noise_fft = _fft2(noise_rgb)
-    for c in range(num_channels):
-        noise_fft[:, :, c] *= noise_window
-    noise_rgb = np.real(_ifft2(noise_fft))
-    shaped_noise_fft = _fft2(noise_rgb)
-    shaped_noise_fft[:, :, :] = (
-        np.absolute(shaped_noise_fft[:, :, :]) ** 2 * (src_dist**noise_q) * src_phase
-    )  # perform the actual shaping
-
-    brightness_variation = 0.0  # color_variation # todo: temporarily tieing brightness variation to color variation for now
-    contrast_adjusted_np_src = (
-        _np_src_image[:] * (brightness_variation + 1.0) - brightness_variation * 2.0
-    )
-
-    # scikit-image is used for histogram matching, very convenient!
-    shaped_noise = np.real(_ifft2(shaped_noise_fft))
-    shaped_noise -= np.min(shaped_noise)
-    shaped_noise /= np.max(shaped_noise)
-    shaped_noise[img_mask, :] = skimage.exposure.match_histograms(
-        shaped_noise[img_mask, :] ** 1.0,
-        contrast_adjusted_np_src[ref_mask, :],
-        channel_axis=1,
-    )
-    shaped_noise = _np_src_image[:] * (1.0 - np_mask_rgb) + shaped_noise * np_mask_rgb
-    # _save_debug_img(shaped_noise, "shaped_noise")
+    noise_rgb += (1.0 - color_variation) * noise_grey
 
-    matched_noise = np.zeros((width, height, num_channels))
-    matched_noise = shaped_noise[:]
-    # matched_noise[all_mask,:] = skimage.exposure.match_histograms(shaped_noise[all_mask,:], _np_src_image[ref_mask,:], channel_axis=1)
-    # matched_noise = _np_src_image[:] * (1. - np_mask_rgb) + matched_noise * np_mask_rgb
+    shaped_noise = _shape_noise_spectrum(windowed_image, noise_rgb, noise_q, device)
+    shaped_noise -= np.min(shaped_noise, axis=(1, 2, 3), keepdims=True)
+    shaped_noise /= np.max(shaped_noise, axis=(1, 2, 3), keepdims=True)
 
-    # _save_debug_img(matched_noise, "matched_noise")
+    # scikit-image is used for histogram matching, very convenient!
+    for k in range(n):
+        shaped_noise[k][img_mask[k], :] = skimage.exposure.match_histograms(
+            shaped_noise[k][img_mask[k], :],
+            src_images[k][ref_mask[k], :],
+            channel_axis=1,
+        )
+    matched_noise = src_images * (1.0 - masks) + shaped_noise * masks
 
     """
     todo:
     color_variation doesnt have to be a single number, the overall color tone of the out-painted area could be param controlled
     """
 
-    return np.clip(matched_noise, 0.0, 1.0)
+    matched_noise = np.clip(matched_noise, 0.0, 1.0)
+    return matched_noise if batched else matched_noise[0]
 
 
 #
@@ -903,8 +1699,8 @@ def find_noise_for_image(
     image = image.to(device)
     x = model.get_first_stage_encoding(model.encode_first_stage(image))
 
-    uncond = model.get_learned_conditioning([""])
-    cond = model.get_learned_conditioning([prompt])
+    uncond = get_learned_conditioning(model, [""])
+    cond = get_learned_conditioning(model, [prompt])
 
     s_in = x.new_ones([x.shape[0]])
     dnw = K.external.CompVisDenoiser(model)
@@ -946,6 +1742,177 @@ def find_noise_for_image(
     return x / sigmas[-1]
 
 
+class NoiseInversionCache:
+    """Cache of the noise found by find_noise_for_image, so iterating on the same init image
+    doesn't run the inversion again. Results are kept in memory and, when a directory is set,
+    also saved to disk so they survive restarts."""
+
+    def __init__(self, max_entries=16, cache_dir="", max_disk_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, init_image, prompt, steps, cond_scale, normalize):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(init_image.tobytes())
+        h.update(
+            json.dumps(
+                [
+                    init_image.size,
+                    server_state["loaded_model"]
+                    if "loaded_model" in server_state
+                    else None,
+                    st.session_state["defaults"].general.precision,
+                    prompt,
+                    steps,
+                    cond_scale,
+                    normalize,
+                ]
+            ).encode("utf-8")
+        )
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        noise = self.read_disk(key)
+        with self.lock:
+            if noise is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._add(key, noise)
+        return noise
+
+    def put(self, key, noise):
+        noise = noise.detach().to("cpu")
+        with self.lock:
+            self._add(key, noise)
+        self.write_disk(key, noise)
+
+    def _add(self, key, noise):
+        self.entries[key] = noise
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = os.path.join(self.cache_dir, f"{key}.pt")
+        if not os.path.isfile(path):
+            return None
+        try:
+            noise = torch.load(path, map_location="cpu")
+            os.utime(path)
+            return noise
+        except Exception as e:
+            logger.warning(
+                f"Discarding unreadable noise inversion cache entry {path}: {e}"
+            )
+            os.remove(path)
+            return None
+
+    def write_disk(self, key, noise):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, f"{key}.pt")
+            torch.save(noise, path + ".tmp")
+            os.replace(path + ".tmp", path)
+            self.prune_disk()
+        except OSError as e:
+            logger.warning(f"Could not write noise inversion cache entry: {e}")
+
+    def prune_disk(self):
+        """Removes the least recently used files until the disk tier fits its budget."""
+        files = [
+            entry
+            for entry in os.scandir(self.cache_dir)
+            if entry.is_file() and entry.name.endswith(".pt")
+        ]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in files[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+def get_noise_inversion_cache():
+    with server_state_lock["noise_inversion_cache"]:
+        if "noise_inversion_cache" not in server_state:
+            server_state["noise_inversion_cache"] = NoiseInversionCache(
+                max_entries=st.session_state[
+                    "defaults"
+                ].general.noise_inversion_cache_max_entries,
+                cache_dir=st.session_state[
+                    "defaults"
+                ].general.noise_inversion_cache_dir,
+                max_disk_bytes=st.session_state[
+                    "defaults"
+                ].general.noise_inversion_cache_max_disk_mb
+                * 1024
+                * 1024,
+            )
+
+    return server_state["noise_inversion_cache"]
+
+
+def find_noise_for_image_cached(
+    model,
+    device,
+    init_image,
+    prompt,
+    steps=200,
+    cond_scale=2.0,
+    verbose=False,
+    normalize=False,
+    generation_callback=None,
+):
+    """Same as find_noise_for_image but going through the shared noise inversion cache."""
+    cache = get_noise_inversion_cache()
+    key = cache.key(init_image, prompt, steps, cond_scale, normalize)
+    noise = cache.get(key)
+    if noise is None:
+        noise = find_noise_for_image(
+            model,
+            device,
+            init_image,
+            prompt,
+            steps,
+            cond_scale,
+            verbose=verbose,
+            normalize=normalize,
+            generation_callback=generation_callback,
+        )
+        cache.put(key, noise)
+    else:
+        logger.info(f"Reusing cached noise inversion, {cache.stats()}")
+
+    return noise.to(device)
+
+
 #
 def folder_picker(
     label="Select:",
@@ -1088,6 +2055,9 @@ class LDSR:
     def __init__(self, modelPath, yamlPath):
         self.modelPath = modelPath
         self.yamlPath = yamlPath
+        # the loaded model is kept here so consecutive superResolution calls reuse it
+        # instead of going through torch.load every time, use unload() to free it.
+        self.model = None
         # self.model = self.load_model_from_config()
         # print(self.load_model_from_config(OmegaConf.load(yamlPath), modelPath))
         # self.print_current_directory()
@@ -1114,16 +2084,36 @@ class LDSR:
     """
 
     def load_model_from_config(self):
-        # print(f"Loading model from {self.modelPath}")
+        if self.model is not None:
+            return self.model
+
+        logger.info(f"Loading LDSR model from {self.modelPath}")
         pl_sd = torch.load(self.modelPath, map_location="cpu")
         pl_sd["global_step"]
         sd = pl_sd["state_dict"]
         config = OmegaConf.load(self.yamlPath)
         model = instantiate_from_config(config.model, personalization_config="")
         m, u = model.load_state_dict(sd, strict=False)
+        del pl_sd, sd
         model.cuda()
         model.eval()
-        return {"model": model}  # , global_step
+
+        self.model = {"model": model}  # , global_step
+        return self.model
+
+    def is_loaded(self):
+        return self.model is not None
+
+    def unload(self):
+        """Removes the LDSR model from memory, it will be loaded again on the next superResolution call."""
+        if self.model is None:
+            return
+
+        logger.info(f"Unloading LDSR model {self.modelPath}")
+        del self.model["model"]
+        self.model = None
+        gc.collect()
+        torch_gc()
 
     """
     def get_model(self):
@@ -1447,7 +2437,6 @@ class LDSR:
             )
         return logs
 
-    @torch.no_grad()
     @torch.no_grad()
     def superResolution(
         self,
@@ -1476,6 +2465,26 @@ class LDSR:
         downsample_method = 'Lanczos' #@param ['Nearest', 'Lanczos']
         """
 
+        return self.superResolution_batch(
+            [image],
+            ddimSteps=ddimSteps,
+            preDownScale=preDownScale,
+            postDownScale=postDownScale,
+            downsample_method=downsample_method,
+        )[0]
+
+    @torch.no_grad()
+    def superResolution_batch(
+        self,
+        images,
+        ddimSteps=100,
+        preDownScale=1,
+        postDownScale=1,
+        downsample_method="Lanczos",
+    ):
+        """Runs superResolution on a list of images using the same loaded model, returns a list with the results.
+        See superResolution for the meaning of the other arguments."""
+
         diffMode = "superresolution"
         model = self.load_model_from_config()
 
@@ -1484,6 +2493,44 @@ class LDSR:
         diffusion_steps = int(ddimSteps)  # @param [25, 50, 100, 250, 500, 1000]
         eta = 1.0  # @param  {type: 'raw'}
 
+        gc.collect()
+        torch.cuda.empty_cache()
+
+        results = []
+        for n, image in enumerate(images):
+            if len(images) > 1:
+                logger.info(f"Running LDSR on image {n + 1}/{len(images)}")
+
+            results.append(
+                self._super_resolve(
+                    model["model"],
+                    image,
+                    diffMode,
+                    diffusion_steps,
+                    eta,
+                    preDownScale,
+                    postDownScale,
+                    downsample_method,
+                )
+            )
+
+        gc.collect()
+        torch.cuda.empty_cache()
+
+        logger.info("Processing finished!")
+        return results
+
+    def _super_resolve(
+        self,
+        model,
+        image,
+        diffMode,
+        diffusion_steps,
+        eta,
+        preDownScale,
+        postDownScale,
+        downsample_method,
+    ):
         # ####Scaling options:
         # Downsampling to 256px first will often improve the final image and runs faster.
 
@@ -1494,9 +2541,6 @@ class LDSR:
         # Nearest gives sharper results, but may look more pixellated. Lancoz is much higher quality, but result may be less crisp.
         # downsample_method = 'Lanczos' #@param ['Nearest', 'Lanczos']
 
-        gc.collect()
-        torch.cuda.empty_cache()
-
         im_og = image
         width_og, height_og = im_og.size
 
@@ -1515,7 +2559,7 @@ class LDSR:
                 (width_downsampled_pre, height_downsampled_pre), Image.LANCZOS
             )
 
-        logs = self.run(model["model"], im_og, diffMode, diffusion_steps, eta)
+        logs = self.run(model, im_og, diffMode, diffusion_steps, eta)
 
         sample = logs["sample"]
         sample = sample.detach().cpu()
@@ -1549,11 +2593,8 @@ class LDSR:
             )
             a = a.resize((width_og, height_og), aliasing)
 
-        del model
-        gc.collect()
-        torch.cuda.empty_cache()
+        del logs
 
-        logger.info("Processing finished!")
         return a
 
 
@@ -1579,7 +2620,7 @@ def log_likelihood(
 
     x_min = x, x.new_zeros([x.shape[0]])
     t = x.new_tensor([sigma_min, sigma_max])
-    sol = odeint(ode_fn, x_min, t, atol=atol, rtol=rtol, method="dopri5")
+    sol = torchdiffeq.odeint(ode_fn, x_min, t, atol=atol, rtol=rtol, method="dopri5")
     latent, delta_ll = sol[0][-1], sol[1][-1]
     ll_prior = (
         torch.distributions.Normal(0, sigma_max).log_prob(latent).flatten(1).sum(1)
@@ -1587,18 +2628,45 @@ def log_likelihood(
     return ll_prior + delta_ll, {"fevals": fevals}
 
 
-def create_random_tensors(shape, seeds):
-    xs = []
-    for seed in seeds:
-        torch.manual_seed(seed)
+def create_random_tensors(shape, seeds, compat=None):
+    """Creates one noise tensor of the given shape for each seed and returns them as a single batch.
 
-        # randn results depend on device; gpu and cpu get different results for same seed;
-        # the way I see it, it's better to do this on CPU, so that everyone gets same result;
-        # but the original script had it like this so i do not dare change it for now because
-        # it will break everyone's seeds.
-        xs.append(torch.randn(shape, device=st.session_state["defaults"].general.gpu))
-    x = torch.stack(xs)
-    return x
+    The noise for each seed is drawn from its own torch.Generator straight into a preallocated tensor.
+    With compat enabled (the default, see general.noise_compatibility_mode) the noise is drawn on the
+    GPU exactly like older versions did, so old seeds give the same images.
+    With compat disabled the noise is drawn on the CPU, so the same seed gives the same noise on any
+    device.
+    Either way the global RNG is left seeded with the last seed, the samplers that add noise during
+    sampling depend on it to give the same image for the same seed."""
+    if compat is None:
+        compat = st.session_state["defaults"].general.noise_compatibility_mode
+
+    device = (
+        torch.device(f"cuda:{st.session_state['defaults'].general.gpu}")
+        if torch.cuda.is_available()
+        else torch.device("cpu")
+    )
+
+    # randn results depend on device; gpu and cpu get different results for same seed;
+    # the way I see it, it's better to do this on CPU, so that everyone gets same result;
+    # but the original script had it like this so compat mode keeps doing it on the gpu
+    # because changing it would break everyone's seeds.
+    noise_device = device if compat else torch.device("cpu")
+
+    x = torch.empty((len(seeds), *shape), device=noise_device)
+    for i, seed in enumerate(seeds):
+        if compat and i == len(seeds) - 1:
+            # the last seed goes through the global RNG so it ends up in the same state as before.
+            torch.manual_seed(seed)
+            x[i].normal_()
+        else:
+            generator = torch.Generator(device=noise_device)
+            generator.manual_seed(seed)
+            x[i].normal_(generator=generator)
+    if not compat:
+        torch.manual_seed(seeds[-1])
+
+    return x.to(device, non_blocking=True)
 
 
 def torch_gc():
@@ -1813,7 +2881,9 @@ class RealESRGANModel(nn.Module):
         if Path(model_name_or_path).exists():
             file = model_name_or_path
         else:
-            file = hf_hub_download(model_name_or_path, "RealESRGAN_x4plus.pth")
+            file = huggingface_hub.hf_hub_download(
+                model_name_or_path, "RealESRGAN_x4plus.pth"
+            )
         return cls(file)
 
     def upsample_imagefolder(self, in_dir, out_dir, suffix="out", outfile_ext=".png"):
@@ -1896,23 +2966,7 @@ def load_sd_model(model_name: str):
     if st.session_state.defaults.general.optimized:
         config = OmegaConf.load(st.session_state.defaults.general.optimized_config)
 
-        sd = load_sd_from_config(ckpt_path)
-        li, lo = [], []
-        for key, v_ in sd.items():
-            sp = key.split(".")
-            if (sp[0]) == "model":
-                if "input_blocks" in sp:
-                    li.append(key)
-                elif "middle_block" in sp:
-                    li.append(key)
-                elif "time_embed" in sp:
-                    li.append(key)
-                else:
-                    lo.append(key)
-        for key in li:
-            sd["model1." + key[6:]] = sd.pop(key)
-        for key in lo:
-            sd["model2." + key[6:]] = sd.pop(key)
+        checkpoint = load_sd_from_config(ckpt_path)
 
         device = (
             torch.device(f"cuda:{st.session_state.defaults.general.gpu}")
@@ -1921,21 +2975,24 @@ def load_sd_model(model_name: str):
         )
 
         model = instantiate_from_config(config.modelUNet)
-        _, _ = model.load_state_dict(sd, strict=False)
+        model.load_state_dict(
+            state_dict_for(model, checkpoint, rename=unet_checkpoint_key), strict=False
+        )
         model.cuda()
         model.eval()
         model.turbo = st.session_state.defaults.general.optimized_turbo
+        model.prefetch = st.session_state.defaults.general.optimized_prefetch
 
         modelCS = instantiate_from_config(config.modelCondStage)
-        _, _ = modelCS.load_state_dict(sd, strict=False)
+        modelCS.load_state_dict(state_dict_for(modelCS, checkpoint), strict=False)
         modelCS.cond_stage_model.device = device
         modelCS.eval()
 
         modelFS = instantiate_from_config(config.modelFirstStage)
-        _, _ = modelFS.load_state_dict(sd, strict=False)
+        modelFS.load_state_dict(state_dict_for(modelFS, checkpoint), strict=False)
         modelFS.eval()
 
-        del sd
+        del checkpoint
 
         if not st.session_state.defaults.general.no_half:
             model = model.half().to(device)
@@ -2172,6 +3229,45 @@ def split_weighted_subprompts(input_string, normalize=True):
     return [(x[0], x[1] / weight_sum) for x in parsed_prompts]
 
 
+def get_prompt_conditioning(model, prompts, uc, normalize_prompt_weights=True):
+    """Return the conditioning for a batch of prompts, applying `:` sub-prompt weights.
+
+    A batch that repeats a single prompt is weighted once and broadcast over the batch,
+    a batch of different prompts (e.g. grouped horde jobs) is weighted per prompt."""
+    if len(set(prompts)) > 1:
+        if not any(
+            len(split_weighted_subprompts(prompt, normalize_prompt_weights)) > 1
+            for prompt in prompts
+        ):
+            return get_learned_conditioning(model, prompts)
+
+        return torch.cat(
+            [
+                get_prompt_conditioning(
+                    model, [prompt], uc[i : i + 1], normalize_prompt_weights
+                )
+                for i, prompt in enumerate(prompts)
+            ],
+            dim=0,
+        )
+
+    # split the prompt if it has : for weighting
+    weighted_subprompts = split_weighted_subprompts(
+        prompts[0], normalize_prompt_weights
+    )
+
+    # sub-prompt weighting used if more than 1
+    if len(weighted_subprompts) > 1:
+        c = torch.zeros_like(uc)  # i dont know if this is correct.. but it works
+        for subprompt, weight in weighted_subprompts:
+            # note if alpha negative, it functions same as torch.sub
+            c = torch.add(c, get_learned_conditioning(model, subprompt), alpha=weight)
+        return c
+
+    # just behave like usual
+    return get_learned_conditioning(model, prompts)
+
+
 def slerp(device, t, v0: torch.Tensor, v1: torch.Tensor, DOT_THRESHOLD=0.9995):
     v0 = v0.detach().cpu().numpy()
     v1 = v1.detach().cpu().numpy()
@@ -2243,6 +3339,7 @@ def get_font(fontsize):
 def load_embeddings(fp):
     if fp is not None and hasattr(server_state["model"], "embedding_manager"):
         server_state["model"].embedding_manager.load(fp["name"])
+        get_conditioning_cache().embeddings_changed()
 
 
 def load_learned_embed_in_clip(
@@ -2277,7 +3374,7 @@ def load_learned_embed_in_clip(
 
     # add the token in tokenizer
     token = token if token is not None else trained_token
-    tokenizer.add_tokens(token)
+    num_added_tokens = tokenizer.add_tokens(token)
 
     # resize the token embeddings
     text_encoder.resize_token_embeddings(len(tokenizer))
@@ -2285,6 +3382,10 @@ def load_learned_embed_in_clip(
     # get the id for the token and assign the embeds
     token_id = tokenizer.convert_tokens_to_ids(token)
     text_encoder.get_input_embeddings().weight.data[token_id] = embeds
+
+    # prompts encoded before this point could have been using a different embedding for this token.
+    if num_added_tokens:
+        get_conditioning_cache().embeddings_changed()
     return token
 
 
@@ -2704,26 +3805,168 @@ def save_sample(
                 mdata.add_text(key, str(metadata[key]))
             image.save(f"{filename_i}.png", pnginfo=mdata)
         else:
+            # the EXIF block is written while encoding the image instead of reading
+            # the file back and rewriting it with piexif.insert afterwards.
+            exif = metadata_to_exif(metadata)
             if jpg_sample:
-                image.save(f"{filename_i}.jpg", quality=save_quality, optimize=True)
+                image.save(
+                    f"{filename_i}.jpg", quality=save_quality, optimize=True, exif=exif
+                )
             elif save_ext == "webp":
                 image.save(
                     f"{filename_i}.{save_ext}",
                     "webp",
                     quality=save_quality,
                     lossless=save_lossless,
+                    exif=exif,
                 )
             else:
                 # not sure what file format this is
-                image.save(f"{filename_i}.{save_ext}", f"{save_ext}")
+                image.save(f"{filename_i}.{save_ext}", save_format, exif=exif)
+
+
+class ImageSaver:
+    """Runs the image saving work (encoding, metadata, info files and grids) on background threads.
+
+    At most max_pending jobs can be waiting at the same time, submit() blocks when that limit is
+    reached so a fast sampler can not pile up images in memory faster than they can be written.
+    close() waits for all the submitted jobs and must be called before the images are returned,
+    using the saver as a context manager closes it even when the job is stopped or fails.
+    """
+
+    def __init__(self, workers=2, max_pending=8):
+        ctx = get_script_run_ctx()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="ImageSaver",
+            # lets the workers read st.session_state like the thread that created them.
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+        )
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, func, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def flush(self):
+        for future in self.futures:
             try:
-                exif_dict = piexif.load(f"{filename_i}.{save_ext}")
-            except:
-                exif_dict = {"Exif": dict()}
-            exif_dict["Exif"][
-                piexif.ExifIFD.UserComment
-            ] = piexif.helper.UserComment.dump(json.dumps(metadata), encoding="unicode")
-            piexif.insert(piexif.dump(exif_dict), f"{filename_i}.{save_ext}")
+                future.result()
+            except Exception:
+                import traceback
+
+                logger.error("Error saving image:")
+                logger.error(traceback.format_exc())
+        self.futures = []
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SequenceAllocator:
+    """Hands out the sequence numbers used to name the images saved on each folder.
+
+    The folder is only scanned the first time a number is requested for it, after that the
+    numbers come from a counter kept in memory, so numbering an image does not depend on how
+    many files the folder has and concurrent requests never get the same number.
+    When persist is enabled the next number is also kept in a small sidecar file inside the
+    folder which is locked while it is updated, so several processes can share the same folder.
+    """
+
+    def __init__(self, persist=False):
+        self.persist = persist
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def scan(path, prefix=""):
+        result = -1
+        for p in Path(path).iterdir():
+            if p.name.endswith((".png", ".jpg", ".webp")) and p.name.startswith(prefix):
+                tmp = p.name[len(prefix) :]
+                try:
+                    result = max(int(tmp.split("-")[0]), result)
+                except ValueError:
+                    pass
+        return result + 1
+
+    def next(self, path, prefix=""):
+        key = (os.path.abspath(path), prefix)
+
+        with self.lock:
+            if self.persist:
+                return self._next_persisted(path, prefix)
+
+            if key not in self.counters:
+                self.counters[key] = self.scan(path, prefix)
+
+            number = self.counters[key]
+            self.counters[key] += 1
+            return number
+
+    def _next_persisted(self, path, prefix):
+        sidecar = os.path.join(
+            path, f".next_sequence_number{'-' + prefix if prefix else ''}"
+        )
+
+        with open(sidecar, "a+", encoding="utf-8") as f:
+            lock_file(f)
+            try:
+                f.seek(0)
+                try:
+                    number = int(f.read().strip())
+                except ValueError:
+                    # first time this folder is used or the file got corrupted, start from the files on disk.
+                    number = self.scan(path, prefix)
+
+                f.seek(0)
+                f.truncate()
+                f.write(str(number + 1))
+                f.flush()
+            finally:
+                unlock_file(f)
+
+        return number
+
+
+def lock_file(f):
+    if os.name == "nt":
+        import msvcrt
+
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+    else:
+        import fcntl
+
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def unlock_file(f):
+    if os.name == "nt":
+        import msvcrt
+
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 
 def get_next_sequence_number(path, prefix=""):
@@ -2735,17 +3978,16 @@ def get_next_sequence_number(path, prefix=""):
     prefix, and strip the prefix from filenames before extracting their
     sequence number.
 
-    The sequence starts at 0.
+    The sequence starts at 0. The directory is only scanned the first time,
+    each call reserves a new number, see SequenceAllocator.
     """
-    result = -1
-    for p in Path(path).iterdir():
-        if p.name.endswith((".png", ".jpg")) and p.name.startswith(prefix):
-            tmp = p.name[len(prefix) :]
-            try:
-                result = max(int(tmp.split("-")[0]), result)
-            except ValueError:
-                pass
-    return result + 1
+    with server_state_lock["sequence_allocator"]:
+        if "sequence_allocator" not in server_state:
+            server_state["sequence_allocator"] = SequenceAllocator(
+                persist=st.session_state["defaults"].general.persist_sequence_numbers
+            )
+
+    return server_state["sequence_allocator"].next(path, prefix)
 
 
 def oxlamon_matrix(prompt, seed, n_iter, batch_size):
@@ -2828,7 +4070,62 @@ def oxlamon_matrix(prompt, seed, n_iter, batch_size):
 
 
 #
-def process_images(
+def process_images(*args, **kwargs):
+    """Runs _process_images under the VRAM admission control, holding the models it uses so
+    other sessions can't evict them while it runs.
+
+    The job's peak VRAM is estimated from its size, batch size, sampler and post-processing;
+    batches that can't fit even on an idle GPU are split into more iterations of a smaller
+    batch, and jobs that don't fit next to the running ones wait for them instead of running
+    out of memory. The measured peak is fed back to calibrate the estimates."""
+    call = inspect.signature(_process_images).bind(*args, **kwargs)
+    call.apply_defaults()
+    arguments = call.arguments
+    models = ["model"] + post_processing_model_names(
+        arguments["use_GFPGAN"], arguments["use_RealESRGAN"], arguments["use_LDSR"]
+    )
+    with get_model_registry().hold(*models):
+        return admit_process_images(call)
+
+
+def admit_process_images(call):
+    """Runs the bound _process_images call once the admission controller lets it."""
+    controller = get_admission_controller()
+    if controller is None:
+        return _process_images(*call.args, **call.kwargs)
+
+    arguments = call.arguments
+    job = dict(
+        width=arguments["width"],
+        height=arguments["height"],
+        sampler_name=arguments["sampler_name"],
+        use_GFPGAN=arguments["use_GFPGAN"],
+        use_RealESRGAN=arguments["use_RealESRGAN"],
+        use_LDSR=arguments["use_LDSR"],
+    )
+
+    batch_size = controller.plan_batch_size(batch_size=arguments["batch_size"], **job)
+    if batch_size != arguments["batch_size"]:
+        logger.info(
+            f"A batch of {arguments['batch_size']} won't fit in VRAM, running it in batches of {batch_size}."
+        )
+        arguments["n_iter"] = (
+            arguments["n_iter"] * arguments["batch_size"] // batch_size
+        )
+        arguments["batch_size"] = batch_size
+
+    estimate = controller.estimator.estimate(batch_size=batch_size, **job)
+    logger.debug(f"Estimated peak VRAM {estimate:.0f} MiB, {controller.stats()}")
+    with controller.admit(estimate) as measured_peak:
+        result = _process_images(*call.args, **call.kwargs)
+        peak = measured_peak()
+        if peak is not None:
+            controller.estimator.record(batch_size=batch_size, peak_mb=peak, **job)
+
+    return result
+
+
+def _process_images(
     outpath,
     func_init,
     func_sample,
@@ -2867,8 +4164,13 @@ def process_images(
     variant_amount=0.0,
     variant_seed=None,
     save_individual_images: bool = True,
+    batch_prompts=None,
+    batch_seeds=None,
 ):
-    """this is the main loop that both txt2img and img2img use; it calls func_init once inside all the scopes and func_sample once per batch"""
+    """this is the main loop that both txt2img and img2img use; it calls func_init once inside all the scopes and func_sample once per batch
+
+    batch_prompts/batch_seeds give every sample its own prompt and seed instead of repeating `prompt`,
+    which lets the horde bridge sample several compatible jobs in a single batch."""
 
     torch_gc()
     # start time after garbage collection (or before?)
@@ -2881,7 +4183,9 @@ def process_images(
     mem_mon.start()
 
     if st.session_state.defaults.general.use_sd_concepts_library:
-        prompt_tokens = re.findall("<([a-zA-Z0-9-]+)>", prompt)
+        prompt_tokens = re.findall(
+            "<([a-zA-Z0-9-]+)>", " ".join(batch_prompts) if batch_prompts else prompt
+        )
 
         if prompt_tokens:
             # compviz
@@ -2975,6 +4279,8 @@ def process_images(
             n_iter = math.ceil(len(all_prompts) / batch_size)
             all_seeds = len(all_prompts) * [seed]
 
+        all_negprompts = len(all_prompts) * [negprompt]
+
         logger.info(
             f"Prompt matrix will create {len(all_prompts)} images using a total of {n_iter} batches."
         )
@@ -2988,8 +4294,19 @@ def process_images(
                 logger.info("Error verifying input:", file=sys.stderr)
                 logger.info(traceback.format_exc(), file=sys.stderr)
 
-        all_prompts = batch_size * n_iter * [prompt]
-        all_seeds = [seed + x for x in range(len(all_prompts))]
+        if batch_prompts:
+            all_prompts = []
+            all_negprompts = []
+            for batch_prompt in batch_prompts:
+                batch_prompt, _, batch_negprompt = batch_prompt.partition("###")
+                all_prompts.append(batch_prompt.strip())
+                all_negprompts.append(batch_negprompt.strip())
+            all_seeds = list(batch_seeds)
+            n_iter = math.ceil(len(all_prompts) / batch_size)
+        else:
+            all_prompts = batch_size * n_iter * [prompt]
+            all_seeds = [seed + x for x in range(len(all_prompts))]
+            all_negprompts = len(all_prompts) * [negprompt]
 
     precision_scope = (
         autocast
@@ -2999,7 +4316,15 @@ def process_images(
     output_images = []
     grid_captions = []
     stats = []
-    with torch.no_grad(), precision_scope("cuda"), (
+
+    # images are encoded and written to disk on background threads while the next batch is sampled.
+    image_saver = ImageSaver(
+        workers=st.session_state["defaults"].general.save_workers,
+        max_pending=st.session_state["defaults"].general.save_queue_size,
+    )
+
+    # the saver is closed when the block exits, so everything is on disk before returning.
+    with image_saver, torch.no_grad(), precision_scope("cuda"), (
         server_state["model"].ema_scope()
         if not st.session_state["defaults"].general.optimized
         else nullcontext()
@@ -3023,81 +4348,62 @@ def process_images(
             for si in range(len(all_seeds)):
                 all_seeds[si] += target_seed_randomizer
 
+        inverted_noise = None
         for n in range(n_iter):
             logger.info(f"Iteration: {n+1}/{n_iter}")
             prompts = all_prompts[n * batch_size : (n + 1) * batch_size]
             captions = prompt_matrix_parts[n * batch_size : (n + 1) * batch_size]
             seeds = all_seeds[n * batch_size : (n + 1) * batch_size]
+            negprompts = all_negprompts[n * batch_size : (n + 1) * batch_size]
 
             logger.info(prompt)
 
             if st.session_state["defaults"].general.optimized:
-                server_state["modelCS"].to(st.session_state["defaults"].general.gpu)
+                get_offloader(server_state["device"]).acquire(server_state["modelCS"])
 
-            uc = (
-                server_state["model"]
-                if not st.session_state["defaults"].general.optimized
-                else server_state["modelCS"]
-            ).get_learned_conditioning(len(prompts) * [negprompt])
+            uc = get_learned_conditioning(
+                (
+                    server_state["model"]
+                    if not st.session_state["defaults"].general.optimized
+                    else server_state["modelCS"]
+                ),
+                negprompts,
+            )
 
             if isinstance(prompts, tuple):
                 prompts = list(prompts)
 
-            # split the prompt if it has : for weighting
-            # TODO for speed it might help to have this occur when all_prompts filled??
-            weighted_subprompts = split_weighted_subprompts(
-                prompts[0], normalize_prompt_weights
-            )
-
-            # sub-prompt weighting used if more than 1
-            if len(weighted_subprompts) > 1:
-                c = torch.zeros_like(
-                    uc
-                )  # i dont know if this is correct.. but it works
-                for i in range(0, len(weighted_subprompts)):
-                    # note if alpha negative, it functions same as torch.sub
-                    c = torch.add(
-                        c,
-                        (
-                            server_state["model"]
-                            if not st.session_state["defaults"].general.optimized
-                            else server_state["modelCS"]
-                        ).get_learned_conditioning(weighted_subprompts[i][0]),
-                        alpha=weighted_subprompts[i][1],
-                    )
-            else:  # just behave like usual
-                c = (
+            c = get_prompt_conditioning(
+                (
                     server_state["model"]
                     if not st.session_state["defaults"].general.optimized
                     else server_state["modelCS"]
-                ).get_learned_conditioning(prompts)
+                ),
+                prompts,
+                uc,
+                normalize_prompt_weights,
+            )
 
             shape = [opt_C, height // opt_f, width // opt_f]
 
             if st.session_state["defaults"].general.optimized:
-                mem = torch.cuda.memory_allocated() / 1e6
-                server_state["modelCS"].to("cpu")
-                while torch.cuda.memory_allocated() / 1e6 >= mem:
-                    time.sleep(1)
+                get_offloader(server_state["device"]).offload(server_state["modelCS"])
 
             if noise_mode == 1 or noise_mode == 3:
-                # TODO params for find_noise_to_image
-                x = torch.cat(
-                    batch_size
-                    * [
-                        find_noise_for_image(
-                            server_state["model"],
-                            server_state["device"],
-                            init_img.convert("RGB"),
-                            "",
-                            find_noise_steps,
-                            0.0,
-                            normalize=True,
-                            generation_callback=generation_callback,
-                        )
-                    ],
-                    dim=0,
-                )
+                # the init image doesn't change between iterations, so the inversion is only run once.
+                if inverted_noise is None:
+                    # TODO params for find_noise_to_image
+                    inverted_noise = find_noise_for_image_cached(
+                        server_state["model"],
+                        server_state["device"],
+                        init_img.convert("RGB"),
+                        "",
+                        find_noise_steps,
+                        0.0,
+                        normalize=True,
+                        generation_callback=generation_callback,
+                    )
+                x = torch.cat(batch_size * [inverted_noise], dim=0)
             else:
                 # we manually generate all input noises because each one should have a specific seed
                 x = create_random_tensors(shape, seeds=seeds)
@@ -3118,16 +4424,18 @@ def process_images(
                     x,
                 )
 
-            samples_ddim = func_sample(
-                init_data=init_data,
-                x=x,
-                conditioning=c,
-                unconditional_conditioning=uc,
-                sampler_name=sampler_name,
-            )
+            # the optimized unet shares its split buffers between the steps of this run only.
+            with getattr(server_state["model"], "reuse_split_buffers", nullcontext)():
+                samples_ddim = func_sample(
+                    init_data=init_data,
+                    x=x,
+                    conditioning=c,
+                    unconditional_conditioning=uc,
+                    sampler_name=sampler_name,
+                )
 
             if st.session_state["defaults"].general.optimized:
-                server_state["modelFS"].to(st.session_state["defaults"].general.gpu)
+                get_offloader(server_state["device"]).acquire(server_state["modelFS"])
 
             x_samples_ddim = (
                 server_state["model"]
@@ -3217,7 +4525,8 @@ def process_images(
 
                     gfpgan_filename = original_filename + "-gfpgan"
 
-                    save_sample(
+                    image_saver.submit(
+                        save_sample,
                         gfpgan_image,
                         sample_path_i,
                         gfpgan_filename,
@@ -3287,7 +4596,8 @@ def process_images(
                     # normalize_prompt_weights, use_GFPGAN, write_info_files, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
                     # save_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode)
 
-                    save_sample(
+                    image_saver.submit(
+                        save_sample,
                         esrgan_image,
                         sample_path_i,
                         esrgan_filename,
@@ -3364,7 +4674,8 @@ def process_images(
                     # normalize_prompt_weights, use_GFPGAN, write_info_files, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
                     # save_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode)
 
-                    save_sample(
+                    image_saver.submit(
+                        save_sample,
                         result,
                         sample_path_i,
                         ldsr_filename,
@@ -3467,7 +4778,8 @@ def process_images(
                     # normalize_prompt_weights, use_GFPGAN, write_info_files, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
                     # save_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode)
 
-                    save_sample(
+                    image_saver.submit(
+                        save_sample,
                         result,
                         sample_path_i,
                         ldsr_filename,
@@ -3542,7 +4854,8 @@ def process_images(
                     gfpgan_esrgan_sample = output[:, :, ::-1]
                     gfpgan_esrgan_image = Image.fromarray(gfpgan_esrgan_sample)
 
-                    save_sample(
+                    image_saver.submit(
+                        save_sample,
                         gfpgan_esrgan_image,
                         sample_path_i,
                         gfpgan_esrgan_filename,
@@ -3621,7 +4934,8 @@ def process_images(
                     image = Image.composite(init_img, image, init_mask)
 
                 if save_individual_images:
-                    save_sample(
+                    image_saver.submit(
+                        save_sample,
                         image,
                         sample_path_i,
                         filename,
@@ -3658,10 +4972,9 @@ def process_images(
                     # grid_captions.append( captions[i] )
                 if "defaults" in st.session_state:
                     if st.session_state["defaults"].general.optimized:
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        server_state["modelFS"].to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                        get_offloader(server_state["device"]).offload(
+                            server_state["modelFS"]
+                        )
 
             if len(run_images) > 1:
                 preview_image = image_grid(run_images, n_iter)
@@ -3711,7 +5024,8 @@ def process_images(
 
             grid_count = get_next_sequence_number(outpath, "grid-")
             grid_file = f"grid-{grid_count:05}-{seed}_{slugify(prompts[i].replace(' ', '_')[:120-len(full_path)])}.{grid_ext}"
-            grid.save(
+            image_saver.submit(
+                grid.save,
                 os.path.join(outpath, grid_file),
                 grid_format,
                 quality=grid_quality,
@@ -3724,6 +5038,8 @@ def process_images(
     mem_max_used, mem_total = mem_mon.read_and_stop()
     time_diff = time.time() - start_time
 
+    logger.debug(f"Conditioning cache: {get_conditioning_cache().stats()}")
+
     info = f"""
             {prompt}
             Steps: {steps}, Sampler: {sampler_name}, CFG scale: {cfg_scale}, Seed: {seed}{', Denoising strength: '+str(denoising_strength) if init_img is not None else ''}{', GFPGAN' if use_GFPGAN and server_state["GFPGAN"] is not None else ''}{', '+realesrgan_model_name if use_RealESRGAN and server_state["RealESRGAN"] is not None else ''}{', Prompt Matrix Mode.' if prompt_matrix else ''}""".strip()
@@ -19,15 +19,22 @@
 
 # We import hydralit like this to replace the previous stuff
 # we had with native streamlit as it lets ur replace things 1:1
-from sd_utils import logger, load_models
+from sd_utils import st, logger, load_models, seed_to_int
+from horde_client import (
+    HordeClient,
+    log_upload_errors,
+    next_batch,
+    prefetch_jobs,
+    upload_generation,
+)
 
 # streamlit imports
 
 # streamlit components section
 
 # other imports
-import requests, time, json, base64
-from io import BytesIO
+import queue, threading, collections
+from concurrent.futures import ThreadPoolExecutor
 
 # import custom components
 
@@ -48,184 +55,111 @@ def run_bridge(
     horde_censor_nsfw,
     horde_blacklist,
     horde_censorlist,
+    client=None,
 ):
-    current_id = None
-    current_payload = None
-    loop_retry = 0
+    """Pipelined bridge worker.
+
+    Jobs are popped on a background thread while the current batch samples, compatible
+    jobs (same model, resolution, sampler, steps and cfg scale) are sampled together and
+    finished images are encoded and uploaded on separate threads."""
+    from txt2img import txt2img
+
+    if client is None:
+        client = HordeClient(
+            horde_url,
+            api_key,
+            pool_size=st.session_state["defaults"].general.bridge_upload_workers + 1,
+            timeout=st.session_state["defaults"].general.bridge_request_timeout,
+            backoff_max=st.session_state["defaults"].general.bridge_backoff_max,
+            breaker_threshold=st.session_state[
+                "defaults"
+            ].general.bridge_breaker_threshold,
+            breaker_reset=st.session_state["defaults"].general.bridge_breaker_reset,
+        )
+
+    max_batch = max(1, st.session_state["defaults"].general.bridge_max_batch)
+    prefetch = max(max_batch, st.session_state["defaults"].general.bridge_prefetch)
+
     # load the model for stable horde if its not in memory already
     # we should load it after we get the request from the API in
     # case the model is different from the loaded in memory but
     # for now we can load it here so its read right away.
     load_models(use_GFPGAN=True)
-    while True:
-        if loop_retry > 10 and current_id:
+
+    gen_dict = {
+        "name": horde_name,
+        "max_pixels": horde_max_pixels,
+        "priority_usernames": priority_usernames,
+        "nsfw": horde_nsfw,
+        "blacklist": horde_blacklist,
+        "models": ["stable_diffusion"],
+    }
+
+    jobs = queue.Queue()
+    # popped jobs that have not been handed to the sampler yet
+    slots = threading.BoundedSemaphore(prefetch)
+    pending = collections.deque()
+    stop = threading.Event()
+
+    prefetcher = threading.Thread(
+        target=prefetch_jobs,
+        args=(
+            client,
+            gen_dict,
+            jobs,
+            slots,
+            stop,
+            interval,
+            horde_nsfw,
+            horde_censor_nsfw,
+            horde_censorlist,
+            seed_to_int,
+        ),
+        name="horde-prefetch",
+        daemon=True,
+    )
+    prefetcher.start()
+
+    uploader = ThreadPoolExecutor(
+        max_workers=st.session_state["defaults"].general.bridge_upload_workers,
+        thread_name_prefix="horde-upload",
+    )
+
+    try:
+        while True:
+            batch = next_batch(jobs, pending, max_batch, prefetcher)
+            for _ in batch:
+                slots.release()
+
+            payload = batch[0].payload
             logger.info(
-                f"Exceeded retry count {loop_retry} for generation id {current_id}. Aborting generation!"
+                f"Sampling {len(batch)} job(s): {', '.join(str(job.id) for job in batch)}"
             )
-            current_id = None
-            current_payload = None
-            current_generation = None
-            loop_retry = 0
-        elif current_id:
-            logger.info(f"Retrying ({loop_retry}/10) for generation id {current_id}...")
-        gen_dict = {
-            "name": horde_name,
-            "max_pixels": horde_max_pixels,
-            "priority_usernames": priority_usernames,
-            "nsfw": horde_nsfw,
-            "blacklist": horde_blacklist,
-            "models": ["stable_diffusion"],
-        }
-        headers = {"apikey": api_key}
-        if current_id:
-            loop_retry += 1
-        else:
-            try:
-                pop_req = requests.post(
-                    horde_url + "/api/v2/generate/pop", json=gen_dict, headers=headers
-                )
-            except requests.exceptions.ConnectionError:
-                logger.warning(
-                    f"Server {horde_url} unavailable during pop. Waiting 10 seconds..."
-                )
-                time.sleep(10)
-                continue
-            except requests.exceptions.JSONDecodeError():
-                logger.warning(
-                    f"Server {horde_url} unavailable during pop. Waiting 10 seconds..."
-                )
-                time.sleep(10)
-                continue
-            try:
-                pop = pop_req.json()
-            except json.decoder.JSONDecodeError:
-                logger.warning(
-                    f"Could not decode response from {horde_url} as json. Please inform its administrator!"
-                )
-                time.sleep(interval)
-                continue
-            if pop is None:
-                logger.warning(
-                    f"Something has gone wrong with {horde_url}. Please inform its administrator!"
-                )
-                time.sleep(interval)
-                continue
-            if not pop_req.ok:
-                pop["message"]
-                logger.warning(
-                    f"During gen pop, server {horde_url} responded with status code {pop_req.status_code}: {pop['message']}. Waiting for 10 seconds..."
-                )
-                if "errors" in pop:
-                    logger.debug(f"Detailed Request Errors: {pop['errors']}")
-                time.sleep(10)
-                continue
-            if not pop.get("id"):
-                skipped_info = pop.get("skipped")
-                if skipped_info and len(skipped_info):
-                    skipped_info = f" Skipped Info: {skipped_info}."
-                else:
-                    skipped_info = ""
-                logger.info(
-                    f"Server {horde_url} has no valid generations to do for us.{skipped_info}"
-                )
-                time.sleep(interval)
-                continue
-            current_id = pop["id"]
-            logger.info(f"Request with id {current_id} picked up. Initiating work...")
-            current_payload = pop["payload"]
-            if "toggles" in current_payload and current_payload["toggles"] is None:
-                logger.error(f"Received Bad payload: {pop}")
-                current_id = None
-                current_payload = None
-                current_generation = None
-                loop_retry = 0
-                time.sleep(10)
-                continue
-
-        logger.debug(current_payload)
-        current_payload["toggles"] = current_payload.get("toggles", [1, 4])
-        # In bridge-mode, matrix is prepared on the horde and split in multiple nodes
-        if 0 in current_payload["toggles"]:
-            current_payload["toggles"].remove(0)
-        if 8 not in current_payload["toggles"]:
-            if horde_censor_nsfw and not horde_nsfw:
-                current_payload["toggles"].append(8)
-            elif any(word in current_payload["prompt"] for word in horde_censorlist):
-                current_payload["toggles"].append(8)
-
-        from txt2img import txt2img
-
-        """{'prompt': 'Centred Husky, inside spiral with circular patterns, trending on dribbble, knotwork, spirals, key patterns,
-        zoomorphics, ', 'ddim_steps': 30, 'n_iter': 1, 'sampler_name': 'DDIM', 'cfg_scale': 16.0, 'seed': '3405278433', 'height': 512, 'width': 512}"""
-
-        # images, seed, info, stats = txt2img(**current_payload)
-        images, seed, info, stats = txt2img(
-            str(current_payload["prompt"]),
-            int(current_payload["ddim_steps"]),
-            str(current_payload["sampler_name"]),
-            int(current_payload["n_iter"]),
-            1,
-            float(current_payload["cfg_scale"]),
-            str(current_payload["seed"]),
-            int(current_payload["height"]),
-            int(current_payload["width"]),
-            save_grid=False,
-            group_by_prompt=False,
-            save_individual_images=False,
-            write_info_files=False,
-        )
 
-        buffer = BytesIO()
-        # We send as WebP to avoid using all the horde bandwidth
-        images[0].save(buffer, format="WebP", quality=90)
-        # logger.info(info)
-        submit_dict = {
-            "id": current_id,
-            "generation": base64.b64encode(buffer.getvalue()).decode("utf8"),
-            "api_key": api_key,
-            "seed": seed,
-            "max_pixels": horde_max_pixels,
-        }
-        current_generation = seed
-        while current_id and current_generation is not None:
-            try:
-                submit_req = requests.post(
-                    horde_url + "/api/v2/generate/submit",
-                    json=submit_dict,
-                    headers=headers,
-                )
-                try:
-                    submit = submit_req.json()
-                except json.decoder.JSONDecodeError:
-                    logger.error(
-                        f"Something has gone wrong with {horde_url} during submit. Please inform its administrator!  (Retry {loop_retry}/10)"
-                    )
-                    time.sleep(interval)
-                    continue
-                if submit_req.status_code == 404:
-                    logger.info(
-                        "The generation we were working on got stale. Aborting!"
-                    )
-                elif not submit_req.ok:
-                    logger.error(
-                        f"During gen submit, server {horde_url} responded with status code {submit_req.status_code}: {submit['message']}. Waiting for 10 seconds...  (Retry {loop_retry}/10)"
-                    )
-                    if "errors" in submit:
-                        logger.debug(f"Detailed Request Errors: {submit['errors']}")
-                    time.sleep(10)
-                    continue
-                else:
-                    logger.info(
-                        f'Submitted generation with id {current_id} and contributed for {submit_req.json()["reward"]}'
-                    )
-                current_id = None
-                current_payload = None
-                current_generation = None
-                loop_retry = 0
-            except requests.exceptions.ConnectionError:
-                logger.warning(
-                    f"Server {horde_url} unavailable during submit. Waiting 10 seconds...  (Retry {loop_retry}/10)"
+            images, seed, info, stats = txt2img(
+                str(payload["prompt"]),
+                int(payload["ddim_steps"]),
+                str(payload["sampler_name"]),
+                1,
+                len(batch),
+                float(payload["cfg_scale"]),
+                batch[0].seed,
+                int(payload["height"]),
+                int(payload["width"]),
+                save_grid=False,
+                group_by_prompt=False,
+                save_individual_images=False,
+                write_info_files=False,
+                batch_prompts=[str(job.payload["prompt"]) for job in batch],
+                batch_seeds=[job.seed for job in batch],
+            )
+
+            for job, image in zip(batch, images):
+                upload = uploader.submit(
+                    upload_generation, client, job, image, api_key, horde_max_pixels
                 )
-                time.sleep(10)
-                continue
-        time.sleep(interval)
+                upload.add_done_callback(log_upload_errors(job))
+    finally:
+        stop.set()
+        # let the uploads that are already queued finish before leaving
+        uploader.shutdown(wait=True)
@@ -393,6 +393,8 @@ def txt2img(
     write_info_files: bool = True,
     use_stable_horde: bool = False,
     stable_horde_key: str = "0000000000",
+    batch_prompts=None,
+    batch_seeds=None,
 ):
     outpath = st.session_state["defaults"].general.outdir_txt2img
 
@@ -509,6 +511,8 @@ def txt2img(
             jpg_sample=save_as_jpg,
             variant_amount=variant_amount,
             variant_seed=variant_seed,
+            batch_prompts=batch_prompts,
+            batch_seeds=batch_seeds,
         )
 
         del sampler
@@ -38,6 +38,7 @@ from sd_utils import (
     optimize_update_preview_frequency,
     load_learned_embed_in_clip,
     load_GFPGAN,
+    get_model_registry,
     RealESRGANModel,
     set_page_title,
 )
@@ -57,7 +58,7 @@ from streamlit_server_state import server_state, server_state_lock
 
 # other imports
 
-import os, sys, json, re, random, datetime, time, warnings, mimetypes
+import os, sys, json, re, random, datetime, time, warnings, mimetypes, collections
 from PIL import Image
 import torch
 import numpy as np
@@ -90,11 +91,9 @@ from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
 from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 from typing import Callable, List, Optional, Union
 from pathlib import Path
-from torchvision.transforms.functional import pil_to_tensor
 from torchvision import transforms
 import librosa
 from PIL import Image
-from torchvision.io import write_video
 from torchvision import transforms
 import torch.nn as nn
 from uuid import uuid4
@@ -181,7 +180,261 @@ def get_timesteps_arr(audio_filepath, offset, duration, fps=30, margin=1.0, smoo
     return T * (1 - smooth) + np.linspace(0.0, 1.0, T.shape[0]) * smooth
 
 
+def slerp_batch(
+    t: torch.Tensor, v0: torch.Tensor, v1: torch.Tensor, DOT_THRESHOLD=0.9995
+):
+    """Vectorized version of slerp, interpolates v0 (1, ...) and v1 (1, ...) at every value
+    of t in one go and returns a (len(t), ...) tensor."""
+    t = t.to(device=v0.device, dtype=torch.float32).view(-1, *([1] * (v0.dim() - 1)))
+    a = v0.float()
+    b = v1.float()
+
+    dot = torch.sum(a * b / (torch.linalg.norm(a) * torch.linalg.norm(b)))
+    if torch.abs(dot) > DOT_THRESHOLD:
+        v2 = (1 - t) * a + t * b
+    else:
+        theta_0 = torch.acos(dot)
+        sin_theta_0 = torch.sin(theta_0)
+        theta_t = theta_0 * t
+        s0 = torch.sin(theta_0 - theta_t) / sin_theta_0
+        s1 = torch.sin(theta_t) / sin_theta_0
+        v2 = s0 * a + s1 * b
+
+    return v2.to(v0.dtype)
+
+
+class TextEmbeddingCache:
+    """LRU cache of text encoder outputs.
+
+    Entries are keyed by the tokenizer and text encoder identity (and vocabulary size, so
+    textual inversion tokens added later don't get stale embeddings) plus the text, which
+    makes it safe to share between frames, clips and walks on the same pipeline."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pipe, text, max_length):
+        return (
+            id(pipe.tokenizer),
+            id(pipe.text_encoder),
+            len(pipe.tokenizer),
+            max_length,
+            torch.is_autocast_enabled(),
+            text,
+        )
+
+    def get(self, pipe, texts, max_length=None):
+        """Returns the embeddings of `texts` as one (len(texts), 77, 768) tensor, encoding
+        the texts that aren't cached yet in a single text encoder pass."""
+        if isinstance(texts, str):
+            texts = [texts]
+        max_length = max_length or pipe.tokenizer.model_max_length
+
+        keys = [self.key(pipe, text, max_length) for text in texts]
+        missing = list(
+            dict.fromkeys(
+                text for text, key in zip(texts, keys) if key not in self.entries
+            )
+        )
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            text_input = pipe.tokenizer(
+                missing,
+                padding="max_length",
+                max_length=max_length,
+                truncation=True,
+                return_tensors="pt",
+            )
+            with torch.no_grad():
+                embeds = pipe.text_encoder(text_input.input_ids.to(pipe.device))[0]
+            for text, embed in zip(missing, embeds):
+                self.entries[self.key(pipe, text, max_length)] = embed.unsqueeze(0)
+
+        for key in keys:
+            self.entries.move_to_end(key)
+        result = torch.cat([self.entries[key] for key in keys])
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return result
+
+    def clear(self):
+        self.entries.clear()
+
+
+def get_text_embeddings(pipe, texts, max_length=None):
+    """Encodes texts with the pipeline's text encoder through the cache kept on the pipeline."""
+    cache = getattr(pipe, "embedding_cache", None)
+    if cache is None:
+        cache = TextEmbeddingCache()
+        pipe.embedding_cache = cache
+    return cache.get(pipe, texts, max_length)
+
+
+def add_audio_track(container, audio_filepath, offset, duration, sr):
+    """Loads duration seconds of audio_filepath from offset and adds an aac stream for it to
+    container. Returns the stream and the samples, which are encoded by write_audio_track.
+    """
+    audio, sr = librosa.load(
+        audio_filepath, sr=sr, mono=True, offset=offset, duration=duration
+    )
+    return container.add_stream("aac", rate=sr), audio
+
+
+def write_audio_track(container, stream, audio):
+    """Encodes the samples of an audio track added by add_audio_track into container."""
+    import av
+
+    frame_size = stream.codec_context.frame_size or 1024
+    audio = audio.astype(np.float32)
+    for start in range(0, audio.shape[0], frame_size):
+        audio_frame = av.AudioFrame.from_ndarray(
+            audio[np.newaxis, start : start + frame_size],
+            format="fltp",
+            layout="mono",
+        )
+        audio_frame.sample_rate = stream.codec_context.sample_rate
+        for packet in stream.encode(audio_frame):
+            container.mux(packet)
+    for packet in stream.encode():
+        container.mux(packet)
+
+
 #
+class VideoStreamWriter:
+    """Encodes frames into a video file as they are produced.
+
+    Frames are pushed straight into a PyAV container, so memory use stays constant no matter
+    how long the video is. An optional audio clip is muxed in when the writer is closed.
+    """
+
+    def __init__(
+        self,
+        output_filepath: Union[str, Path],
+        fps: int = 30,
+        audio_filepath: Union[str, Path] = None,
+        audio_offset: float = 0,
+        audio_duration: float = 2,
+        sr: int = 22050,
+        options: dict = None,
+    ):
+        import av
+
+        self.container = av.open(str(output_filepath), mode="w")
+        self.fps = fps
+        self.options = options or {"crf": "10"}
+        self.stream = None
+        self.frame_count = 0
+
+        self.audio = None
+        self.audio_stream = None
+        if audio_filepath:
+            self.audio_stream, self.audio = add_audio_track(
+                self.container, audio_filepath, audio_offset, audio_duration, sr
+            )
+
+    def write(self, frame):
+        """Encodes a single frame, either a PIL image, a HWC uint8 array or a CHW tensor in range [0, 255]."""
+        import av
+
+        if isinstance(frame, torch.Tensor):
+            frame = frame.permute(1, 2, 0).cpu().numpy()
+        frame = np.asarray(
+            frame.convert("RGB") if isinstance(frame, Image.Image) else frame
+        )
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+
+        if self.stream is None:
+            # the stream is created on the first frame so we know its size.
+            self.stream = self.container.add_stream("libx264", rate=self.fps)
+            self.stream.width = frame.shape[1]
+            self.stream.height = frame.shape[0]
+            self.stream.pix_fmt = "yuv420p"
+            self.stream.options = self.options
+
+        video_frame = av.VideoFrame.from_ndarray(frame, format="rgb24")
+        for packet in self.stream.encode(video_frame):
+            self.container.mux(packet)
+        self.frame_count += 1
+
+    def close(self):
+        if self.stream is not None:
+            for packet in self.stream.encode():
+                self.container.mux(packet)
+        if self.audio_stream is not None:
+            write_audio_track(self.container, self.audio_stream, self.audio)
+        self.container.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def concat_videos(
+    clip_filepaths: List[Union[str, Path]],
+    output_filepath: Union[str, Path],
+    audio_filepath: Union[str, Path] = None,
+    audio_offset: float = 0,
+    audio_duration: float = None,
+    sr: int = 44100,
+):
+    """Concatenates the video of clips encoded with the same settings by copying their packets,
+    no frame is decoded or re-encoded. The audio is encoded once for the whole video instead
+    of copying the track of every clip, each of those starts with its own encoder priming.
+    """
+    import av
+
+    output = av.open(str(output_filepath), mode="w")
+    output_streams = None
+    # where the next clip starts, per stream and in that stream's time base.
+    offsets = None
+    audio_stream = None
+
+    for clip_filepath in clip_filepaths:
+        with av.open(str(clip_filepath)) as clip:
+            if output_streams is None:
+                add_stream = getattr(output, "add_stream_from_template", None)
+                output_streams = [
+                    add_stream(stream)
+                    if add_stream
+                    else output.add_stream(template=stream)
+                    for stream in clip.streams.video
+                ]
+                offsets = [0] * len(output_streams)
+                if audio_filepath:
+                    audio_stream, audio = add_audio_track(
+                        output, audio_filepath, audio_offset, audio_duration, sr
+                    )
+
+            ends = list(offsets)
+            # the clips' own audio tracks come first, their stream indices don't line up.
+            positions = {stream.index: j for j, stream in enumerate(clip.streams.video)}
+            for packet in clip.demux(clip.streams.video):
+                # the demuxer yields an empty packet at the end of each stream
+                if packet.dts is None:
+                    continue
+                index = positions[packet.stream.index]
+                packet.pts += offsets[index]
+                packet.dts += offsets[index]
+                ends[index] = max(ends[index], packet.pts + (packet.duration or 0))
+                packet.stream = output_streams[index]
+                output.mux(packet)
+            offsets = ends
+
+    if audio_stream is not None:
+        write_audio_track(output, audio_stream, audio)
+    output.close()
+    return str(output_filepath)
+
+
 def make_video_pyav(
     frames_or_frame_dir: Union[str, Path, torch.Tensor],
     audio_filepath: Union[str, Path] = None,
@@ -193,55 +446,31 @@ def make_video_pyav(
     glob_pattern: str = "*.png",
 ):
     """
-    TODO - docstring here
+    Encode a directory of frames (or a frame tensor) into a video, one frame at a time.
 
     frames_or_frame_dir: (Union[str, Path, torch.Tensor]):
         Either a directory of images, or a tensor of shape (T, C, H, W) in range [0, 255].
     """
-
-    # Torchvision write_video doesn't support pathlib paths
-    output_filepath = str(output_filepath)
-
     if isinstance(frames_or_frame_dir, (str, Path)):
-        frames = None
-        for img in sorted(Path(frames_or_frame_dir).glob(glob_pattern)):
-            frame = pil_to_tensor(Image.open(img)).unsqueeze(0)
-            frames = frame if frames is None else torch.cat([frames, frame])
+        frames = (
+            Image.open(img)
+            for img in sorted(Path(frames_or_frame_dir).glob(glob_pattern))
+        )
     else:
         frames = frames_or_frame_dir
 
-    # TCHW -> THWC
-    frames = frames.permute(0, 2, 3, 1)
-
-    if audio_filepath:
-        # Read audio, convert to tensor
-        audio, sr = librosa.load(
-            audio_filepath,
-            sr=sr,
-            mono=True,
-            offset=audio_offset,
-            duration=audio_duration,
-        )
-        audio_tensor = torch.tensor(audio).unsqueeze(0)
-
-        write_video(
-            output_filepath,
-            frames,
-            fps=fps,
-            audio_array=audio_tensor,
-            audio_fps=sr,
-            audio_codec="aac",
-            options={"crf": "10", "pix_fmt": "yuv420p"},
-        )
-    else:
-        write_video(
-            output_filepath,
-            frames,
-            fps=fps,
-            options={"crf": "10", "pix_fmt": "yuv420p"},
-        )
+    with VideoStreamWriter(
+        output_filepath,
+        fps=fps,
+        audio_filepath=audio_filepath,
+        audio_offset=audio_offset,
+        audio_duration=audio_duration,
+        sr=sr,
+    ) as writer:
+        for frame in frames:
+            writer.write(frame)
 
-    return output_filepath
+    return str(output_filepath)
 
 
 class StableDiffusionWalkPipeline(DiffusionPipeline):
@@ -640,32 +869,19 @@ class StableDiffusionWalkPipeline(DiffusionPipeline):
         latents_a = self.init_noise(seed_a, noise_shape)
         latents_b = self.init_noise(seed_b, noise_shape)
 
-        batch_idx = 0
-        embeds_batch, noise_batch = None, None
-        for i, t in enumerate(T):
-            embeds = torch.lerp(embeds_a, embeds_b, t)
-            noise = slerp(
-                device="cuda",
-                t=float(t),
-                v0=latents_a,
-                v1=latents_b,
-                DOT_THRESHOLD=0.9995,
-            )
+        # the noise for the whole clip is interpolated in one go, the (much larger) text
+        # embeddings are interpolated one batch at a time.
+        T = torch.as_tensor(np.asarray(T), dtype=torch.float32)
+        noise = slerp_batch(T, latents_a, latents_b, DOT_THRESHOLD=0.9995)
 
-            embeds_batch = (
-                embeds if embeds_batch is None else torch.cat([embeds_batch, embeds])
-            )
-            noise_batch = (
-                noise if noise_batch is None else torch.cat([noise_batch, noise])
+        for batch_idx, start in enumerate(range(0, T.shape[0], batch_size)):
+            t = T[start : start + batch_size].to(embeds_a.device)
+            embeds_batch = torch.lerp(
+                embeds_a, embeds_b, t.view(-1, 1, 1).to(embeds_a.dtype)
             )
-            batch_is_ready = embeds_batch.shape[0] == batch_size or i + 1 == T.shape[0]
-            if not batch_is_ready:
-                continue
-            yield batch_idx, embeds_batch, noise_batch
-            batch_idx += 1
-            del embeds_batch, noise_batch
+            yield batch_idx, embeds_batch, noise[start : start + batch_size]
+            del embeds_batch
             torch.cuda.empty_cache()
-            embeds_batch, noise_batch = None, None
 
     def make_clip_frames(
         self,
@@ -687,7 +903,11 @@ class StableDiffusionWalkPipeline(DiffusionPipeline):
         skip: int = 0,
         callback=None,
         callback_steps: int = 1,
+        writer: VideoStreamWriter = None,
+        save_frames: bool = True,
     ):
+        """Generate the frames between two prompts. Frames are written to `save_path` when
+        `save_frames` is set and/or handed to `writer` as soon as they are decoded."""
         save_path = Path(save_path)
         save_path.mkdir(parents=True, exist_ok=True)
 
@@ -729,11 +949,14 @@ class StableDiffusionWalkPipeline(DiffusionPipeline):
                 )["images"]
 
                 for image in outputs:
-                    frame_filepath = save_path / (
-                        f"frame%06d{image_file_ext}" % frame_index
-                    )
                     image = image if not upsample else self.upsampler(image)
-                    image.save(frame_filepath)
+                    if save_frames:
+                        frame_filepath = save_path / (
+                            f"frame%06d{image_file_ext}" % frame_index
+                        )
+                        image.save(frame_filepath)
+                    if writer is not None:
+                        writer.write(image)
                     frame_index += 1
 
     def walk(
@@ -761,6 +984,7 @@ class StableDiffusionWalkPipeline(DiffusionPipeline):
         smooth: Optional[float] = 0.0,
         callback=None,
         callback_steps=1,
+        save_frames: Optional[bool] = True,
     ):
         """Generate a video from a sequence of prompts and seeds. Optionally, add audio to the
         video to interpolate to the intensity of the audio.
@@ -811,6 +1035,9 @@ class StableDiffusionWalkPipeline(DiffusionPipeline):
                 Margin from librosa hpss to use for audio interpolation.
             smooth (Optional[float], *optional*, defaults to 0.0):
                 Smoothness of the audio interpolation. 1.0 means linear interpolation.
+            save_frames (Optional[bool], *optional*, defaults to True):
+                When False, frames are only encoded into the clip videos and no image files are written.
+                Clips that were interrupted can then only be resumed from their first frame.
 
         This function will create sub directories for each prompt and seed pair.
 
@@ -919,6 +1146,9 @@ class StableDiffusionWalkPipeline(DiffusionPipeline):
             audio_filepath = data["audio_filepath"]
             audio_start_sec = data["audio_start_sec"]
 
+        # encode every prompt of the walk once, up front, so the clips only hit the cache.
+        self.embed_text(list(prompts))
+
         for i, (prompt_a, prompt_b, seed_a, seed_b, num_step) in enumerate(
             zip(prompts, prompts[1:], seeds, seeds[1:], num_interpolation_steps)
         ):
@@ -932,82 +1162,86 @@ class StableDiffusionWalkPipeline(DiffusionPipeline):
             skip = 0
             if resume:
                 if step_output_filepath.exists():
-                    print(f"Skipping {save_path} because frames already exist")
+                    print(f"Skipping {save_path} because the clip already exists")
                     continue
 
                 existing_frames = sorted(save_path.glob(f"*{image_file_ext}"))
                 if existing_frames:
-                    skip = int(existing_frames[-1].stem[-6:]) + 1
-                    if skip + 1 >= num_step:
-                        print(f"Skipping {save_path} because frames already exist")
-                        continue
-                    print(f"Resuming {save_path.name} from frame {skip}")
+                    skip = min(int(existing_frames[-1].stem[-6:]) + 1, num_step)
+                    if skip == num_step:
+                        # the run stopped after the last frame but before the clip was done.
+                        print(f"Encoding {save_path.name} from its existing frames")
+                    else:
+                        print(f"Resuming {save_path.name} from frame {skip}")
 
             audio_offset = audio_start_sec + sum(num_interpolation_steps[:i]) / fps
             audio_duration = num_step / fps
 
-            self.make_clip_frames(
-                prompt_a,
-                prompt_b,
-                seed_a,
-                seed_b,
-                num_interpolation_steps=num_step,
-                save_path=save_path,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale,
-                eta=eta,
-                height=height,
-                width=width,
-                upsample=upsample,
-                batch_size=batch_size,
-                skip=skip,
-                T=get_timesteps_arr(
-                    audio_filepath,
-                    offset=audio_offset,
-                    duration=audio_duration,
-                    fps=fps,
-                    margin=margin,
-                    smooth=smooth,
-                    callback=callback,
-                    callback_steps=callback_steps,
-                )
-                if audio_filepath
-                else None,
-            )
-            make_video_pyav(
-                save_path,
-                audio_filepath=audio_filepath,
+            # frames go into the clip video as they are generated instead of being read back at the end,
+            # the clip only gets its final name once it is complete so resume doesn't mistake a partial one for done.
+            partial_output_filepath = step_output_filepath.with_suffix(".partial.mp4")
+            with VideoStreamWriter(
+                partial_output_filepath,
                 fps=fps,
-                output_filepath=step_output_filepath,
-                glob_pattern=f"*{image_file_ext}",
+                audio_filepath=audio_filepath,
                 audio_offset=audio_offset,
                 audio_duration=audio_duration,
                 sr=44100,
-            )
-
-        return make_video_pyav(
-            full_path,
+            ) as writer:
+                # frames from an interrupted run go in first.
+                resumed_frames = sorted(save_path.glob(f"*{image_file_ext}"))[:skip]
+                for frame_filepath in resumed_frames:
+                    writer.write(Image.open(frame_filepath))
+
+                if skip < num_step:
+                    self.make_clip_frames(
+                        prompt_a,
+                        prompt_b,
+                        seed_a,
+                        seed_b,
+                        num_interpolation_steps=num_step,
+                        save_path=save_path,
+                        num_inference_steps=num_inference_steps,
+                        guidance_scale=guidance_scale,
+                        eta=eta,
+                        height=height,
+                        width=width,
+                        upsample=upsample,
+                        batch_size=batch_size,
+                        skip=skip,
+                        T=get_timesteps_arr(
+                            audio_filepath,
+                            offset=audio_offset,
+                            duration=audio_duration,
+                            fps=fps,
+                            margin=margin,
+                            smooth=smooth,
+                            callback=callback,
+                            callback_steps=callback_steps,
+                        )
+                        if audio_filepath
+                        else None,
+                        writer=writer,
+                        save_frames=save_frames,
+                    )
+            os.replace(partial_output_filepath, step_output_filepath)
+
+        # the clips share their encoding settings so they can be joined without re-encoding.
+        return concat_videos(
+            [
+                Path(f"{full_path}/{name}_{i:06d}/{name}_{i:06d}.mp4")
+                for i in range(len(num_interpolation_steps))
+            ],
+            output_filepath,
             audio_filepath=audio_filepath,
-            fps=fps,
             audio_offset=audio_start_sec,
             audio_duration=sum(num_interpolation_steps) / fps,
-            output_filepath=output_filepath,
-            glob_pattern=f"**/*{image_file_ext}",
-            sr=44100,
         )
 
     def embed_text(self, text):
-        """Helper to embed some text"""
+        """Helper to embed some text, repeated prompts come from the pipeline's embedding cache"""
         with torch.autocast("cuda"):
-            text_input = self.tokenizer(
-                text,
-                padding="max_length",
-                max_length=self.tokenizer.model_max_length,
-                truncation=True,
-                return_tensors="pt",
-            )
-            with torch.no_grad():
-                embed = self.text_encoder(text_input.input_ids.to(self.device))[0]
+            embed = get_text_embeddings(self, text)
         return embed
 
     def init_noise(self, seed, noise_shape):
@@ -1062,10 +1296,8 @@ def diffuse(
 
     # classifier guidance: add the unconditional embedding
     max_length = cond_embeddings.shape[1]  # 77
-    uncond_input = pipe.tokenizer(
-        [""], padding="max_length", max_length=max_length, return_tensors="pt"
-    )
-    uncond_embeddings = pipe.text_encoder(uncond_input.input_ids.to(torch_device))[0]
+    # the unconditional embedding is the same for every frame so it comes from the cache.
+    uncond_embeddings = get_text_embeddings(pipe, [""], max_length).to(torch_device)
     text_embeddings = torch.cat([uncond_embeddings, cond_embeddings])
 
     # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
@@ -1842,15 +2074,16 @@ def txt2vid(
                             "Running GFPGAN on image ..."
                         )
                     # skip_save = True # #287 >_>
-                    torch_gc()
-                    cropped_faces, restored_faces, restored_img = server_state[
-                        "GFPGAN"
-                    ].enhance(
-                        np.array(image)[:, :, ::-1],
-                        has_aligned=False,
-                        only_center_face=False,
-                        paste_back=True,
-                    )
+                    with get_model_registry().hold("GFPGAN"):
+                        torch_gc()
+                        cropped_faces, restored_faces, restored_img = server_state[
+                            "GFPGAN"
+                        ].enhance(
+                            np.array(image)[:, :, ::-1],
+                            has_aligned=False,
+                            only_center_face=False,
+                            paste_back=True,
+                        )
                     gfpgan_sample = restored_img[:, :, ::-1]
                     gfpgan_image = Image.fromarray(gfpgan_sample)
 
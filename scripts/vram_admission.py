@@ -0,0 +1,271 @@
+# This file is part of sygil-webui (https://github.com/Sygil-Dev/sygil-webui/).
+
+# Copyright 2022 Sygil-Dev team.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+admission control for process_images: jobs reserve their estimated peak VRAM before they
+start and wait, in arrival order, while it doesn't fit next to the jobs already running.
+"""
+import collections
+import contextlib
+import threading
+
+import numpy as np
+import pynvml
+import torch
+
+
+class NvmlMemoryProbe:
+    """Reads the memory of a GPU through NVML. Peaks come from torch's allocator statistics, so
+    they are exact and don't need a polling thread."""
+
+    def __init__(self, device_index=0):
+        pynvml.nvmlInit()
+        self.handle = pynvml.nvmlDeviceGetHandleByIndex(device_index)
+        self.device = torch.device("cuda", device_index)
+        self.start_allocated = 0
+
+    def cached(self):
+        """Bytes torch's allocator keeps reserved without anything allocated in them."""
+        return torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(
+            self.device
+        )
+
+    def read(self):
+        """Returns the used and total memory of the device in bytes. What torch keeps cached
+        counts as free, the next job gets it from the allocator."""
+        info = pynvml.nvmlDeviceGetMemoryInfo(self.handle)
+        return info.used - self.cached(), info.total
+
+    def reset_peak(self):
+        torch.cuda.reset_peak_memory_stats(self.device)
+        self.start_allocated = torch.cuda.memory_allocated(self.device)
+
+    def peak(self):
+        """Bytes reserved on top of what was in use at the last reset_peak, the cache it started
+        with counts as part of the peak, like read() counts it as free."""
+        return max(
+            0, torch.cuda.max_memory_reserved(self.device) - self.start_allocated
+        )
+
+
+class FakeMemoryProbe:
+    """Memory probe without a GPU, used to exercise the admission control on CPU-only machines
+    and in tests. Jobs can simulate their memory use with allocate and free."""
+
+    def __init__(self, total, used=0):
+        self.total = total
+        self.used = used
+        self.start_used = used
+        self.peak_used = used
+        self.lock = threading.Lock()
+
+    def allocate(self, size):
+        with self.lock:
+            self.used += size
+            self.peak_used = max(self.peak_used, self.used)
+
+    def free(self, size):
+        with self.lock:
+            self.used -= size
+
+    def read(self):
+        with self.lock:
+            return self.used, self.total
+
+    def reset_peak(self):
+        with self.lock:
+            self.start_used = self.peak_used = self.used
+
+    def peak(self):
+        with self.lock:
+            return max(0, self.peak_used - self.start_used)
+
+
+class VramEstimator:
+    """Estimates the peak VRAM, in MiB, a process_images call needs on top of the loaded models.
+
+    The estimate is linear in a few features of the job: the pixels sampled and decoded, the
+    attention maps (which grow with the square of the latent size) and the post-processing
+    models it loads, plus a per sampler offset. The coefficients start from rough priors and are
+    calibrated with a ridge regression towards them from the peaks recorded by finished jobs.
+    """
+
+    features_names = ("pixels", "attention", "GFPGAN", "RealESRGAN", "LDSR")
+    prior = np.array([800.0, 1024.0, 600.0, 1200.0, 3000.0])
+
+    def __init__(self, max_samples=256, ridge=4.0):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.ridge = ridge
+        self.coefficients = self.prior.copy()
+        self.sampler_offsets = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def features(width, height, batch_size, use_GFPGAN, use_RealESRGAN, use_LDSR):
+        megapixels = width * height / (512 * 512)
+        return np.array(
+            [
+                batch_size * megapixels,
+                batch_size * megapixels**2,
+                float(bool(use_GFPGAN)),
+                float(bool(use_RealESRGAN)),
+                float(bool(use_LDSR)),
+            ]
+        )
+
+    def estimate(self, width, height, batch_size, sampler_name, **flags):
+        features = self.features(width, height, batch_size, **flags)
+        with self.lock:
+            return max(
+                0.0,
+                float(features @ self.coefficients)
+                + self.sampler_offsets.get(sampler_name, 0.0),
+            )
+
+    def record(self, width, height, batch_size, sampler_name, peak_mb, **flags):
+        """Adds the measured peak of a finished job and recalibrates the model."""
+        with self.lock:
+            self.samples.append(
+                (
+                    self.features(width, height, batch_size, **flags),
+                    sampler_name,
+                    peak_mb,
+                )
+            )
+            x = np.stack([sample[0] for sample in self.samples])
+            y = np.array([sample[2] for sample in self.samples])
+            # the ridge term pulls the coefficients towards the priors while there are few samples.
+            self.coefficients = np.linalg.solve(
+                x.T @ x + self.ridge * np.eye(len(self.prior)),
+                x.T @ y + self.ridge * self.prior,
+            )
+            residuals = collections.defaultdict(list)
+            for features, name, peak in self.samples:
+                residuals[name].append(peak - features @ self.coefficients)
+            self.sampler_offsets = {
+                name: float(np.mean(values)) for name, values in residuals.items()
+            }
+
+
+class AdmissionController:
+    """Admits jobs to the GPU based on their estimated peak VRAM.
+
+    Running jobs reserve their estimate; a job that doesn't fit in what's left waits, in arrival
+    order, until enough is released, and a batch that wouldn't fit even on an idle GPU is split into smaller
+    batches by plan_batch_size. The memory used by everything else (models, other processes)
+    is read from the probe whenever no job is running."""
+
+    def __init__(self, probe, estimator=None, margin_mb=512):
+        self.probe = probe
+        self.estimator = estimator or VramEstimator()
+        self.margin_mb = margin_mb
+        self.reservations = {}
+        self.waiting = collections.deque()
+        self.overlapped = set()
+        self.idle_used_mb = None
+        self.total_mb = None
+        self.condition = threading.Condition()
+
+    def _refresh_idle(self):
+        used, total = self.probe.read()
+        self.idle_used_mb = used / 1_048_576
+        self.total_mb = total / 1_048_576
+
+    def capacity(self):
+        """MiB a job can use when it runs alone."""
+        with self.condition:
+            if self.total_mb is None or not self.reservations:
+                self._refresh_idle()
+            return self.total_mb - self.idle_used_mb - self.margin_mb
+
+    def available(self):
+        """MiB not reserved by running jobs. Must be called with the condition held."""
+        return (
+            self.total_mb
+            - self.idle_used_mb
+            - self.margin_mb
+            - sum(self.reservations.values())
+        )
+
+    def plan_batch_size(self, width, height, batch_size, sampler_name, **flags):
+        """Largest divisor of batch_size whose estimate fits on an idle GPU, at least 1."""
+        capacity = self.capacity()
+        for size in range(batch_size, 0, -1):
+            if batch_size % size:
+                continue
+            if (
+                self.estimator.estimate(width, height, size, sampler_name, **flags)
+                <= capacity
+            ):
+                return size
+        return 1
+
+    @contextlib.contextmanager
+    def admit(self, estimate_mb):
+        """Waits until estimate_mb fits and reserves it while the block runs. Yields a function
+        returning the peak MiB measured for the job, or None if other jobs ran at the same time.
+        """
+        token = object()
+        with self.condition:
+            if not self.reservations:
+                self._refresh_idle()
+            # jobs are admitted in arrival order so big jobs aren't starved by smaller ones, and a
+            # job always runs when the GPU is idle, even if its estimate doesn't fit.
+            self.waiting.append(token)
+            try:
+                while self.waiting[0] is not token or (
+                    self.reservations and estimate_mb > self.available()
+                ):
+                    self.condition.wait()
+                    if not self.reservations:
+                        self._refresh_idle()
+            except BaseException:
+                # the jobs behind this one would wait for it forever.
+                self.waiting.remove(token)
+                self.condition.notify_all()
+                raise
+            self.waiting.popleft()
+            self.condition.notify_all()
+            if self.reservations:
+                self.overlapped.update(self.reservations)
+                self.overlapped.add(token)
+            else:
+                self.probe.reset_peak()
+            self.reservations[token] = estimate_mb
+
+        def measured_peak():
+            with self.condition:
+                if token in self.overlapped:
+                    return None
+            return self.probe.peak() / 1_048_576
+
+        try:
+            yield measured_peak
+        finally:
+            with self.condition:
+                del self.reservations[token]
+                self.overlapped.discard(token)
+                self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "running": len(self.reservations),
+                "waiting": len(self.waiting),
+                "reserved_mb": round(sum(self.reservations.values())),
+                "idle_used_mb": round(self.idle_used_mb or 0),
+                "total_mb": round(self.total_mb or 0),
+                "samples": len(self.estimator.samples),
+            }
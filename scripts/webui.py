@@ -135,6 +135,11 @@ parser.add_argument(
     action="store_true",
     help="alternative optimization mode that does not save as much VRAM but runs siginificantly faster",
 )
+parser.add_argument(
+    "--optimized-prefetch",
+    action="store_true",
+    help="in optimized mode, copy the next half of the model to the GPU while the current one runs; faster, but both halves must fit",
+)
 parser.add_argument(
     "--optimized",
     action="store_true",
@@ -147,6 +152,25 @@ parser.add_argument(
     help="dir to write scn2img results to (overrides --outdir)",
     default=None,
 )
+parser.add_argument(
+    "--scn2img_cache_mb",
+    type=int,
+    help="memory budget in MiB for scn2img's cache of rendered scene nodes",
+    default=1024,
+)
+parser.add_argument(
+    "--scn2img_disk_cache",
+    type=str,
+    nargs="?",
+    help="dir to persist scn2img's rendered scene nodes to, so unchanged parts of a scene are reused across restarts",
+    default=None,
+)
+parser.add_argument(
+    "--gobig_batch_size",
+    type=int,
+    help="number of tiles GoBig refines at once, raise it if you have the VRAM to spare",
+    default=2,
+)
 parser.add_argument(
     "--outdir_img2img",
     type=str,
@@ -352,7 +376,6 @@ import yaml
 import copy
 from typing import List, Union, Callable
 from pathlib import Path
-from collections import namedtuple
 from functools import partial
 
 # tell the user which GPU the code is actually using
@@ -381,6 +404,7 @@ from torch import autocast
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.util import instantiate_from_config
+from optimizedSD.offload import get_offloader
 
 
 # add global options to models
@@ -653,16 +677,21 @@ class KDiffusionSampler:
 
 
 def create_random_tensors(shape, seeds):
-    xs = []
-    for seed in seeds:
-        torch.manual_seed(seed)
-
-        # randn results depend on device; gpu and cpu get different results for same seed;
-        # the way I see it, it's better to do this on CPU, so that everyone gets same result;
-        # but the original script had it like this so i do not dare change it for now because
-        # it will break everyone's seeds.
-        xs.append(torch.randn(shape, device=device))
-    x = torch.stack(xs)
+    # randn results depend on device; gpu and cpu get different results for same seed;
+    # the way I see it, it's better to do this on CPU, so that everyone gets same result;
+    # but the original script had it like this so i do not dare change it for now because
+    # it will break everyone's seeds.
+    x = torch.empty((len(seeds), *shape), device=device)
+    for i, seed in enumerate(seeds):
+        if i == len(seeds) - 1:
+            # the last seed goes through the global RNG so it ends up in the same state as before,
+            # the samplers that add noise while sampling depend on it.
+            torch.manual_seed(seed)
+            x[i].normal_()
+        else:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(seed)
+            x[i].normal_(generator=generator)
     return x
 
 
@@ -880,6 +909,7 @@ def load_SD_model():
         model.cuda()
         model.eval()
         model.turbo = opt.optimized_turbo
+        model.prefetch = opt.optimized_prefetch
 
         modelCS = instantiate_from_config(config.modelCondStage)
         _, _ = modelCS.load_state_dict(sd, strict=False)
@@ -1580,7 +1610,7 @@ def process_images(
                     print(f"Current prompt: {p}")
 
             if opt.optimized:
-                modelCS.to(device)
+                get_offloader(device).acquire(modelCS)
             uc = (model if not opt.optimized else modelCS).get_learned_conditioning(
                 len(prompts) * [negprompt]
             )
@@ -1615,10 +1645,7 @@ def process_images(
             shape = [opt_C, height // opt_f, width // opt_f]
 
             if opt.optimized:
-                mem = torch.cuda.memory_allocated() / 1e6
-                modelCS.to("cpu")
-                while torch.cuda.memory_allocated() / 1e6 >= mem:
-                    time.sleep(1)
+                get_offloader(device).offload(modelCS)
 
             cur_variant_amount = variant_amount
             if variant_amount == 0.0:
@@ -1743,21 +1770,23 @@ def process_images(
                         raise StopIteration()
 
             try:
-                samples_ddim = func_sample(
-                    init_data=init_data,
-                    x=x,
-                    conditioning=c,
-                    unconditional_conditioning=uc,
-                    sampler_name=sampler_name,
-                    img_callback=sample_iteration_callback,
-                )
+                # the optimized unet shares its split buffers between the steps of this run only.
+                with getattr(model, "reuse_split_buffers", nullcontext)():
+                    samples_ddim = func_sample(
+                        init_data=init_data,
+                        x=x,
+                        conditioning=c,
+                        unconditional_conditioning=uc,
+                        sampler_name=sampler_name,
+                        img_callback=sample_iteration_callback,
+                    )
             except StopIteration:
                 print("Skipping iteration")
                 job_info.job_status = "Skipping iteration"
                 continue
 
             if opt.optimized:
-                modelFS.to(device)
+                get_offloader(device).acquire(modelFS)
 
             for i in range(len(samples_ddim)):
                 x_samples_ddim = (
@@ -2084,10 +2113,7 @@ def process_images(
                         )
 
             if opt.optimized:
-                mem = torch.cuda.memory_allocated() / 1e6
-                modelFS.to("cpu")
-                while torch.cuda.memory_allocated() / 1e6 >= mem:
-                    time.sleep(1)
+                get_offloader(device).offload(modelFS)
 
         if (prompt_matrix or not skip_grid) and not do_not_save_grid:
             grid = None
@@ -2528,7 +2554,7 @@ def img2img(
             mask = mask[None].transpose(0, 1, 2, 3)
             mask = torch.from_numpy(mask).to(device)
         if opt.optimized:
-            modelFS.to(device)
+            get_offloader(device).acquire(modelFS)
 
         # let's try and find where init_image is 0's
         # shape is probably (3,width,height)?
@@ -2611,10 +2637,7 @@ def img2img(
         )  # move to latent space
 
         if opt.optimized:
-            mem = torch.cuda.memory_allocated() / 1e6
-            modelFS.to("cpu")
-            while torch.cuda.memory_allocated() / 1e6 >= mem:
-                time.sleep(1)
+            get_offloader(device).offload(modelFS)
 
         return (
             init_latent,
@@ -2886,6 +2909,204 @@ def slerp(device, t, v0: torch.Tensor, v1: torch.Tensor, DOT_THRESHOLD=0.9995):
     return v2
 
 
+def get_tile_starts(size, tile, overlap):
+    """Offsets of the tiles covering `size` pixels with at least `overlap` pixels shared between
+    neighbours, spread evenly over the image and aligned to the latent grid."""
+    if size <= tile:
+        return [0]
+    count = math.ceil((size - overlap) / (tile - overlap))
+    count = max(count, 2)
+    return [
+        round(i * (size - tile) / (count - 1) / opt_f) * opt_f for i in range(count)
+    ]
+
+
+def get_tile_weights(tile_w, tile_h, overlap):
+    """Feathered blending weights of a tile, ramping up over `overlap` pixels from each edge."""
+
+    def ramp(n):
+        edge = np.minimum(np.arange(n), np.arange(n)[::-1]) + 1.0
+        return np.clip(edge / (overlap + 1.0), 0.0, 1.0)
+
+    return (ramp(tile_h)[:, None] * ramp(tile_w)[None, :])[..., None].astype(np.float32)
+
+
+k_samplers = {
+    "k_dpm_2_a": "dpm_2_ancestral",
+    "k_dpm_2": "dpm_2",
+    "k_euler_a": "euler_ancestral",
+    "k_euler": "euler",
+    "k_heun": "heun",
+    "k_lms": "lms",
+}
+
+
+tiled_samplers = {}
+
+
+def get_tiled_sampler(sampler_name):
+    """Samplers used by refine_tiled, made once per model instead of once per call."""
+    key = (id(model), sampler_name)
+    if key not in tiled_samplers:
+        tiled_samplers.clear()
+        if sampler_name == "DDIM":
+            tiled_samplers[key] = DDIMSampler(model)
+        elif sampler_name in k_samplers:
+            tiled_samplers[key] = KDiffusionSampler(model, k_samplers[sampler_name])
+        else:
+            raise Exception("Unknown sampler: " + sampler_name)
+    return tiled_samplers[key]
+
+
+def refine_tiled(
+    image,
+    prompt,
+    sampler_name,
+    steps,
+    denoising_strength,
+    cfg_scale,
+    seed,
+    tile_w=512,
+    tile_h=512,
+    overlap=64,
+    batch_size=2,
+    normalize_prompt_weights=True,
+):
+    """Runs img2img over a large image in overlapping tiles and blends them back together.
+
+    The tiles are encoded, sampled and decoded `batch_size` at a time with the prompt encoded
+    once, and their seams are blended with feathered weights, so the memory used only depends
+    on the tile size and batch size and the time grows linearly with the number of tiles.
+    The prompt takes a `###` negative prompt and `:weight` sub-prompts like process_images.
+    """
+    assert 0.0 <= denoising_strength <= 1.0, "can only work with strength in [0.0, 1.0]"
+    tile_w = max(opt_f, tile_w // opt_f * opt_f)
+    tile_h = max(opt_f, tile_h // opt_f * opt_f)
+    overlap = min(overlap, tile_w // 2, tile_h // 2)
+
+    negprompt = ""
+    if "###" in prompt:
+        prompt, negprompt = prompt.split("###", 1)
+        prompt = prompt.strip()
+        negprompt = negprompt.strip()
+
+    image = image.convert("RGB")
+    width, height = image.size
+    # pad the image to the latent grid and to at least one tile, the padding is cropped at the end.
+    padded_w = max(tile_w, math.ceil(width / opt_f) * opt_f)
+    padded_h = max(tile_h, math.ceil(height / opt_f) * opt_f)
+    pixels = np.array(image).astype(np.float32) / 255.0
+    pixels = np.pad(
+        pixels, ((0, padded_h - height), (0, padded_w - width), (0, 0)), mode="edge"
+    )
+
+    tiles = [
+        (x, y)
+        for y in get_tile_starts(padded_h, tile_h, overlap)
+        for x in get_tile_starts(padded_w, tile_w, overlap)
+    ]
+    weights = get_tile_weights(tile_w, tile_h, overlap)
+    canvas = np.zeros((padded_h, padded_w, 3), dtype=np.float32)
+    canvas_weights = np.zeros((padded_h, padded_w, 1), dtype=np.float32)
+
+    sampler = get_tiled_sampler(sampler_name)
+    t_enc = int(denoising_strength * steps)
+    batch_count = math.ceil(len(tiles) / batch_size)
+    print(
+        f"GoBig upscaling will process a total of {len(tiles)} tiles of {tile_w}x{tile_h} in a total of {batch_count} batches of {batch_size}."
+    )
+
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+    with torch.no_grad(), precision_scope("cuda"), (
+        model.ema_scope() if not opt.optimized else nullcontext()
+    ):
+        if opt.optimized:
+            get_offloader(device).acquire(modelCS)
+        cs_model = model if not opt.optimized else modelCS
+        uc = cs_model.get_learned_conditioning([negprompt])
+        weighted_subprompts = split_weighted_subprompts(
+            prompt, normalize_prompt_weights
+        )
+        if len(weighted_subprompts) > 1:
+            c = torch.zeros_like(uc)
+            for subprompt, weight in weighted_subprompts:
+                # note if alpha negative, it functions same as torch.sub
+                c = torch.add(
+                    c, cs_model.get_learned_conditioning(subprompt), alpha=weight
+                )
+        else:
+            c = cs_model.get_learned_conditioning([prompt])
+        fs_model = model if not opt.optimized else modelFS
+        if opt.optimized:
+            get_offloader(device).offload(modelCS)
+
+        for i in range(batch_count):
+            batch = tiles[i * batch_size : (i + 1) * batch_size]
+            print(f"GoBig batch {i + 1}/{batch_count}")
+            init_image = torch.from_numpy(
+                np.stack([pixels[y : y + tile_h, x : x + tile_w] for x, y in batch])
+            )
+            init_image = 2.0 * init_image.permute(0, 3, 1, 2).to(device) - 1.0
+            # the first stage model is only on the gpu while it encodes and decodes.
+            if opt.optimized:
+                get_offloader(device).acquire(modelFS)
+            x0 = fs_model.get_first_stage_encoding(
+                fs_model.encode_first_stage(init_image)
+            )
+            if opt.optimized:
+                get_offloader(device).offload(modelFS)
+            x = create_random_tensors(
+                [opt_C, tile_h // opt_f, tile_w // opt_f],
+                seeds=[seed + i * batch_size + k for k in range(len(batch))],
+            )
+            conditioning = c.expand(len(batch), -1, -1)
+            unconditional_conditioning = uc.expand(len(batch), -1, -1)
+
+            if t_enc == 0:
+                samples = x0
+            elif sampler_name != "DDIM":
+                sigmas = sampler.model_wrap.get_sigmas(steps)
+                xi = x0 + x * sigmas[steps - t_enc - 1]
+                samples = K.sampling.__dict__[f"sample_{sampler.get_sampler_name()}"](
+                    CFGDenoiser(sampler.model_wrap),
+                    xi,
+                    sigmas[steps - t_enc - 1 :],
+                    extra_args={
+                        "cond": conditioning,
+                        "uncond": unconditional_conditioning,
+                        "cond_scale": cfg_scale,
+                    },
+                    disable=False,
+                )
+            else:
+                sampler.make_schedule(ddim_num_steps=steps, ddim_eta=0.0, verbose=False)
+                z_enc = sampler.stochastic_encode(
+                    x0, torch.tensor([t_enc] * len(batch)).to(device)
+                )
+                samples = sampler.decode(
+                    z_enc,
+                    conditioning,
+                    t_enc,
+                    unconditional_guidance_scale=cfg_scale,
+                    unconditional_conditioning=unconditional_conditioning,
+                )
+
+            if opt.optimized:
+                get_offloader(device).acquire(modelFS)
+            decoded = fs_model.decode_first_stage(samples)
+            if opt.optimized:
+                get_offloader(device).offload(modelFS)
+            decoded = torch.clamp((decoded + 1.0) / 2.0, min=0.0, max=1.0)
+            decoded = decoded.permute(0, 2, 3, 1).float().cpu().numpy()
+            for (x, y), tile in zip(batch, decoded):
+                canvas[y : y + tile_h, x : x + tile_w] += tile * weights
+                canvas_weights[y : y + tile_h, x : x + tile_w] += weights
+
+    combined = canvas / canvas_weights
+    combined = (combined[:height, :width] * 255.0).round().astype(np.uint8)
+    return Image.fromarray(combined)
+
+
 def imgproc(
     image,
     image_batch,
@@ -2904,6 +3125,7 @@ def imgproc(
     imgproc_ldsr_steps,
     imgproc_ldsr_pre_downSample,
     imgproc_ldsr_post_downSample,
+    imgproc_tile_overlap=64,
 ):
     outpath = opt.outdir_imglab or opt.outdir or "outputs/imglab-samples"
     output = []
@@ -2955,270 +3177,20 @@ def imgproc(
             # downscale to 1/2 size
             result = result.resize((result.width // 2, result.height // 2), LANCZOS)
 
-        # make sense of parameters
-        n_iter = 1
-        batch_size = 1
-        seed = seed_to_int(imgproc_seed)
-        ddim_steps = int(imgproc_steps)
-        resize_mode = 0  # need to add resize mode to form, or infer correct resolution from file name
-        width = int(imgproc_width)
-        height = int(imgproc_height)
-        cfg_scale = float(imgproc_cfg)
-        denoising_strength = float(imgproc_denoising)
-        skip_save = True
-        skip_grid = True
-        prompt = imgproc_prompt
-        t_enc = int(denoising_strength * ddim_steps)
-        sampler_name = imgproc_sampling
-
-        if sampler_name == "DDIM":
-            sampler = DDIMSampler(model)
-        elif sampler_name == "k_dpm_2_a":
-            sampler = KDiffusionSampler(model, "dpm_2_ancestral")
-        elif sampler_name == "k_dpm_2":
-            sampler = KDiffusionSampler(model, "dpm_2")
-        elif sampler_name == "k_euler_a":
-            sampler = KDiffusionSampler(model, "euler_ancestral")
-        elif sampler_name == "k_euler":
-            sampler = KDiffusionSampler(model, "euler")
-        elif sampler_name == "k_heun":
-            sampler = KDiffusionSampler(model, "heun")
-        elif sampler_name == "k_lms":
-            sampler = KDiffusionSampler(model, "lms")
-        else:
-            raise Exception("Unknown sampler: " + sampler_name)
-            pass
-        init_img = result
-        mask_restore = False
-        assert (
-            0.0 <= denoising_strength <= 1.0
-        ), "can only work with strength in [0.0, 1.0]"
-
-        def init():
-            image = init_img.convert("RGB")
-            image = resize_image(resize_mode, image, width, height)
-            image = np.array(image).astype(np.float32) / 255.0
-            image = image[None].transpose(0, 3, 1, 2)
-            image = torch.from_numpy(image)
-
-            if opt.optimized:
-                modelFS.to(device)
-
-            init_image = 2.0 * image - 1.0
-            init_image = init_image.to(device)
-            init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
-            init_latent = (
-                model if not opt.optimized else modelFS
-            ).get_first_stage_encoding(
-                (model if not opt.optimized else modelFS).encode_first_stage(init_image)
-            )  # move to latent space
-
-            if opt.optimized:
-                mem = torch.cuda.memory_allocated() / 1e6
-                modelFS.to("cpu")
-                while torch.cuda.memory_allocated() / 1e6 >= mem:
-                    time.sleep(1)
-
-            return (init_latent,)
-
-        def sample(
-            init_data,
-            x,
-            conditioning,
-            unconditional_conditioning,
-            sampler_name,
-            img_callback: Callable = None,
-        ):
-            if sampler_name != "DDIM":
-                (x0,) = init_data
-
-                sigmas = sampler.model_wrap.get_sigmas(ddim_steps)
-                noise = x * sigmas[ddim_steps - t_enc - 1]
-
-                xi = x0 + noise
-                sigma_sched = sigmas[ddim_steps - t_enc - 1 :]
-                model_wrap_cfg = CFGDenoiser(sampler.model_wrap)
-                samples_ddim = K.sampling.__dict__[
-                    f"sample_{sampler.get_sampler_name()}"
-                ](
-                    model_wrap_cfg,
-                    xi,
-                    sigma_sched,
-                    extra_args={
-                        "cond": conditioning,
-                        "uncond": unconditional_conditioning,
-                        "cond_scale": cfg_scale,
-                    },
-                    disable=False,
-                    callback=partial(
-                        KDiffusionSampler.img_callback_wrapper, img_callback
-                    ),
-                )
-            else:
-                (x0,) = init_data
-                sampler.make_schedule(
-                    ddim_num_steps=ddim_steps, ddim_eta=0.0, verbose=False
-                )
-                z_enc = sampler.stochastic_encode(
-                    x0, torch.tensor([t_enc] * batch_size).to(device)
-                )
-                # decode it
-                samples_ddim = sampler.decode(
-                    z_enc,
-                    conditioning,
-                    t_enc,
-                    unconditional_guidance_scale=cfg_scale,
-                    unconditional_conditioning=unconditional_conditioning,
-                )
-            return samples_ddim
-
-        def split_grid(image, tile_w=512, tile_h=512, overlap=64):
-            Grid = namedtuple(
-                "Grid", ["tiles", "tile_w", "tile_h", "image_w", "image_h", "overlap"]
-            )
-            w = image.width
-            h = image.height
-
-            now = tile_w - overlap  # non-overlap width
-            noh = tile_h - overlap
-
-            cols = math.ceil((w - overlap) / now)
-            rows = math.ceil((h - overlap) / noh)
-
-            grid = Grid([], tile_w, tile_h, w, h, overlap)
-            for row in range(rows):
-                row_images = []
-
-                y = row * noh
-
-                if y + tile_h >= h:
-                    y = h - tile_h
-
-                for col in range(cols):
-                    x = col * now
-
-                    if x + tile_w >= w:
-                        x = w - tile_w
-
-                    tile = image.crop((x, y, x + tile_w, y + tile_h))
-
-                    row_images.append([x, tile_w, tile])
-
-                grid.tiles.append([y, tile_h, row_images])
-
-            return grid
-
-        def combine_grid(grid):
-            def make_mask_image(r):
-                r = r * 255 / grid.overlap
-                r = r.astype(np.uint8)
-                return Image.fromarray(r, "L")
-
-            mask_w = make_mask_image(
-                np.arange(grid.overlap, dtype=np.float)
-                .reshape((1, grid.overlap))
-                .repeat(grid.tile_h, axis=0)
-            )
-            mask_h = make_mask_image(
-                np.arange(grid.overlap, dtype=np.float)
-                .reshape((grid.overlap, 1))
-                .repeat(grid.image_w, axis=1)
-            )
-
-            combined_image = Image.new("RGB", (grid.image_w, grid.image_h))
-            for y, h, row in grid.tiles:
-                combined_row = Image.new("RGB", (grid.image_w, h))
-                for x, w, tile in row:
-                    if x == 0:
-                        combined_row.paste(tile, (0, 0))
-                        continue
-
-                    combined_row.paste(
-                        tile.crop((0, 0, grid.overlap, h)), (x, 0), mask=mask_w
-                    )
-                    combined_row.paste(
-                        tile.crop((grid.overlap, 0, w, h)), (x + grid.overlap, 0)
-                    )
-
-                if y == 0:
-                    combined_image.paste(combined_row, (0, 0))
-                    continue
-
-                combined_image.paste(
-                    combined_row.crop((0, 0, combined_row.width, grid.overlap)),
-                    (0, y),
-                    mask=mask_h,
-                )
-                combined_image.paste(
-                    combined_row.crop((0, grid.overlap, combined_row.width, h)),
-                    (0, y + grid.overlap),
-                )
-
-            return combined_image
-
-        grid = split_grid(result, tile_w=width, tile_h=height, overlap=64)
-        work = []
-        work_results = []
-
-        for y, h, row in grid.tiles:
-            for tiledata in row:
-                work.append(tiledata[2])
-        batch_count = math.ceil(len(work) / batch_size)
-        print(
-            f"GoBig upscaling will process a total of {len(work)} images tiled as {len(grid.tiles[0][2])}x{len(grid.tiles)} in a total of {batch_count} batches."
+        combined_image = refine_tiled(
+            result,
+            imgproc_prompt,
+            imgproc_sampling,
+            int(imgproc_steps),
+            float(imgproc_denoising),
+            float(imgproc_cfg),
+            seed_to_int(imgproc_seed),
+            tile_w=int(imgproc_width),
+            tile_h=int(imgproc_height),
+            overlap=int(imgproc_tile_overlap),
+            batch_size=opt.gobig_batch_size,
+            normalize_prompt_weights=False,
         )
-        for i in range(batch_count):
-            init_img = work[i * batch_size : (i + 1) * batch_size][0]
-            output_images, seed, info, stats = process_images(
-                outpath=outpath,
-                func_init=init,
-                func_sample=sample,
-                prompt=prompt,
-                seed=seed,
-                sampler_name=sampler_name,
-                skip_save=skip_save,
-                skip_grid=skip_grid,
-                batch_size=batch_size,
-                n_iter=n_iter,
-                steps=ddim_steps,
-                cfg_scale=cfg_scale,
-                width=width,
-                height=height,
-                prompt_matrix=None,
-                filter_nsfw=False,
-                use_GFPGAN=None,
-                use_RealESRGAN=None,
-                realesrgan_model_name=None,
-                fp=None,
-                normalize_prompt_weights=False,
-                init_img=init_img,
-                init_mask=None,
-                keep_mask=False,
-                mask_blur_strength=None,
-                denoising_strength=denoising_strength,
-                mask_restore=mask_restore,
-                resize_mode=resize_mode,
-                uses_loopback=False,
-                sort_samples=True,
-                write_info_files=True,
-                write_sample_info_to_log_file=False,
-                jpg_sample=False,
-                imgProcessorTask=True,
-            )
-            # if initial_seed is None:
-            #    initial_seed = seed
-            # seed = seed + 1
-
-            work_results.append(output_images[0])
-        image_index = 0
-        for y, h, row in grid.tiles:
-            for tiledata in row:
-                tiledata[2] = work_results[image_index]
-                image_index += 1
-
-        combined_image = combine_grid(grid)
-        len(os.listdir(outpath)) - 1
-        del sampler
 
         torch.cuda.empty_cache()
         ImageMetadata.set_on_image(combined_image, metadata)
@@ -3601,6 +3573,7 @@ imgproc_defaults = {
     "height": 512,
     "width": 512,
     "denoising_strength": 0.30,
+    "tile_overlap": 64,
 }
 imgproc_mode_toggles = ["Fix Faces", "Upscale"]
 
@@ -14,6 +14,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+from lazy_imports import get_import_profiler, measure_startup, report_startup
+
+# the profiler has to be running before sd_utils and the rest are imported.
+if "--profile-startup" in sys.argv:
+    get_import_profiler()
+
 # base webui import and utils.
 # import streamlit as st
 
@@ -48,7 +55,8 @@ from custom_components import draggable_number_input
 # end of imports
 # ---------------------------------------------------------------------------------------------------------------
 
-load_configs()
+with measure_startup("load_configs()"):
+    load_configs()
 
 help = """
 A double dash (`--`) is used to separate streamlit arguments from app arguments.
@@ -149,6 +157,12 @@ parser.add_argument(
     default=0,
     help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen",
 )
+parser.add_argument(
+    "--profile-startup",
+    action="store_true",
+    default=False,
+    help="Print how long the imports and the first page render took once the UI is up.",
+)
 opt = parser.parse_args()
 
 with server_state_lock["bridge"]:
@@ -344,7 +358,11 @@ if __name__ == "__main__":
     # quiesce_logger(opt.quiet)
 
     if not opt.headless:
-        layout()
+        with measure_startup("first layout()"):
+            layout()
+
+    if opt.profile_startup:
+        report_startup()
 
     with server_state_lock["bridge"]:
         if server_state["bridge"]:
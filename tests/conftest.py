@@ -0,0 +1,6 @@
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the webui scripts import each other as top level modules, like when they are run.
+sys.path[:0] = [root, os.path.join(root, "scripts")]
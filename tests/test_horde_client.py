@@ -0,0 +1,323 @@
+"""
+the horde client and the bridge pipeline against a stub horde server running in a thread: the
+circuit breaker lets a single trial through when half-open, jobs are prefetched, batched by
+their settings and uploaded.
+"""
+import collections
+import concurrent.futures
+import http.server
+import json
+import queue
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from horde_client import (
+    BridgeJob,
+    CircuitBreaker,
+    HordeClient,
+    log_upload_errors,
+    next_batch,
+    prefetch_jobs,
+    upload_generation,
+)
+from logger import logger
+
+
+class StubHorde(http.server.ThreadingHTTPServer):
+    """Answers each endpoint with the next (status, json) of its script, or the last one once
+    the script runs out, and keeps the payloads it was sent."""
+
+    def __init__(self, scripts):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.scripts = {endpoint: list(script) for endpoint, script in scripts.items()}
+        self.received = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def answer(self, endpoint, payload):
+        with self.lock:
+            self.received[endpoint].append(payload)
+            script = self.scripts[endpoint]
+            return script.pop(0) if len(script) > 1 else script[0]
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        status, data = self.server.answer(self.path, payload)
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def horde():
+    servers = []
+
+    def start(scripts):
+        server = StubHorde(scripts)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def client_for(server, **kwargs):
+    kwargs = dict(backoff_base=0.001, backoff_max=0.01, timeout=5, **kwargs)
+    return HordeClient(server.url, "0000000000", **kwargs)
+
+
+def job(id, width=512, seed="1"):
+    payload = {
+        "prompt": f"prompt {id}",
+        "width": width,
+        "height": 512,
+        "sampler_name": "k_euler",
+        "ddim_steps": 20,
+        "cfg_scale": 7.5,
+        "seed": seed,
+    }
+    return 200, {"id": id, "payload": payload}
+
+
+def start_prefetcher(client, jobs, slots, stop, censorlist=()):
+    prefetcher = threading.Thread(
+        target=prefetch_jobs,
+        args=(client, {"name": "test"}, jobs, slots, stop, 0.05, False, False),
+        kwargs={"horde_censorlist": list(censorlist), "seed_to_int": int},
+        daemon=True,
+    )
+    prefetcher.start()
+    return prefetcher
+
+
+def waiters(breaker, count):
+    """Starts count threads blocked in breaker.wait(), returns the list they append to once let
+    through and the threads."""
+    passed = []
+    threads = [
+        threading.Thread(target=lambda: passed.append(breaker.wait()), daemon=True)
+        for _ in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    return passed, threads
+
+
+def test_breaker_opens_after_threshold_failures():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.opened_at is None
+    breaker.record_failure()
+    assert breaker.opened_at is not None
+    breaker.record_success()
+    assert breaker.opened_at is None and breaker.failures == 0
+
+
+def test_half_open_breaker_lets_a_single_trial_through():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.1)
+    breaker.record_failure()
+    passed, threads = waiters(breaker, 4)
+
+    time.sleep(0.3)
+    assert len(passed) == 1
+
+    breaker.record_success()
+    for thread in threads:
+        thread.join(1)
+    assert len(passed) == 4
+
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.2)
+    breaker.record_failure()
+    breaker.wait()
+    passed, threads = waiters(breaker, 2)
+
+    breaker.record_failure()
+    opened_at = breaker.opened_at
+    time.sleep(0.1)
+    assert passed == []
+    # only one of them makes the next trial once the breaker half-opens again.
+    time.sleep(0.3)
+    assert len(passed) == 1
+    assert breaker.opened_at == opened_at
+
+    breaker.record_success()
+    for thread in threads:
+        thread.join(1)
+    assert len(passed) == 2
+
+
+def test_client_reports_unexpected_errors_to_the_breaker():
+    breaker_reset = 0.1
+    client = HordeClient(
+        "http://127.0.0.1:1", "0000000000", breaker_reset=breaker_reset
+    )
+    client.breaker.record_failure()
+    client.breaker.opened_at = time.monotonic() - breaker_reset
+
+    # a url requests can't even send is neither a connection error nor a timeout.
+    client.horde_url = "nonsense://"
+    with pytest.raises(Exception):
+        client.pop({})
+    assert not client.breaker.trial
+    assert client.breaker.opened_at is not None
+
+
+def test_client_opens_the_breaker_on_server_errors(horde):
+    server = horde(
+        {"/api/v2/generate/pop": [(500, {"message": "down"})] * 2 + [job("a")]}
+    )
+    client = client_for(server, breaker_threshold=2, breaker_reset=0.2)
+
+    assert client.pop({}) is None
+    assert client.pop({}) is None
+    assert client.breaker.opened_at is not None
+
+    start = time.monotonic()
+    assert client.pop({})["id"] == "a"
+    assert time.monotonic() - start >= 0.1
+    assert client.breaker.opened_at is None
+    assert client.stats()["/api/v2/generate/pop"]["count"] == 3
+
+
+def test_client_treats_rate_limiting_and_stale_jobs(horde):
+    server = horde(
+        {
+            "/api/v2/generate/pop": [(429, {"message": "slow down"}), job("a")],
+            "/api/v2/generate/submit": [(404, {"message": "stale"})],
+        }
+    )
+    client = client_for(server, breaker_threshold=1)
+
+    assert client.pop({}) is None
+    # rate limiting isn't a failure of the server.
+    assert client.breaker.opened_at is None
+    assert client.pop({})["id"] == "a"
+    assert client.submit({"id": "a"}) is True
+
+
+def test_pipeline_batches_compatible_jobs_and_uploads_them(horde):
+    server = horde(
+        {
+            "/api/v2/generate/pop": [
+                job("a"),
+                job("b", width=768),
+                job("c"),
+                job("d", seed="4"),
+                (200, {"id": None, "skipped": {}}),
+            ],
+            "/api/v2/generate/submit": [(200, {"reward": 1.0})],
+        }
+    )
+    client = client_for(server)
+    jobs = queue.Queue()
+    slots = threading.BoundedSemaphore(4)
+    stop = threading.Event()
+    prefetcher = start_prefetcher(client, jobs, slots, stop)
+
+    # all four jobs are popped while nothing is sampled, then the slots run out.
+    deadline = time.monotonic() + 5
+    while jobs.qsize() < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert jobs.qsize() == 4
+
+    pending = collections.deque()
+    batches = []
+    while len(batches) < 3:
+        batch = next_batch(jobs, pending, 2, prefetcher)
+        for _ in batch:
+            slots.release()
+        batches.append(batch)
+    stop.set()
+    prefetcher.join(1)
+
+    assert [[item.id for item in batch] for batch in batches] == [
+        ["a", "c"],
+        ["b"],
+        ["d"],
+    ]
+    assert not pending and jobs.empty()
+
+    image = Image.new("RGB", (8, 8))
+    for batch in batches:
+        for item in batch:
+            upload_generation(client, item, image, "key", 512)
+    submitted = server.received["/api/v2/generate/submit"]
+    assert [(item["id"], item["seed"]) for item in submitted] == [
+        ("a", 1),
+        ("c", 1),
+        ("b", 1),
+        ("d", 4),
+    ]
+    assert all(item["generation"] for item in submitted)
+
+
+def test_prefetcher_survives_bad_replies(horde):
+    server = horde(
+        {
+            "/api/v2/generate/pop": [
+                # the censor list is checked against the prompt this payload lacks.
+                (200, {"id": "bad", "payload": {"width": 512}}),
+                job("a"),
+                (200, {"id": None}),
+            ]
+        }
+    )
+    jobs = queue.Queue()
+    stop = threading.Event()
+    prefetcher = start_prefetcher(
+        client_for(server), jobs, threading.BoundedSemaphore(2), stop, ["nsfw"]
+    )
+
+    try:
+        assert jobs.get(timeout=5).id == "a"
+        assert prefetcher.is_alive()
+    finally:
+        stop.set()
+        prefetcher.join(1)
+
+
+def test_next_batch_raises_once_the_prefetcher_is_gone():
+    prefetcher = threading.Thread(target=lambda: None)
+    prefetcher.start()
+    prefetcher.join()
+
+    with pytest.raises(RuntimeError, match="prefetch"):
+        next_batch(
+            queue.Queue(), collections.deque(), 1, prefetcher, poll_interval=0.01
+        )
+
+
+def test_failed_uploads_are_logged():
+    messages = []
+    sink = logger.add(messages.append, level="ERROR")
+    try:
+        future = concurrent.futures.Future()
+        future.add_done_callback(
+            log_upload_errors(BridgeJob("x", job("x")[1]["payload"], 1))
+        )
+        future.set_exception(KeyError("reward"))
+    finally:
+        logger.remove(sink)
+
+    assert len(messages) == 1
+    assert "generation id x" in messages[0] and "KeyError" in messages[0]
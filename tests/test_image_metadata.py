@@ -0,0 +1,42 @@
+"""
+ImageMetadata round trip through the EXIF UserComment tag of the JPEG and WebP images the
+webui saves.
+"""
+import io
+
+import pytest
+from PIL import Image
+
+from frontend.image_metadata import ImageMetadata, metadata_to_exif
+
+pytest.importorskip("piexif")
+
+
+def saved(image, format, **kwargs):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **kwargs)
+    buffer.seek(0)
+    return Image.open(buffer)
+
+
+@pytest.mark.parametrize("format", ["JPEG", "WEBP"])
+def test_metadata_survives_saving_as(format):
+    metadata = ImageMetadata(
+        prompt="a painting of a fox, “sitting” in the snow",
+        seed="1234",
+        width="512",
+        height="512",
+        steps="50",
+        cfg_scale="7.5",
+    )
+    image = Image.new("RGB", (64, 64))
+
+    reopened = saved(image, format, exif=metadata_to_exif(metadata.as_dict()))
+
+    assert ImageMetadata.get_from_image(reopened) == metadata
+
+
+def test_image_without_metadata_has_none():
+    reopened = saved(Image.new("RGB", (64, 64)), "JPEG")
+
+    assert ImageMetadata.get_from_image(reopened) is None
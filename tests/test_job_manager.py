@@ -0,0 +1,143 @@
+"""
+JobManager's token queue: waiters are served by priority, then with sessions taking turns, and
+tokens of jobs that are cancelled or never start go back to the next waiter.
+"""
+import threading
+import time
+
+import pytest
+
+from frontend.job_manager import JobInfo, JobManager
+
+
+def txt2img():
+    pass
+
+
+def make_job(session_key, priority=0):
+    return JobInfo(
+        inputs=(),
+        func=txt2img,
+        session_key=session_key,
+        timestamp=time.time(),
+        priority=priority,
+    )
+
+
+class Waiter:
+    """Blocks in _get_job_token on a thread until the job is given a token or cancelled."""
+
+    def __init__(self, manager, job):
+        self.manager = manager
+        self.job = job
+        self.token = None
+        self.thread = threading.Thread(target=self.wait, daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + 5
+        while job.queue_item is None and time.monotonic() < deadline:
+            time.sleep(0.001)
+        assert job.queue_item is not None
+
+    def wait(self):
+        self.token = self.manager._get_job_token(self.job, block=True)
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(max_jobs=1)
+    holder = make_job("holder")
+    holder.job_token = manager._get_job_token(holder)
+    assert manager._claim_job_token(holder)
+    manager.holder = holder
+    return manager
+
+
+def served_order(manager, waiters):
+    """Releases the token once per waiter, each one claims it and runs to completion."""
+    order = []
+    token = manager.holder.job_token
+    pending = list(waiters)
+    while pending:
+        manager._release_job_token(token)
+        served = next_served(pending)
+        pending.remove(served)
+        served.job.job_token = token = served.token
+        assert manager._claim_job_token(served.job)
+        order.append(served.job)
+    return order
+
+
+def next_served(waiters):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        for waiter in waiters:
+            if not waiter.thread.is_alive():
+                return waiter
+        time.sleep(0.001)
+    raise AssertionError("no waiter was given the token")
+
+
+def test_waiters_are_served_by_priority_then_taking_turns(manager):
+    a1, a2, a3, b1 = (make_job(session) for session in "aaab")
+    urgent = make_job("c", priority=-1)
+    waiters = [Waiter(manager, job) for job in (a1, a2, a3, b1, urgent)]
+
+    assert served_order(manager, waiters) == [urgent, a1, b1, a2, a3]
+
+
+def test_queue_position_follows_the_serving_order(manager):
+    a1, a2, b1 = (make_job(session) for session in "aab")
+    for job in (a1, a2, b1):
+        Waiter(manager, job)
+
+    assert manager._queue_position(a1) == (1, 3)
+    assert manager._queue_position(b1) == (2, 3)
+    assert manager._queue_position(a2) == (3, 3)
+
+
+def test_cancelled_waiter_leaves_the_queue(manager):
+    first, second = make_job("a"), make_job("b")
+    first_waiter = Waiter(manager, first)
+    second_waiter = Waiter(manager, second)
+
+    manager._cancel_queued_job(first)
+    first_waiter.thread.join(1)
+    assert first_waiter.token is None
+
+    assert served_order(manager, [second_waiter]) == [second]
+    assert manager.queue_stats()["queued"] == 0
+
+
+def test_cancelling_a_job_gives_back_its_token(manager):
+    first, second = make_job("a"), make_job("b")
+    first_waiter = Waiter(manager, first)
+    second_waiter = Waiter(manager, second)
+
+    manager._release_job_token(manager.holder.job_token)
+    first_waiter.thread.join(1)
+    # the job got the token but never started, like the hung job path drops it.
+    manager._cancel_queued_job(first)
+
+    second_waiter.thread.join(1)
+    assert second_waiter.token is not None
+    first.job_token = first_waiter.token
+    assert not manager._claim_job_token(first)
+
+
+def test_unclaimed_token_is_taken_back(manager):
+    manager.JOB_MAX_CLAIM_TIME = 0.1
+    abandoned, waiting = make_job("a"), make_job("b")
+    abandoned_waiter = Waiter(manager, abandoned)
+    waiting_waiter = Waiter(manager, waiting)
+
+    manager._release_job_token(manager.holder.job_token)
+    abandoned_waiter.thread.join(1)
+    assert abandoned_waiter.token is not None
+
+    # the tab of the first job was closed, so it never claims its token.
+    waiting_waiter.thread.join(1)
+    assert waiting_waiter.token is not None
+    waiting.job_token = waiting_waiter.token
+    assert manager._claim_job_token(waiting)
+    abandoned.job_token = abandoned_waiter.token
+    assert not manager._claim_job_token(abandoned)
@@ -0,0 +1,99 @@
+"""
+drives ModelOffloader through UNet.apply_model the way the optimized samplers do, with
+FakeOffloadBackend standing in for the cuda streams so it runs without a gpu.
+"""
+import threading
+import types
+
+import pytest
+import torch
+
+from optimizedSD import offload
+from optimizedSD.ddpm import UNet
+from optimizedSD.offload import FakeOffloadBackend, ModelOffloader
+
+
+class Encoder(torch.nn.Module):
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.weight = torch.nn.Parameter(torch.ones(1))
+
+    def forward(self, x, t, cond):
+        self.backend.check_usable(self)
+        return x * self.weight, t.float(), [x + 1, x + 2]
+
+
+class Decoder(torch.nn.Module):
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.weight = torch.nn.Parameter(torch.ones(1))
+
+    def forward(self, h, emb, dtype, hs, cond):
+        self.backend.check_usable(self)
+        return (h + hs[0] + hs[1]) * self.weight
+
+
+def sample(max_resident, prefetch, steps=3, batch_size=4, unet_bs=2):
+    backend = FakeOffloadBackend(max_resident)
+    offloader = ModelOffloader("cuda", backend=backend)
+    unet = types.SimpleNamespace(
+        cdevice="cuda",
+        turbo=False,
+        prefetch=prefetch,
+        unet_bs=unet_bs,
+        split_buffers=threading.local(),
+        model1=Encoder(backend),
+        model2=Decoder(backend),
+    )
+
+    x = torch.randn(batch_size, 4, 8, 8)
+    t = torch.zeros(batch_size, dtype=torch.long)
+    cond = torch.randn(batch_size, 77, 16)
+    outputs = []
+    with pytest.MonkeyPatch.context() as patch, torch.no_grad():
+        patch.setitem(offload.offloaders, torch.device("cuda"), offloader)
+        for _ in range(steps):
+            outputs.append(UNet.apply_model(unet, x, t, cond))
+
+    for output in outputs:
+        torch.testing.assert_close(output, 3 * x + 3)
+    return backend, unet
+
+
+def test_one_module_resident_at_a_time():
+    backend, unet = sample(max_resident=1, prefetch=False)
+    assert backend.location(unet.model1) == "cpu"
+    assert backend.location(unet.model2) == "cpu"
+
+
+def test_prefetch_keeps_both_halves_resident():
+    backend, unet = sample(max_resident=2, prefetch=True)
+    # the first half was brought back in for the next step.
+    assert backend.location(unet.model1) == "cuda"
+    assert backend.location(unet.model2) == "cpu"
+
+
+def test_prefetch_needs_room_for_both_halves():
+    with pytest.raises(AssertionError, match="resident"):
+        sample(max_resident=1, prefetch=True)
+
+
+def test_every_copy_to_the_device_is_waited_for():
+    backend, unet = sample(max_resident=2, prefetch=True, steps=2)
+    to_device = [
+        entry[3] for entry in backend.log if entry[0] == "copy" and entry[2] == "cuda"
+    ]
+    # the last prefetch of model1 is only waited for by the next step.
+    assert set(to_device[:-1]) <= backend.waited
+
+
+def test_without_backend_modules_move_synchronously():
+    offloader = ModelOffloader("cpu")
+    module = torch.nn.Linear(2, 2)
+    offloader.acquire(module)
+    offloader.offload(module)
+    offloader.synchronize(module)
+    assert offloader.backend is None
+    assert next(module.parameters()).device.type == "cpu"
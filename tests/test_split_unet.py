@@ -0,0 +1,75 @@
+"""
+the split buffers of the optimized unet are shared by the steps of one sampling run and
+released when it ends, a run in another thread gets its own.
+"""
+import threading
+import types
+
+import torch
+
+from optimizedSD.ddpm import UNet
+
+
+def encoder(x, t, cond):
+    return x.clone(), t.float(), [x + 1]
+
+
+def decoder(h, emb, dtype, hs, cond):
+    return h + hs[0]
+
+
+def stand_in():
+    return types.SimpleNamespace(
+        cdevice="cpu",
+        turbo=True,
+        unet_bs=1,
+        split_buffers=threading.local(),
+        model1=encoder,
+        model2=decoder,
+    )
+
+
+def apply(unet):
+    x = torch.randn(2, 4, 8, 8)
+    t = torch.zeros(2, dtype=torch.long)
+    cond = torch.randn(2, 77, 16)
+    with torch.no_grad():
+        torch.testing.assert_close(UNet.apply_model(unet, x, t, cond), 2 * x + 1)
+
+
+def test_buffers_live_as_long_as_the_run():
+    unet = stand_in()
+    with UNet.reuse_split_buffers(unet):
+        apply(unet)
+        buffers = unet.split_buffers.current
+        first = {name: buffer[1] for name, buffer in buffers.items()}
+        apply(unet)
+        # the second step writes into the same tensors.
+        assert all(buffers[name][1] is tensor for name, tensor in first.items())
+    assert unet.split_buffers.current is None
+
+
+def test_buffers_are_not_kept_outside_of_a_run():
+    unet = stand_in()
+    apply(unet)
+    assert getattr(unet.split_buffers, "current", None) is None
+
+
+def test_concurrent_runs_get_their_own_buffers():
+    unet = stand_in()
+    seen = []
+    started = threading.Barrier(2)
+
+    def run():
+        with UNet.reuse_split_buffers(unet):
+            started.wait()
+            apply(unet)
+            seen.append(unet.split_buffers.current)
+            started.wait()
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(seen) == 2 and seen[0] is not seen[1]
@@ -0,0 +1,147 @@
+"""
+admission control driven by FakeMemoryProbe: jobs that fit run together, the others wait in
+arrival order, and batches too big for an idle GPU are split.
+"""
+import threading
+import time
+
+import pytest
+
+from vram_admission import AdmissionController, FakeMemoryProbe
+
+MB = 1_048_576
+
+
+@pytest.fixture
+def controller():
+    # 8GiB card with 1GiB used by the models, 6.5GiB left for jobs after the margin.
+    probe = FakeMemoryProbe(8192 * MB, used=1024 * MB)
+    return AdmissionController(probe, margin_mb=512)
+
+
+def start_job(controller, estimate_mb, events, name):
+    """Runs a job in a thread, it holds its reservation until events[name] is set."""
+    admitted = threading.Event()
+    events[name] = threading.Event()
+
+    def job():
+        with controller.admit(estimate_mb):
+            admitted.set()
+            events[name].wait(5)
+
+    thread = threading.Thread(target=job, daemon=True)
+    thread.start()
+    return admitted, thread
+
+
+def test_capacity_leaves_out_used_memory_and_margin(controller):
+    assert controller.capacity() == 8192 - 1024 - 512
+
+
+def test_jobs_that_fit_run_together(controller):
+    events = {}
+    first, _ = start_job(controller, 3000, events, "first")
+    second, _ = start_job(controller, 3000, events, "second")
+    assert first.wait(1) and second.wait(1)
+    assert controller.stats()["running"] == 2
+    for event in events.values():
+        event.set()
+
+
+def test_job_waits_until_there_is_room(controller):
+    events = {}
+    first, first_thread = start_job(controller, 4000, events, "first")
+    assert first.wait(1)
+    second, _ = start_job(controller, 4000, events, "second")
+    assert not second.wait(0.2)
+    assert controller.stats()["waiting"] == 1
+
+    events["first"].set()
+    first_thread.join(1)
+    assert second.wait(1)
+    events["second"].set()
+
+
+def test_jobs_are_admitted_in_arrival_order(controller):
+    events = {}
+    first, first_thread = start_job(controller, 4000, events, "first")
+    assert first.wait(1)
+    big, _ = start_job(controller, 4000, events, "big")
+    while controller.stats()["waiting"] < 1:
+        time.sleep(0.01)
+    # it would fit next to the first job, but the big one arrived before it.
+    small, _ = start_job(controller, 1000, events, "small")
+    assert not small.wait(0.2)
+
+    events["first"].set()
+    first_thread.join(1)
+    assert big.wait(1) and small.wait(1)
+    for event in events.values():
+        event.set()
+
+
+def test_idle_gpu_runs_any_job(controller):
+    with controller.admit(100_000):
+        assert controller.stats()["running"] == 1
+
+
+def test_batch_is_split_to_fit_an_idle_gpu(controller):
+    flags = dict(use_GFPGAN=False, use_RealESRGAN=False, use_LDSR=False)
+    # the priors give 1824MiB per 512x512 image, 4 of them don't fit in 6656MiB.
+    assert controller.plan_batch_size(512, 512, 8, "k_euler", **flags) == 2
+    assert controller.plan_batch_size(512, 512, 3, "k_euler", **flags) == 3
+    assert controller.plan_batch_size(2048, 2048, 4, "k_euler", **flags) == 1
+
+
+def test_peak_is_measured_for_jobs_that_ran_alone(controller):
+    probe = controller.probe
+    with controller.admit(1000) as measured_peak:
+        probe.allocate(700 * MB)
+        probe.free(700 * MB)
+        assert measured_peak() == 700
+
+    events = {}
+    admitted, _ = start_job(controller, 1000, events, "other")
+    assert admitted.wait(1)
+    with controller.admit(1000) as measured_peak:
+        # another job ran at the same time, its memory would be counted too.
+        assert measured_peak() is None
+    events["other"].set()
+
+
+def test_job_that_fails_while_waiting_leaves_the_queue(controller, monkeypatch):
+    events = {}
+    first, first_thread = start_job(controller, 4000, events, "first")
+    assert first.wait(1)
+
+    errors = []
+    admitted = []
+
+    def job(name):
+        try:
+            with controller.admit(4000):
+                admitted.append(name)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=job, args=(name,)) for name in "ab"]
+    for thread in threads:
+        thread.start()
+    while controller.stats()["waiting"] < 2:
+        time.sleep(0.01)
+
+    read = controller.probe.read
+
+    def read_once_failing():
+        monkeypatch.setattr(controller.probe, "read", read)
+        raise RuntimeError("NVML error")
+
+    monkeypatch.setattr(controller.probe, "read", read_once_failing)
+    events["first"].set()
+    first_thread.join(1)
+    for thread in threads:
+        thread.join(1)
+
+    # one of them hit the error, the other one isn't stuck behind it.
+    assert len(errors) == 1 and len(admitted) == 1
+    assert controller.stats()["waiting"] == 0